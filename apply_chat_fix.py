@@ -3,30 +3,30 @@ This script applies the chat interface fixes to prevent user messages from disap
 Run this script instead of personalassistant.py to use the fixed version.
 """
 
-import sys
+import os
 import importlib.util
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+
 # First, import the fixed chat interface
-spec = importlib.util.spec_from_file_location("fixed_chat", "fixed_chat.py")
+spec = importlib.util.spec_from_file_location("fixed_chat", os.path.join(HERE, "fixed_chat.py"))
 fixed_chat = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(fixed_chat)
 
-# Now import and run the original application
-spec = importlib.util.spec_from_file_location("personalassistant", "personalassistant.py")
-personalassistant = importlib.util.module_from_spec(spec)
+# Now import the original application; its engine and query pipeline are used unchanged
+import personalassistant
 
 # Override the original ChatInterface.__init__ to apply our fixes
 original_chat_interface_init = personalassistant.ChatInterface.__init__
 
-def patched_chat_interface_init(self, parent, toggle_theme_callback):
-    # Call the original __init__
-    original_chat_interface_init(self, parent, toggle_theme_callback)
+def patched_chat_interface_init(self, *args, **kwargs):
+    # Call the original __init__ (once per chat tab)
+    original_chat_interface_init(self, *args, **kwargs)
     # Apply our fixes
     fixed_chat.FixedChatInterface.fix_chat_interface(self)
     print("Applied chat interface fixes to prevent user messages from disappearing")
 
-# Apply the patch
-personalassistant.ChatInterface.__init__ = patched_chat_interface_init
-
-# Run the application
-spec.loader.exec_module(personalassistant)
+if __name__ == "__main__":
+    # Apply the patch and run the application
+    personalassistant.ChatInterface.__init__ = patched_chat_interface_init
+    personalassistant.main()
@@ -0,0 +1,153 @@
+"""
+This module contains the assistant's logging setup.
+
+Every module logs through the standard logging module with %-style arguments,
+for example log.debug("Loaded %d entries", count), so a message below the
+configured level is dropped by a level check before anything is formatted.
+Guard debug output that is expensive to compute with
+log.isEnabledFor(logging.DEBUG).
+
+Records that pass the level check have API keys masked and long messages
+shortened (an Ollama response alone can carry thousands of context tokens),
+then go to the console, to an in-memory ring buffer that !logs reads, and
+optionally to a rotating log file written by a background thread, so disk I/O
+never holds up a query.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import re
+import sys
+from collections import deque
+
+LOG_FORMAT = "%(asctime)s %(levelname)-7s %(name)s: %(message)s"
+LOG_FILE_MAX_BYTES = 5 * 1024 * 1024
+LOG_FILE_BACKUPS = 3
+
+# Noisy third-party loggers kept at WARNING whatever the assistant's level is
+QUIET_LOGGERS = ("urllib3", "requests", "PIL")
+
+# key=... in URLs and "key": "..." in dict or JSON dumps
+_SECRET_PARAM = re.compile(r"(\b(?:api[_-]?key|apikey|key|token|access_token|password|secret)=)[^&\s'\"]+", re.IGNORECASE)
+_SECRET_FIELD = re.compile(r"""(['"](?:api[_-]?key|apikey|key|token|access_token|password|secret)['"]\s*:\s*['"])[^'"]+""",
+                           re.IGNORECASE)
+_GOOGLE_KEY = re.compile(r"AIza[0-9A-Za-z_\-]{30,}")
+REDACTED = "***"
+
+_ring = None
+_listener = None
+_handlers = []
+
+def redact(text, secrets=()):
+    """Mask API keys in text: key=/token= parameters, "key": fields, Google keys and the given secret values"""
+    for secret in secrets:
+        text = text.replace(secret, REDACTED)
+    text = _SECRET_PARAM.sub(r"\1" + REDACTED, text)
+    text = _SECRET_FIELD.sub(r"\1" + REDACTED, text)
+    return _GOOGLE_KEY.sub(REDACTED, text)
+
+class PayloadFilter(logging.Filter):
+    """
+    Format a record's message once, mask secrets in it and cut it to max_chars.
+
+    Attached to every handler, but a record is only processed by the first one.
+    Tracebacks are rendered and masked here too, since exception messages often
+    contain the request URL.
+    """
+
+    def __init__(self, max_chars=2000, secrets=()):
+        super().__init__()
+        self.max_chars = max_chars
+        self.secrets = [s for s in secrets if s and len(s) >= 8]
+
+    def filter(self, record):
+        if getattr(record, "redacted", False):
+            return True
+        message = redact(record.getMessage(), self.secrets)
+        if self.max_chars and len(message) > self.max_chars:
+            message = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} more chars]"
+        record.msg, record.args = message, None
+        if record.exc_info:
+            record.exc_text = redact(logging.Formatter().formatException(record.exc_info), self.secrets)
+            record.exc_info = None  # Don't keep the frames alive in the ring buffer
+        record.redacted = True
+        return True
+
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` records in memory; they are only formatted when read"""
+
+    def __init__(self, capacity=2000):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def lines(self, count=50, level=logging.NOTSET):
+        """The last count formatted records at or above level, oldest first"""
+        records = [r for r in list(self.records) if r.levelno >= level]
+        return [self.format(r) for r in records[-count:]]
+
+def setup_logging(level="INFO", ring_size=2000, log_file=None, max_chars=2000, secrets=()):
+    """
+    Configure the root logger; safe to call again to change the settings.
+
+    level: Name or number of the lowest level logged anywhere
+    ring_size: Records kept in memory for recent_logs(); 0 disables the buffer
+    log_file: Path of a rotating log file written on a background thread, or None
+    max_chars: Longest message kept; longer ones are cut
+    secrets: Values (API keys) masked wherever they appear
+    """
+    global _ring, _listener
+    root = logging.getLogger()
+    for handler in _handlers:
+        root.removeHandler(handler)
+    _handlers.clear()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+    _ring = None
+
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    root.setLevel(level)
+    for name in QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(max(level, logging.WARNING))
+
+    payload_filter = PayloadFilter(max_chars, secrets)
+    formatter = logging.Formatter(LOG_FORMAT)
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    _handlers.append(console)
+    if ring_size:
+        _ring = RingBufferHandler(ring_size)
+        _ring.setFormatter(formatter)
+        _handlers.append(_ring)
+    if log_file:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8", delay=True)
+        file_handler.setFormatter(formatter)
+        records = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(records, file_handler)
+        _listener.start()
+        # The QueueHandler only renders message and traceback; file_handler adds the rest on its thread
+        _handlers.append(logging.handlers.QueueHandler(records))
+    for handler in _handlers:
+        handler.addFilter(payload_filter)
+        root.addHandler(handler)
+
+def recent_logs(count=50, level=logging.NOTSET):
+    """The last count log lines of this process at or above level"""
+    if _ring is None:
+        return []
+    return _ring.lines(count, level)
+
+def shutdown_logging():
+    """Write out records still queued for the log file"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown_logging)
@@ -0,0 +1,275 @@
+"""
+This module contains the deadline, hedging and retry helpers for backend calls.
+
+Every query carries a Deadline, and each network call derives its timeout
+from the time the query has left, so one slow backend cannot hold up a turn
+indefinitely. Idempotent GETs (Google search, Tomorrow.io) are hedged. If the
+first request has not answered by the backend's observed p95 latency, a
+duplicate is sent and whichever answers first wins, so only the slowest ~5%
+of calls cost a second request. Failed attempts are retried with jittered
+exponential backoff ("full jitter"), so retries from several queries do not
+arrive in lockstep. A CancelEvent aborts a request from another thread, even
+one still waiting for its response.
+"""
+
+import logging
+import random
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+import requests
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError
+
+log = logging.getLogger(__name__)
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """The query ran out of its time budget"""
+
+class Deadline:
+    """Absolute point in (wall clock) time by which a query must finish"""
+
+    def __init__(self, at, budget=None):
+        self.at = at
+        self.budget = budget if budget is not None else max(0.0, at - time.time())
+
+    @classmethod
+    def after(cls, seconds):
+        return cls(time.time() + seconds, seconds)
+
+    def remaining(self):
+        return max(0.0, self.at - time.time())
+
+    @property
+    def expired(self):
+        return time.time() >= self.at
+
+    def check(self):
+        if self.expired:
+            raise DeadlineExceeded(f"the query took longer than its {self.budget:.0f}s time budget")
+
+    def timeout(self, cap=None):
+        """Timeout for the next call: the time left, at most cap; raises DeadlineExceeded when none is left"""
+        self.check()
+        remaining = self.remaining()
+        return min(remaining, cap) if cap else remaining
+
+class LatencyTracker:
+    """Sliding window of a backend's response times, for choosing the hedge delay"""
+
+    def __init__(self, window=200, min_samples=20, default=1.0):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.min_samples = min_samples
+        self.default = default
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, fraction=0.95):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return self.default
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+_sending = threading.local()  # The CancelEvent of the request the current thread is sending
+
+class CancelEvent(threading.Event):
+    """
+    An Event whose set() also aborts the requests sent inside its sending() block.
+
+    Setting it shuts down their connections, so a request still waiting for
+    its response fails at once and the backend sees the client go away (a
+    streamed Ollama generation only answers once the prompt is evaluated).
+    This needs the session's adapters to go through make_abortable(); a
+    response attach()ed to the event is closed in any case.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._responses = []
+
+    @contextmanager
+    def sending(self):
+        _sending.event = self
+        try:
+            yield
+        finally:
+            _sending.event = None
+            with self._lock:
+                # The connections go back to the pool; later requests on them are not ours to abort
+                self._connections = []
+                self._responses = []
+
+    def track(self, connection):
+        with self._lock:
+            self._connections.append(connection)
+
+    def attach(self, response):
+        with self._lock:
+            if not self.is_set():
+                self._responses.append(response)
+                return
+        response.close()
+
+    def set(self):
+        with self._lock:
+            super().set()
+            connections, self._connections = self._connections, []
+            responses, self._responses = self._responses, []
+        for connection in connections:
+            sock = getattr(connection, "sock", None)
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass  # Already closed
+        for response in responses:
+            response.close()
+
+class _TrackingPool(HTTPConnectionPool):
+    def _get_conn(self, timeout=None):
+        connection = super()._get_conn(timeout)
+        event = getattr(_sending, "event", None)
+        if event is not None:
+            event.track(connection)
+        return connection
+
+class _TrackingHTTPSPool(_TrackingPool, HTTPSConnectionPool):
+    pass
+
+def make_abortable(adapter):
+    """Let a CancelEvent abort the requests adapter (a requests HTTPAdapter) sends; returns adapter"""
+    adapter.poolmanager.pool_classes_by_scheme = {"http": _TrackingPool, "https": _TrackingHTTPSPool}
+    return adapter
+
+def backoff_delay(attempt, base=0.25, cap=4.0):
+    """Full-jitter exponential backoff: uniform in [0, min(cap, base * 2**attempt)]"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="backend-get")
+
+def never_sent(error):
+    """
+    Whether a request failed before it was sent: the connection could not be
+    made (DNS failure, refused, connect timeout). A read timeout or a dropped
+    connection may come after the server has already counted the request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, (requests.exceptions.SSLError, requests.exceptions.ProxyError)) or \
+            not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    # requests wraps urllib3's MaxRetryError, whose reason is the underlying error;
+    # NewConnectionError (and NameResolutionError) derive from ConnectTimeoutError
+    return isinstance(getattr(reason, "reason", reason), ConnectTimeoutError)
+
+def _timed_get(session, tracker, url, kwargs, on_unsent):
+    start_time = time.time()
+    try:
+        return session.get(url, **kwargs)
+    except requests.exceptions.ConnectionError as e:
+        if on_unsent is not None and never_sent(e):
+            on_unsent(e)
+        raise
+    finally:
+        # Losers are recorded too, so slow responses keep counting towards the p95
+        tracker.record(time.time() - start_time)
+
+def _close_response(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+def _hedged_attempt(session, url, deadline, tracker, timeout_cap, hedge, admit, on_unsent, kwargs):
+    """One attempt: a request plus, if it is slow, a duplicate; returns the first usable response"""
+    call_kwargs = dict(kwargs, timeout=deadline.timeout(timeout_cap))
+    pending = {_pool.submit(_timed_get, session, tracker, url, call_kwargs, on_unsent)}
+    if hedge:
+        hedge_delay = tracker.percentile(0.95)
+        done, _ = wait(pending, timeout=min(hedge_delay, deadline.remaining()))
+        if not done and not deadline.expired and (admit is None or admit()):
+            log.debug("Hedging GET %s after %.2fs", url, hedge_delay)
+            call_kwargs = dict(kwargs, timeout=deadline.timeout(timeout_cap))
+            pending.add(_pool.submit(_timed_get, session, tracker, url, call_kwargs, on_unsent))
+
+    last_error = None
+    while pending:
+        done, pending = wait(pending, timeout=deadline.remaining(), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            try:
+                response = future.result()
+            except requests.exceptions.RequestException as e:
+                last_error = e
+                continue
+            if response.status_code >= 500 and (pending or len(done) > 1):
+                last_error = requests.exceptions.HTTPError(f"{response.status_code} Server Error", response=response)
+                response.close()
+                continue
+            for loser in pending | (done - {future}):
+                loser.add_done_callback(_close_response)
+            return response
+    for loser in pending:
+        loser.add_done_callback(_close_response)
+    deadline.check()
+    raise last_error or DeadlineExceeded(f"no response from {url} within the time budget")
+
+def hedged_get(session, url, deadline, tracker, timeout_cap=None, retries=2, hedge=True, admit=None, on_unsent=None,
+               **kwargs):
+    """
+    GET url within the deadline, hedging slow requests and retrying failures.
+
+    Args:
+        session: requests.Session (or the requests module) to send with
+        url: Address to GET; remaining keyword arguments go to session.get
+        deadline: Deadline of the query this call belongs to
+        tracker: LatencyTracker of this backend, updated with every response time
+        timeout_cap: Maximum timeout of a single request, regardless of the time left
+        retries: Extra attempts after connection errors, timeouts and 5xx responses
+        hedge: Whether to send a duplicate request when the first one is slow
+        admit: Optional callable asked before every extra (hedge or retry) request; returning
+            False skips it, e.g. when the request would spend API quota that is not available
+        on_unsent: Optional callable called with the exception of every request (first, hedge or
+            retry) that failed before it was sent (see never_sent), e.g. to give back its quota.
+            A hedge that loses may fail after hedged_get has returned, so it is called then
+
+    Returns:
+        The first response that is not a connection error, timeout or (when another request
+        is still pending) 5xx. Other status codes are left for the caller to handle.
+    """
+    attempt = 0
+    while True:
+        try:
+            response = _hedged_attempt(session, url, deadline, tracker, timeout_cap, hedge, admit, on_unsent, kwargs)
+            if response.status_code < 500:
+                return response
+            error = requests.exceptions.HTTPError(f"{response.status_code} Server Error", response=response)
+        except DeadlineExceeded:
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            response = None
+            error = e
+        if attempt >= retries:
+            if response is not None:
+                return response
+            raise error
+        delay = backoff_delay(attempt)
+        if delay >= deadline.remaining() or (admit is not None and not admit()):
+            if response is not None:
+                return response
+            raise error
+        log.info("Retrying GET %s in %.2fs after: %s", url, delay, error)
+        if response is not None:
+            response.close()
+        time.sleep(delay)
+        attempt += 1
@@ -0,0 +1,262 @@
+"""
+This module contains the incrementally maintained inverted index behind Docs mode.
+
+Files in a local folder are split into passages of a few hundred characters,
+and each passage's terms go into an inverted index (term -> {passage id: count})
+that is ranked with BM25. Each file's modification time and size are recorded,
+so a refresh only re-reads files that were added or changed and drops files
+that were deleted. The index is pickled to disk between sessions.
+"""
+
+import heapq
+import logging
+import math
+import os
+import pickle
+import threading
+import time
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from search_compress import tokenize
+
+Passage = namedtuple("Passage", ["path", "line", "text", "length"])
+IndexStats = namedtuple("IndexStats", ["files", "passages", "terms", "bytes"])
+
+INDEX_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+def split_passages(text, max_chars=800):
+    """Split text into (first line number, passage) chunks, preferring blank-line boundaries"""
+    passages = []
+    lines = []
+    size = 0
+    start_line = 1
+    for number, line in enumerate(text.splitlines(), 1):
+        if not lines:
+            start_line = number
+        lines.append(line)
+        size += len(line) + 1
+        at_boundary = not line.strip()
+        if size >= max_chars or (at_boundary and size >= max_chars // 2):
+            chunk = "\n".join(lines).strip()
+            if chunk:
+                passages.append((start_line, chunk))
+            lines = []
+            size = 0
+    chunk = "\n".join(lines).strip()
+    if chunk:
+        passages.append((start_line, chunk))
+    return passages
+
+def _read_and_split(path, max_chars):
+    """Worker task: read one file and return its passages with term counts"""
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    return [(line, chunk, Counter(tokenize(chunk))) for line, chunk in split_passages(text, max_chars)]
+
+class DocumentIndex:
+    """BM25 passage index over a folder, refreshed incrementally by file mtime and size"""
+
+    def __init__(self, folder, index_file, extensions, passage_chars=800, workers=4):
+        self.folder = folder
+        self.index_file = index_file
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.passage_chars = passage_chars
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._files = {}      # path -> (mtime, size, [passage ids])
+        self._passages = {}   # passage id -> Passage
+        self._postings = {}   # term -> {passage id: term count}
+        self._total_length = 0
+        self._next_id = 0
+        self.last_refresh = 0.0
+        self._load()
+
+    def refresh(self):
+        """Re-index new and changed files and drop deleted ones; returns the number of files changed"""
+        if not self._refresh_lock.acquire(blocking=False):
+            return 0  # Another refresh is already running
+        try:
+            start_time = time.time()
+            seen = self._scan()
+            removed, changed = self._drop_removed(seen)
+
+            # Reading and tokenizing runs in the pool; merging into the index is serialized
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {path: pool.submit(_read_and_split, path, self.passage_chars) for path in changed}
+                for path, future in futures.items():
+                    try:
+                        passages = future.result()
+                    except Exception as e:
+                        log.warning("Error indexing %s: %s", path, e)
+                        continue
+                    with self._lock:
+                        self._remove_file(path)
+                        self._add_file(path, seen[path], passages)
+
+            self.last_refresh = time.time()
+            if removed or changed:
+                self._save()
+            self._log_refresh(len(changed), len(removed), start_time)
+            return len(changed) + len(removed)
+        finally:
+            self._refresh_lock.release()
+
+    def refresh_paced(self, checkpoint):
+        """
+        Idle-time refresh (see idle_jobs.py): files are read one at a time on
+        the calling thread, with checkpoint() called before each one.
+
+        No lock is held across checkpoint(), so while this refresh is paused a
+        refresh() for a query still runs in full; files it indexed meanwhile
+        are skipped here. Returns the number of files changed.
+        """
+        start_time = time.time()
+        seen = self._scan(checkpoint)
+        removed, changed = self._drop_removed(seen)
+        updated = 0
+        for path in changed:
+            checkpoint()
+            try:
+                passages = _read_and_split(path, self.passage_chars)
+            except Exception as e:
+                log.warning("Error indexing %s: %s", path, e)
+                continue
+            with self._lock:
+                if self._files.get(path, (None, None))[:2] == seen[path]:
+                    continue  # A refresh() got there first
+                self._remove_file(path)
+                self._add_file(path, seen[path], passages)
+            updated += 1
+        self.last_refresh = time.time()
+        if removed or updated:
+            self._save()
+        self._log_refresh(updated, len(removed), start_time)
+        return updated + len(removed)
+
+    def _scan(self, checkpoint=None):
+        """path -> (mtime, size) of every indexed file type in the folder"""
+        seen = {}
+        for root, _, names in os.walk(self.folder):
+            if checkpoint is not None:
+                checkpoint()
+            for name in names:
+                if name.lower().endswith(self.extensions):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    seen[path] = (stat.st_mtime, stat.st_size)
+        return seen
+
+    def _drop_removed(self, seen):
+        """Drop deleted files from the index; returns (removed, changed) paths"""
+        with self._lock:
+            removed = [path for path in self._files if path not in seen]
+            changed = [path for path, signature in seen.items()
+                       if self._files.get(path, (None, None))[:2] != signature]
+            for path in removed:
+                self._remove_file(path)
+        return removed, changed
+
+    def _log_refresh(self, changed, removed, start_time):
+        if log.isEnabledFor(logging.DEBUG):
+            stats = self.stats()
+            log.debug("Docs index refresh: %d changed, %d removed in %.3fs (%d files, %d passages, %d terms, %.0f KB)",
+                      changed, removed, time.time() - start_time,
+                      stats.files, stats.passages, stats.terms, stats.bytes / 1024)
+
+    def search(self, query, top_k=4):
+        """Return the top_k (score, Passage) pairs for the query, best first"""
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._passages)
+            if not n or not terms:
+                return []
+            avg_length = self._total_length / n or 1.0
+            k1, b = 1.2, 0.75
+            scores = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for passage_id, tf in postings.items():
+                    length = self._passages[passage_id].length
+                    norm = k1 * (1 - b + b * length / avg_length)
+                    scores[passage_id] = scores.get(passage_id, 0.0) + idf * tf * (k1 + 1) / (tf + norm)
+            best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+            return [(score, self._passages[passage_id]) for passage_id, score in best]
+
+    def stats(self):
+        size = os.path.getsize(self.index_file) if os.path.exists(self.index_file) else 0
+        with self._lock:
+            return IndexStats(len(self._files), len(self._passages), len(self._postings), size)
+
+    def _add_file(self, path, signature, passages):
+        ids = []
+        for line, chunk, counts in passages:
+            passage_id = self._next_id
+            self._next_id += 1
+            length = sum(counts.values())
+            self._passages[passage_id] = Passage(os.path.relpath(path, self.folder), line, chunk, length)
+            self._total_length += length
+            for term, count in counts.items():
+                self._postings.setdefault(term, {})[passage_id] = count
+            ids.append(passage_id)
+        self._files[path] = (signature[0], signature[1], ids)
+
+    def _remove_file(self, path):
+        entry = self._files.pop(path, None)
+        if entry is None:
+            return
+        for passage_id in entry[2]:
+            passage = self._passages.pop(passage_id)
+            self._total_length -= passage.length
+            for term in set(tokenize(passage.text)):
+                postings = self._postings.get(term)
+                if postings is not None:
+                    postings.pop(passage_id, None)
+                    if not postings:
+                        del self._postings[term]
+
+    def _save(self):
+        with self._lock:
+            state = {
+                "version": INDEX_VERSION,
+                "folder": self.folder,
+                "passage_chars": self.passage_chars,
+                "files": self._files,
+                "passages": {pid: tuple(p) for pid, p in self._passages.items()},
+                "postings": self._postings,
+                "total_length": self._total_length,
+                "next_id": self._next_id,
+            }
+            tmp_path = self.index_file + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # Inside the lock: a query's refresh and an idle-time one may save at once
+            os.replace(tmp_path, self.index_file)
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "rb") as f:
+                state = pickle.load(f)
+            # Rebuild from scratch if the folder or passage size changed
+            if (state.get("version") != INDEX_VERSION or state["folder"] != self.folder
+                    or state["passage_chars"] != self.passage_chars):
+                return
+            self._files = state["files"]
+            self._passages = {pid: Passage(*p) for pid, p in state["passages"].items()}
+            self._postings = state["postings"]
+            self._total_length = state["total_length"]
+            self._next_id = state["next_id"]
+            log.debug("Loaded docs index with %d files and %d passages", len(self._files), len(self._passages))
+        except Exception as e:
+            log.warning("Error loading docs index, rebuilding: %s", e)
@@ -0,0 +1,178 @@
+"""
+This module contains the offline geocoder used by the !weather command.
+
+City names are resolved against a bundled gazetteer file without any network
+call. Normalized names are kept in a sorted array, so exact and prefix lookups
+are a binary search. Misspellings fall back to fuzzy matching within the
+names that share the same first letter. Resolved locations are cached in a
+small JSON file so they survive restarts.
+"""
+
+import bisect
+import difflib
+import json
+import logging
+import os
+import re
+import unicodedata
+from collections import namedtuple
+
+Location = namedtuple("Location", ["name", "country", "lat", "lon"])
+
+log = logging.getLogger(__name__)
+
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9]+")
+
+def normalize_place(text):
+    """Lowercase, strip accents and punctuation: 'Zürich, CH' -> 'zurich ch'"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_ALNUM_RE.sub(" ", text.lower()).strip()
+
+class Geocoder:
+    """Resolve city names to coordinates from a gazetteer file"""
+
+    MIN_PREFIX_LENGTH = 3
+    PREFIX_SCAN_LIMIT = 50
+    FUZZY_CUTOFF = 0.75
+
+    def __init__(self, gazetteer_file, cache_file=None):
+        self.cache_file = cache_file
+        self._cities = []     # (name, country code, lat, lon, population)
+        self._keys = []       # sorted normalized names (including alternates)
+        self._ids = []        # city index for each entry in _keys
+        self._buckets = {}    # first letter -> distinct keys, for fuzzy matching
+        self._countries = {}  # normalized country name or code -> country code
+        self._cache = {}
+        self._load_gazetteer(gazetteer_file)
+        self._load_cache()
+
+    def resolve(self, query):
+        """Return a Location for a query like 'Paris', 'paris, fr' or 'Zurich Switzerland', or None"""
+        normalized = normalize_place(query)
+        if not normalized:
+            return None
+        cached = self._cache.get(normalized)
+        if cached is not None:
+            return Location(*cached)
+
+        city, country = self._split_country(query)
+        index = self._lookup(city, country)
+        if index is None:
+            return None
+        name, country_code, lat, lon, _ = self._cities[index]
+        location = Location(name, country_code, lat, lon)
+        self._cache[normalized] = list(location)
+        self._save_cache()
+        return location
+
+    def _split_country(self, query):
+        """
+        Split an optional trailing country qualifier off the query. A comma
+        qualifier that is not a known country stays part of the place name,
+        so 'Paris, Narnia' does not resolve to Paris, FR.
+        """
+        if "," in query:
+            city, _, qualifier = query.rpartition(",")
+            country = self._countries.get(normalize_place(qualifier))
+            if country is not None:
+                return normalize_place(city), country
+            return normalize_place(query), None
+        words = normalize_place(query).split()
+        # "Paris France" / "San Jose Costa Rica": try the longest trailing country name first
+        for size in range(min(3, len(words) - 1), 0, -1):
+            country = self._countries.get(" ".join(words[-size:]))
+            if country is not None:
+                city = " ".join(words[:-size])
+                if self._exact(city, country) or self._fuzzy(city, country) is not None:
+                    return city, country
+        return " ".join(words), None
+
+    def _lookup(self, city, country):
+        exact = self._exact(city, country)
+        if exact:
+            return self._most_populous(exact)
+        if len(city) >= self.MIN_PREFIX_LENGTH:
+            prefixed = self._prefixed(city, country)
+            if prefixed:
+                return self._most_populous(prefixed)
+        return self._fuzzy(city, country)
+
+    def _exact(self, key, country=None):
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_right(self._keys, key, lo=start)
+        return self._filter(self._ids[start:end], country)
+
+    def _prefixed(self, prefix, country=None):
+        start = bisect.bisect_left(self._keys, prefix)
+        matches = []
+        for i in range(start, min(start + self.PREFIX_SCAN_LIMIT, len(self._keys))):
+            if not self._keys[i].startswith(prefix):
+                break
+            matches.append(self._ids[i])
+        return self._filter(matches, country)
+
+    def _fuzzy(self, key, country=None):
+        if not key:
+            return None
+        candidates = self._buckets.get(key[0], [])
+        for match in difflib.get_close_matches(key, candidates, n=3, cutoff=self.FUZZY_CUTOFF):
+            exact = self._exact(match, country)
+            if exact:
+                return self._most_populous(exact)
+        return None
+
+    def _filter(self, ids, country):
+        if country is None:
+            return ids
+        return [i for i in ids if self._cities[i][1] == country]
+
+    def _most_populous(self, ids):
+        return max(ids, key=lambda i: self._cities[i][4])
+
+    def _load_gazetteer(self, path):
+        entries = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                fields = line.split("\t")
+                if line.startswith("="):
+                    code = fields[0][1:]
+                    self._countries[code.lower()] = code
+                    for name in fields[1].split(","):
+                        self._countries[normalize_place(name)] = code
+                    continue
+                name, code, lat, lon, population = fields[:5]
+                index = len(self._cities)
+                self._cities.append((name, code, float(lat), float(lon), int(population or 0)))
+                aliases = [name] + [a for a in (fields[5] if len(fields) > 5 else "").split(",") if a]
+                for key in {normalize_place(a) for a in aliases}:
+                    entries.append((key, index))
+        entries.sort()
+        self._keys = [key for key, _ in entries]
+        self._ids = [index for _, index in entries]
+        for key in dict.fromkeys(self._keys):
+            self._buckets.setdefault(key[0], []).append(key)
+        log.debug("Loaded gazetteer with %d places", len(self._cities))
+
+    def _load_cache(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                self._cache = json.load(f)
+        except Exception as e:
+            log.warning("Error loading geocode cache: %s", e)
+
+    def _save_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            tmp_path = self.cache_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._cache, f, indent=2)
+            os.replace(tmp_path, self.cache_file)
+        except Exception as e:
+            log.warning("Error saving geocode cache: %s", e)
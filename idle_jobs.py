@@ -0,0 +1,166 @@
+"""
+This module contains the scheduler that runs maintenance jobs while the assistant is idle.
+
+Jobs such as re-scanning the docs folder or compacting the memory file are
+registered with the interval they should run at. A due job only starts while
+the user is away (the window is hidden, or nothing was typed for idle_after
+seconds), no query is being answered and the load average is low. Jobs run one
+at a time on a single background thread.
+
+A job receives a checkpoint function and calls it between small units of work
+(a file, a message). When a query starts, begin_interactive() pauses the
+scheduler at once and the job blocks in its next checkpoint until the user is
+idle again, so maintenance never competes with an answer. Jobs must not hold
+a lock that queries need while they call checkpoint().
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+class JobCancelled(BaseException):
+    """
+    Raised by checkpoint() when the scheduler is stopping. Like
+    KeyboardInterrupt it is not an Exception, so a job's own error handling
+    does not swallow it.
+    """
+
+class IdleJob:
+    def __init__(self, name, run, interval):
+        self.name = name
+        self.run = run
+        self.interval = interval
+        self.last_run = 0.0
+
+class IdleScheduler:
+    """Runs registered jobs while the user is idle; see the module docstring"""
+
+    def __init__(self, idle_after=120, max_load=0.5, poll_interval=5.0):
+        self.idle_after = idle_after
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+        self.hidden = False
+        self.last_input = time.time()
+        self._jobs = []
+        self._lock = threading.Lock()
+        self._interactive = 0          # Queries being answered right now
+        self._runnable = threading.Event()  # Cleared the moment the user becomes active
+        self._changed = threading.Event()   # Wakes the scheduler and paused jobs
+        self._stopping = False
+        self._thread = None
+
+    def register(self, name, run, interval):
+        """Run run(checkpoint) at most every interval seconds while idle"""
+        with self._lock:
+            self._jobs.append(IdleJob(name, run, interval))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="idle-jobs", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Cancel the running job at its next checkpoint and end the scheduler thread"""
+        self._stopping = True
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def set_ui_state(self, hidden=None, active_at=None):
+        """Record that the window was shown or hidden, or that the user typed at active_at"""
+        with self._lock:
+            if hidden is not None:
+                self.hidden = hidden
+            if active_at is not None:
+                self.last_input = max(self.last_input, active_at)
+            if not self._user_away():
+                self._runnable.clear()
+        self._changed.set()
+
+    def begin_interactive(self):
+        """Pause maintenance until end_interactive(); call when a query starts"""
+        with self._lock:
+            self._interactive += 1
+            self._runnable.clear()
+
+    def end_interactive(self):
+        with self._lock:
+            self._interactive -= 1
+            self.last_input = max(self.last_input, time.time())
+        self._changed.set()
+
+    @contextmanager
+    def interactive(self):
+        self.begin_interactive()
+        try:
+            yield
+        finally:
+            self.end_interactive()
+
+    def checkpoint(self):
+        """Called by jobs between units of work: returns at once while idle, blocks while the user is active"""
+        if self._stopping:
+            raise JobCancelled()
+        if self._runnable.is_set():
+            return
+        paused_at = time.time()
+        while not self._update_runnable(check_load=False):
+            self._changed.wait(self.poll_interval)
+            self._changed.clear()
+            if self._stopping:
+                raise JobCancelled()
+        log.debug("Idle job resumed after a %.1fs pause", time.time() - paused_at)
+
+    def _user_away(self):
+        return self._interactive == 0 and (self.hidden or time.time() - self.last_input >= self.idle_after)
+
+    def _cpu_busy(self):
+        if hasattr(os, "getloadavg"):  # Not available on Windows
+            return os.getloadavg()[0] / (os.cpu_count() or 1) > self.max_load
+        return False
+
+    def _update_runnable(self, check_load=True):
+        """
+        Set or clear the runnable flag from the current state. The load average
+        is only checked before a job starts: a running job raises it itself.
+        """
+        with self._lock:
+            runnable = self._user_away()
+        if runnable and check_load and self._cpu_busy():
+            runnable = False
+        with self._lock:
+            # A query may have started while the load average was read
+            if runnable and self._user_away():
+                self._runnable.set()
+                return True
+            self._runnable.clear()
+            return False
+
+    def _due_job(self):
+        now = time.time()
+        with self._lock:
+            due = [job for job in self._jobs if now - job.last_run >= job.interval]
+        return min(due, key=lambda job: job.last_run) if due else None
+
+    def _loop(self):
+        while not self._stopping:
+            self._changed.wait(self.poll_interval)
+            self._changed.clear()
+            if self._stopping:
+                break
+            job = self._due_job()
+            if job is None or not self._update_runnable():
+                continue
+            start_time = time.time()
+            try:
+                job.run(self.checkpoint)
+            except JobCancelled:
+                break
+            except Exception as e:
+                log.warning("Idle job %s failed: %s", job.name, e, exc_info=True)
+            job.last_run = time.time()
+            log.debug("Idle job %s finished in %.3fs", job.name, job.last_run - start_time)
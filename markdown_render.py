@@ -0,0 +1,147 @@
+"""
+This module contains the incremental markdown renderer for the chat display.
+
+LLM answers arrive as markdown in small streamed chunks. Re-parsing the whole
+message on every chunk would be quadratic, so the renderer only parses text
+that has just arrived. The unfinished tail line is appended as plain text, and
+once its newline arrives it is replaced by the line rendered with its final
+tags, so each chunk costs work in proportion to its own length.
+"""
+
+import itertools
+import re
+import tkinter as tk
+
+_HEADING_RE = re.compile(r"^(#{1,6})\s+(.*)$")
+_LIST_RE = re.compile(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$")
+_FENCE_RE = re.compile(r"^\s*```")
+# Inline spans: **bold**, __bold__, `code`, *italic*
+_INLINE_RE = re.compile(r"(\*\*[^*]+\*\*|__[^_]+__|`[^`]+`|\*[^*\s][^*]*\*)")
+
+_renderer_ids = itertools.count()
+
+def configure_markdown_tags(text_widget, theme, font_family="Segoe UI", size=11):
+    """Configure the markdown tags on a Text widget for the given theme"""
+    text_widget.tag_configure("md_h1", font=(font_family, size + 5, "bold"), foreground=theme['text'])
+    text_widget.tag_configure("md_h2", font=(font_family, size + 3, "bold"), foreground=theme['text'])
+    text_widget.tag_configure("md_h3", font=(font_family, size + 1, "bold"), foreground=theme['text'])
+    text_widget.tag_configure("md_bold", font=(font_family, size, "bold"))
+    text_widget.tag_configure("md_italic", font=(font_family, size, "italic"))
+    text_widget.tag_configure("md_code", font=("Consolas", size - 1), background=theme['input_bg'])
+    text_widget.tag_configure("md_list", lmargin1=15, lmargin2=30)
+
+class MarkdownStreamRenderer:
+    """
+    Render a markdown message into a Text widget as it streams in.
+
+    Text is inserted at a private mark created at the end of the widget,
+    followed by a placeholder newline. Other messages inserted at the end of
+    the widget while this one streams therefore go below it, on their own
+    line, and never inside the text this renderer replaces. The caller is
+    responsible for the widget state (NORMAL while feeding).
+    """
+
+    def __init__(self, text_widget, base_tag="assistant"):
+        self.text = text_widget
+        self.base_tag = base_tag
+        self._pending = []      # Chunks of the current unfinished line, shown as plain text
+        self._in_code = False   # Inside a ``` fenced block
+        renderer_id = next(_renderer_ids)
+        self._end_mark = f"md_end_{renderer_id}"
+        self._line_mark = f"md_line_{renderer_id}"
+        # Left gravity: text inserted at the end of the widget goes after both marks
+        self.text.mark_set(self._end_mark, "end-1c")
+        self.text.mark_gravity(self._end_mark, tk.LEFT)
+        self.text.mark_set(self._line_mark, "end-1c")
+        self.text.mark_gravity(self._line_mark, tk.LEFT)
+        self.text.insert(self._end_mark, "\n")
+
+    def feed(self, chunk):
+        """Render a newly arrived chunk of markdown"""
+        if not chunk:
+            return
+        if "\n" not in chunk:
+            self._pending.append(chunk)
+            self._insert_pending(chunk)
+            return
+        first, *complete, rest = chunk.split("\n")
+        # Replace the plain text of the finished line with its rendering
+        self.text.delete(self._line_mark, self._end_mark)
+        self._render_line("".join(self._pending) + first)
+        for line in complete:
+            self._render_line(line)
+        self.text.mark_set(self._line_mark, self._end_mark)
+        self._pending = [rest] if rest else []
+        if rest:
+            self._insert_pending(rest)
+
+    def finish(self, trailer=()):
+        """Finalize the last line, append (text, tags) trailer parts and release the marks"""
+        if self._pending:
+            self.text.delete(self._line_mark, self._end_mark)
+            self._render_line("".join(self._pending), newline=False)
+            self._pending = []
+        self.text.delete(self._end_mark)  # The placeholder newline
+        for text, tags in trailer:
+            self._insert_at_end(text, tags)
+        self.text.mark_unset(self._end_mark, self._line_mark)
+
+    def discard(self, start):
+        """Delete everything from start (an index before the message) through this message, and release the marks"""
+        self.text.delete(start, f"{self._end_mark} + 1c")
+        self.text.mark_unset(self._end_mark, self._line_mark)
+
+    def _insert_pending(self, text):
+        if self._in_code:
+            self._insert(text, "md_code")
+        else:
+            self._insert(text)
+
+    def _insert(self, text, *tags):
+        self._insert_at_end(text, (self.base_tag,) + tags)
+
+    def _insert_at_end(self, text, tags):
+        # Only this insert moves the end mark along; others at the same index stay after it
+        self.text.mark_gravity(self._end_mark, tk.RIGHT)
+        self.text.insert(self._end_mark, text, tags)
+        self.text.mark_gravity(self._end_mark, tk.LEFT)
+
+    def _render_line(self, line, newline=True):
+        end = "\n" if newline else ""
+        if _FENCE_RE.match(line):
+            self._in_code = not self._in_code
+            return
+        if self._in_code:
+            self._insert(line + end, "md_code")
+            return
+
+        heading = _HEADING_RE.match(line)
+        if heading:
+            level = min(len(heading.group(1)), 3)
+            self._insert(heading.group(2) + end, f"md_h{level}")
+            return
+
+        item = _LIST_RE.match(line)
+        if item:
+            indent, marker, rest = item.groups()
+            bullet = "•" if marker in "-*+" else marker
+            self._insert(f"{'  ' * (len(indent) // 2)}{bullet} ", "md_list")
+            self._render_inline(rest, "md_list")
+            self._insert(end, "md_list")
+            return
+
+        self._render_inline(line)
+        self._insert(end)
+
+    def _render_inline(self, text, *tags):
+        for part in _INLINE_RE.split(text):
+            if not part:
+                continue
+            if (part.startswith("**") or part.startswith("__")) and len(part) > 4:
+                self._insert(part[2:-2], "md_bold", *tags)
+            elif part.startswith("`") and len(part) > 2:
+                self._insert(part[1:-1], "md_code", *tags)
+            elif part.startswith("*") and part.endswith("*") and len(part) > 2:
+                self._insert(part[1:-1], "md_italic", *tags)
+            else:
+                self._insert(part, *tags)
@@ -0,0 +1,277 @@
+"""
+This module contains the compacted on-disk format of the conversation memory file.
+
+Conversations repeat themselves: the same question asked again, the same
+boilerplate answer given in several conversations. Instead of storing every
+message verbatim, the file keeps a table of distinct texts, and each message
+refers to one of them. A message that is a near duplicate of a stored text
+(found with MinHash signatures and locality-sensitive hashing over shingles)
+refers to that text plus a small patch, so every message is restored exactly
+as it was written.
+
+File format (version 2):
+
+    {"version": 2,
+     "texts": ["first text", "second text", ...],
+     "conversations": {id: {"timestamp": ..., "important": ...,
+                            "messages": [{"role": "user", "text": 0}, {"role": "user", "text": 0, "patch": [[start, end, "new"]]}]}}}
+
+Version 1 files (messages stored verbatim as {"role", "content"}) are still read.
+
+Saving a conversation (put_conversation) only stores exact repeats once and
+leaves the other conversations' entries as they are; the full near-duplicate
+pass (compact) runs separately, in the background (see idle_jobs.py).
+fit_budget() ranks conversations by their stored, deduplicated size, so
+repeated messages do not use up the memory budget.
+"""
+
+import json
+import os
+import random
+import re
+import zlib
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+FORMAT_VERSION = 2
+NUM_PERM = 64          # MinHash permutations
+LSH_BANDS = 16         # NUM_PERM / LSH_BANDS rows per band; candidates share all rows of a band
+SHORT_TEXT_WORDS = 8   # Texts with fewer words are shingled by characters instead of words
+MAX_PATCH_SHARE = 0.5  # Store a near duplicate as a patch only if the patch is smaller than this share of it
+
+_PRIME = (1 << 31) - 1
+_rng = random.Random(20240607)  # Fixed seed: signatures only have to agree within one compaction pass
+_PERMUTATIONS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+_WORD_RE = re.compile(r"\w+")
+
+CompactionStats = namedtuple("CompactionStats", ["messages", "texts", "exact", "near"])
+
+def shingles(text):
+    """Word 3-grams of the normalized text, or character 4-grams for short texts"""
+    words = _WORD_RE.findall(text.lower())
+    if len(words) >= SHORT_TEXT_WORDS:
+        return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+    joined = " ".join(words)
+    if len(joined) <= 4:
+        return {joined}
+    return {joined[i:i + 4] for i in range(len(joined) - 3)}
+
+def minhash(text):
+    """MinHash signature of text's shingles: NUM_PERM minimum hash values"""
+    hashes = [zlib.crc32(shingle.encode("utf-8")) % _PRIME for shingle in shingles(text)]
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+def estimated_similarity(first, second):
+    """Estimated Jaccard similarity of the shingle sets behind two signatures"""
+    return sum(x == y for x, y in zip(first, second)) / NUM_PERM
+
+class LSHIndex:
+    """Buckets signatures by band, so only texts sharing a band are compared"""
+
+    def __init__(self, bands=LSH_BANDS):
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self._buckets = {}     # (band, band values) -> [keys]
+        self._signatures = {}  # key -> signature
+
+    def add(self, key, signature):
+        self._signatures[key] = signature
+        for band in range(self.bands):
+            self._buckets.setdefault(self._band_key(band, signature), []).append(key)
+
+    def most_similar(self, signature):
+        """(key, estimated similarity) of the most similar indexed signature, or (None, 0.0)"""
+        candidates = set()
+        for band in range(self.bands):
+            candidates.update(self._buckets.get(self._band_key(band, signature), ()))
+        best, best_score = None, 0.0
+        for key in candidates:
+            score = estimated_similarity(signature, self._signatures[key])
+            if score > best_score:
+                best, best_score = key, score
+        return best, best_score
+
+    def _band_key(self, band, signature):
+        return band, signature[band * self.rows:(band + 1) * self.rows]
+
+def make_patch(base, text):
+    """Edits that turn base into text, as [start, end, replacement] over base"""
+    matcher = SequenceMatcher(None, base, text, autojunk=False)
+    return [[i1, i2, text[j1:j2]] for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
+def apply_patch(base, patch):
+    parts = []
+    position = 0
+    for start, end, replacement in patch:
+        parts.append(base[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(base[position:])
+    return "".join(parts)
+
+def compact(conversations, threshold=0.7, checkpoint=None):
+    """
+    Turn {id: conversation with verbatim messages} into a version 2 document.
+
+    Returns (document, CompactionStats). Messages are matched against the
+    texts stored so far; an exact repeat refers to the text, a near duplicate
+    (estimated similarity of at least threshold) refers to it with a patch,
+    anything else becomes a new text. A threshold of None only stores exact
+    repeats once, which is much cheaper. checkpoint, if given, is called
+    before each message.
+    """
+    texts = []
+    exact = {}  # text -> index
+    index = LSHIndex()
+    exact_count = near_count = message_count = 0
+    out = {}
+    # Oldest first, so earlier wordings become the stored texts
+    for conversation_id, conversation in sorted(conversations.items(), key=lambda item: item[1].get("timestamp", "")):
+        messages = []
+        for message in conversation.get("messages", []):
+            if checkpoint is not None:
+                checkpoint()
+            message_count += 1
+            content = message.get("content", "")
+            entry = {key: value for key, value in message.items() if key != "content"}
+            if content in exact:
+                entry["text"] = exact[content]
+                exact_count += 1
+                messages.append(entry)
+                continue
+            if threshold is None:
+                signature = None
+                match, score = None, 0.0
+            else:
+                signature = minhash(content)
+                match, score = index.most_similar(signature)
+            if match is not None and score >= threshold:
+                patch = make_patch(texts[match], content)
+                patch_size = sum(len(replacement) + 8 for _, _, replacement in patch)
+                if patch_size < MAX_PATCH_SHARE * len(content) and apply_patch(texts[match], patch) == content:
+                    entry.update(text=match, patch=patch)
+                    near_count += 1
+                    messages.append(entry)
+                    continue
+            entry["text"] = len(texts)
+            exact[content] = len(texts)
+            if signature is not None:
+                index.add(len(texts), signature)
+            texts.append(content)
+            messages.append(entry)
+        out[conversation_id] = dict({key: value for key, value in conversation.items() if key != "messages"},
+                                    messages=messages)
+    document = {"version": FORMAT_VERSION, "texts": texts, "conversations": out}
+    return document, CompactionStats(message_count, len(texts), exact_count, near_count)
+
+def expand(document):
+    """Restore {id: conversation with verbatim messages} from a version 1 or 2 document"""
+    if document.get("version") != FORMAT_VERSION:
+        return document  # Version 1: already verbatim
+    texts = document["texts"]
+    conversations = {}
+    for conversation_id, conversation in document["conversations"].items():
+        messages = []
+        for entry in conversation.get("messages", []):
+            message = {key: value for key, value in entry.items() if key not in ("text", "patch")}
+            content = texts[entry["text"]]
+            if "patch" in entry:
+                content = apply_patch(content, entry["patch"])
+            message["content"] = content
+            messages.append(message)
+        conversations[conversation_id] = dict(conversation, messages=messages)
+    return conversations
+
+def load_conversations(path):
+    """The stored conversations with their messages restored, or {} if there is no file"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return expand(json.load(f))
+
+def summarize(path):
+    """(conversations, messages, important conversations) in the file, without restoring the messages"""
+    if not os.path.exists(path):
+        return 0, 0, 0
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    conversations = document["conversations"] if document.get("version") == FORMAT_VERSION else document
+    return (len(conversations), sum(len(conv.get("messages", [])) for conv in conversations.values()),
+            sum(1 for conv in conversations.values() if conv.get("important", False)))
+
+def load_document(path):
+    """The file as a version 2 document (an empty one if there is no file); version 1 files are converted"""
+    if not os.path.exists(path):
+        return {"version": FORMAT_VERSION, "texts": [], "conversations": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        document = json.load(f)
+    if document.get("version") != FORMAT_VERSION:
+        document, _ = compact(document, threshold=None)
+    return document
+
+def put_conversation(document, conversation_id, conversation):
+    """
+    Store or replace one conversation in document. Its messages reuse texts
+    already stored when they repeat one exactly; near duplicates are left for
+    the next compact(). Other conversations keep their entries and patches.
+    """
+    texts = document["texts"]
+    stored = {text: index for index, text in enumerate(texts)}
+    messages = []
+    for message in conversation.get("messages", []):
+        content = message.get("content", "")
+        entry = {key: value for key, value in message.items() if key != "content"}
+        entry["text"] = stored.get(content)
+        if entry["text"] is None:
+            entry["text"] = stored[content] = len(texts)
+            texts.append(content)
+        messages.append(entry)
+    document["conversations"][conversation_id] = dict(
+        {key: value for key, value in conversation.items() if key != "messages"}, messages=messages)
+
+def fit_budget(document, ranked_ids, max_chars, max_conversations=None):
+    """
+    The leading conversations of ranked_ids whose stored size fits in max_chars.
+
+    A conversation costs the characters of the texts it is the first (in
+    ranked order) to refer to, plus its patches, so repeated messages only
+    count once. The first conversation is always kept.
+    """
+    texts = document["texts"]
+    counted = set()
+    kept = []
+    total = 0
+    for conversation_id in ranked_ids:
+        if max_conversations is not None and len(kept) >= max_conversations:
+            break
+        entries = document["conversations"][conversation_id].get("messages", [])
+        new_texts = {entry["text"] for entry in entries} - counted
+        cost = (sum(len(texts[index]) for index in new_texts)
+                + sum(len(replacement) for entry in entries for _, _, replacement in entry.get("patch", ())))
+        if kept and total + cost > max_chars:
+            break
+        kept.append(conversation_id)
+        counted |= new_texts
+        total += cost
+    return kept
+
+def keep_conversations(document, conversation_ids):
+    """Drop every other conversation from document, and the texts no kept message refers to"""
+    conversations = {conversation_id: document["conversations"][conversation_id] for conversation_id in conversation_ids}
+    renumbered = {}
+    texts = []
+    for conversation in conversations.values():
+        for entry in conversation.get("messages", []):
+            if entry["text"] not in renumbered:
+                renumbered[entry["text"]] = len(texts)
+                texts.append(document["texts"][entry["text"]])
+            entry["text"] = renumbered[entry["text"]]
+    document["texts"] = texts
+    document["conversations"] = conversations
+
+def write_document(path, document):
+    """Replace the file with a document made by compact()"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(document, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
@@ -0,0 +1,143 @@
+"""
+This module contains the model shootout used by the !compare command.
+
+The same prompt is sent to several local Ollama models, either concurrently
+or one after another. The latter is for setups where Ollama cannot keep all
+of them loaded at once, because queued requests would otherwise count their
+waiting time as latency. Each run records time to first token, generation
+speed, total latency and the memory the model occupies according to
+/api/ps. Results are appended to a JSON lines file so runs on different
+hardware or days can be compared later.
+"""
+
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import requests
+
+ModelRun = namedtuple("ModelRun", [
+    "model",              # Model name as configured
+    "answer",             # Full answer text (empty on error)
+    "ttft",               # Seconds from sending the request to the first token
+    "tokens_per_second",  # Generation speed reported by Ollama (eval_count / eval_duration)
+    "total_time",         # Seconds from sending the request to the final chunk
+    "load_time",          # Seconds Ollama spent loading the model for this request
+    "memory_bytes",       # Total model size in memory, from /api/ps
+    "vram_bytes",         # Part of memory_bytes held in GPU memory
+    "error",              # Error message, or None
+])
+
+def _model_names_match(configured, loaded):
+    # /api/ps reports "llama3.1:latest" for a model configured as "llama3.1"
+    return loaded == configured or (":" not in configured and loaded == f"{configured}:latest")
+
+def model_memory(ps_url, model, timeout=5):
+    """Return (size, size_vram) in bytes for a loaded model, or (None, None)"""
+    try:
+        response = requests.get(ps_url, timeout=timeout)
+        response.raise_for_status()
+        for entry in response.json().get('models', []):
+            if _model_names_match(model, entry.get('name', '')):
+                return entry.get('size'), entry.get('size_vram')
+    except (requests.exceptions.RequestException, ValueError):
+        pass
+    return None, None
+
+def run_model(generate_url, ps_url, model, prompt, timeout=300):
+    """Stream one answer from a model and measure it"""
+    start_time = time.time()
+    first_token_time = None
+    parts = []
+    result = {}
+    try:
+        payload = {"model": model, "prompt": prompt, "stream": True}
+        with requests.post(generate_url, json=payload, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                result = json.loads(line)
+                piece = result.get('response', '')
+                if piece:
+                    if first_token_time is None:
+                        first_token_time = time.time()
+                    parts.append(piece)
+                if result.get('done'):
+                    break
+    except Exception as e:
+        return ModelRun(model, "".join(parts), None, None, time.time() - start_time, None, None, None, str(e))
+
+    total_time = time.time() - start_time
+    eval_count = result.get('eval_count')
+    eval_duration = result.get('eval_duration')  # Nanoseconds
+    tokens_per_second = eval_count / (eval_duration / 1e9) if eval_count and eval_duration else None
+    load_duration = result.get('load_duration')
+    # Ask right away, before Ollama may unload the model to make room for another one
+    memory_bytes, vram_bytes = model_memory(ps_url, model)
+    answer = "".join(parts)
+    if "<think>" in answer:
+        answer = answer.split("</think>")[-1].strip()
+    return ModelRun(
+        model,
+        answer.strip(),
+        first_token_time - start_time if first_token_time is not None else None,
+        tokens_per_second,
+        total_time,
+        load_duration / 1e9 if load_duration else None,
+        memory_bytes,
+        vram_bytes,
+        None
+    )
+
+def compare_models(generate_url, ps_url, models, prompt, concurrent=True, on_result=None):
+    """
+    Run the prompt on every model and return the ModelRuns in the order of models.
+
+    on_result, if given, is called with each ModelRun as soon as it finishes.
+    """
+    runs = {}
+    if concurrent:
+        with ThreadPoolExecutor(max_workers=len(models)) as pool:
+            futures = [pool.submit(run_model, generate_url, ps_url, model, prompt) for model in models]
+            for future in as_completed(futures):
+                run = future.result()
+                runs[run.model] = run
+                if on_result:
+                    on_result(run)
+    else:
+        for model in models:
+            run = run_model(generate_url, ps_url, model, prompt)
+            runs[model] = run
+            if on_result:
+                on_result(run)
+    return [runs[model] for model in models]
+
+def format_bytes(size):
+    if size is None:
+        return "?"
+    return f"{size / 1024 ** 3:.1f} GB" if size >= 1024 ** 3 else f"{size / 1024 ** 2:.0f} MB"
+
+def format_run_stats(run):
+    """One-line summary of a run's measurements"""
+    if run.error:
+        return f"Error: {run.error}"
+    ttft = f"{run.ttft:.2f}s" if run.ttft is not None else "?"
+    speed = f"{run.tokens_per_second:.1f} tok/s" if run.tokens_per_second is not None else "? tok/s"
+    memory = format_bytes(run.memory_bytes)
+    if run.memory_bytes and run.vram_bytes is not None:
+        memory += f" ({run.vram_bytes * 100 // run.memory_bytes}% GPU)"
+    return f"TTFT {ttft} · {speed} · total {run.total_time:.2f}s · {memory}"
+
+def save_comparison(path, prompt, runs, concurrent):
+    """Append one comparison to the results file as a JSON line"""
+    record = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "prompt": prompt,
+        "concurrent": concurrent,
+        "runs": [run._asdict() for run in runs]
+    }
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record) + "\n")
@@ -0,0 +1,127 @@
+"""
+This module contains the Ollama performance profiles and the auto-tuner.
+
+A profile is a named set of Ollama generation `options` (num_ctx, num_thread,
+num_batch, num_predict) sent with every generation. Ollama's defaults are
+chosen for a typical desktop. On many-core CPU-only hosts the thread and
+batch counts matter a lot, so autotune() benchmarks combinations against the
+local model and saves the fastest one as the "tuned" profile.
+"""
+
+import json
+import os
+from datetime import datetime
+
+import requests
+
+# Representative turn used to score settings: a prompt of this many tokens and an answer of that many
+TUNE_PROMPT_TOKENS = 1000
+TUNE_ANSWER_TOKENS = 200
+TUNE_BATCH_SIZES = (128, 256, 512, 1024)
+TUNE_PREDICT_TOKENS = 48  # Tokens generated per trial to measure the generation speed
+
+TUNED_PROFILE = "tuned"
+
+# Options that shape how Ollama loads the model; requests that differ in these force a reload
+LOAD_OPTIONS = ("num_ctx", "num_batch", "num_thread", "num_gpu", "main_gpu", "low_vram", "use_mmap", "use_mlock", "numa")
+
+# ~1000 tokens of filler the model has to read before answering
+_TUNE_TEXT = ("The assistant reads this paragraph to measure how quickly the prompt is processed. "
+              "It contains ordinary sentences about weather, cities, cooking and software. ") * 40
+
+def load_profiles(profiles, tuned_file, model):
+    """Return the configured profiles plus the auto-tuned one, if a tuning run for model was saved"""
+    profiles = dict(profiles)
+    if tuned_file and os.path.exists(tuned_file):
+        try:
+            with open(tuned_file, "r", encoding="utf-8") as f:
+                record = json.load(f)
+            if record.get("model") == model:
+                profiles[TUNED_PROFILE] = record["options"]
+        except (OSError, ValueError, KeyError):
+            pass
+    return profiles
+
+def load_options(options):
+    """The part of a request's options that decides whether the loaded model can serve it"""
+    return {name: options[name] for name in LOAD_OPTIONS if name in options}
+
+def thread_candidates(cpu_count=None):
+    """Thread counts worth trying: a quarter, half, three quarters and all of the logical CPUs"""
+    cpu_count = cpu_count or os.cpu_count() or 4
+    return sorted({max(1, cpu_count * share // 4) for share in (1, 2, 3, 4)})
+
+def _benchmark(generate_url, model, options, trial, timeout):
+    """Run one non-streamed generation with options; returns (prompt tok/s, gen tok/s)"""
+    payload = {
+        "model": model,
+        # A different first line each trial, so Ollama cannot reuse the previous trial's prompt cache
+        "prompt": f"Trial {trial}.\n{_TUNE_TEXT}\nSummarize the paragraph above in one long sentence.",
+        "stream": False,
+        "options": dict(options, num_predict=TUNE_PREDICT_TOKENS, temperature=0, seed=42),
+    }
+    response = requests.post(generate_url, json=payload, timeout=timeout)
+    response.raise_for_status()
+    result = response.json()
+    prompt_rate = result['prompt_eval_count'] / (result['prompt_eval_duration'] / 1e9)
+    eval_rate = result['eval_count'] / (result['eval_duration'] / 1e9)
+    return prompt_rate, eval_rate
+
+def autotune(generate_url, model, num_ctx, cpu_count=None, on_progress=None, timeout=600):
+    """
+    Find the fastest num_thread and num_batch for the model at the given context size.
+
+    Searches one option at a time (threads first, then batch size) instead of the full
+    grid, since every combination forces Ollama to reload the model. Each setting is
+    scored by the estimated time of a representative turn. Returns a dict with the
+    best "options", the estimated turn time and every trial's measurements.
+    """
+    trials = []
+
+    def run(options):
+        trial = len(trials) + 1
+        try:
+            # The first generation after an options change includes the model reload; measure the second
+            _benchmark(generate_url, model, options, f"{trial}-warmup", timeout)
+            prompt_rate, eval_rate = _benchmark(generate_url, model, options, trial, timeout)
+        except Exception as e:
+            trials.append({"options": options, "error": str(e)})
+            if on_progress:
+                on_progress(f"Trial {trial} {options}: failed ({e})")
+            return None
+        turn_time = TUNE_PROMPT_TOKENS / prompt_rate + TUNE_ANSWER_TOKENS / eval_rate
+        trials.append({
+            "options": options,
+            "prompt_tokens_per_second": round(prompt_rate, 1),
+            "tokens_per_second": round(eval_rate, 1),
+            "turn_seconds": round(turn_time, 2),
+        })
+        if on_progress:
+            on_progress(f"Trial {trial} threads={options['num_thread']} batch={options['num_batch']}: "
+                        f"prompt {prompt_rate:.0f} tok/s, generation {eval_rate:.1f} tok/s, turn ~{turn_time:.1f}s")
+        return turn_time
+
+    best_options, best_time = None, float("inf")
+    for threads in thread_candidates(cpu_count):
+        options = {"num_ctx": num_ctx, "num_thread": threads, "num_batch": 512}
+        turn_time = run(options)
+        if turn_time is not None and turn_time < best_time:
+            best_options, best_time = options, turn_time
+    if best_options is None:
+        raise RuntimeError("every benchmark trial failed; is Ollama running and the model pulled?")
+    for batch in TUNE_BATCH_SIZES:
+        if batch == best_options["num_batch"]:
+            continue
+        options = dict(best_options, num_batch=batch)
+        turn_time = run(options)
+        if turn_time is not None and turn_time < best_time:
+            best_options, best_time = options, turn_time
+    return {"options": best_options, "turn_seconds": round(best_time, 2), "trials": trials}
+
+def save_tuned_profile(path, model, result):
+    """Save an autotune() result; load_profiles() then offers it as the "tuned" profile"""
+    record = dict(result, model=model, timestamp=datetime.now().isoformat(timespec="seconds"))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, path)
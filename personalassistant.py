@@ -7,77 +7,177 @@ import time
 import sys
 import json
 import os
+import itertools
+import logging
+import multiprocessing
 import urllib.parse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from assistant_log import recent_logs, setup_logging
+from backend_http import CancelEvent, Deadline, LatencyTracker, hedged_get, make_abortable
+from doc_index import DocumentIndex
+from geocoder import Geocoder
+from idle_jobs import IdleScheduler
+from markdown_render import MarkdownStreamRenderer, configure_markdown_tags
+import memory_store
+from model_compare import ModelRun, compare_models, format_run_stats, save_comparison
+from ollama_profiles import TUNED_PROFILE, autotune, load_options, load_profiles, save_tuned_profile
+from query_pipeline import Pipeline, QueryContext, QueryFinished, Stage, StageCache, format_timings
+from query_profiler import QueryProfiler
+from semantic_cache import SemanticCache
+from turn_template import STOP_SEQUENCES, TurnStopFilter, classify_query, history_without_question, question_turn
+from search_compress import compress_search_results, estimate_tokens, format_search_results
+from search_quota import SearchQuota, SearchQuotaExceeded, SearchResultCache, format_age
+from search_router import ROUTER_PROMPT, RouteDecision, parse_router_answer, route_query
+from session_trace import RecordingAdapter, TraceRecorder
 
 # --- Configuration ---
 OLLAMA_MODEL = "llama3.1" #Example model
 OLLAMA_URL = "http://localhost:11434/api/generate"
-DEBUG_MODE = True
 SYSTEM_PROMPT = (
     "You are an AI assistant designed to help users with a wide range of tasks. "
 )
 
+# Ollama performance profiles: generation options sent with every query (switch with !perf <name>)
+OLLAMA_PROFILES = {
+    "snappy": {"num_ctx": 2048, "num_batch": 512, "num_predict": 256},
+    "balanced": {"num_ctx": 4096, "num_batch": 512, "num_predict": 768},
+    "long-context": {"num_ctx": 16384, "num_batch": 256, "num_predict": 1536},
+}
+OLLAMA_PROFILE = "balanced"  # Profile used at startup; "tuned" uses the result of !tune
+OLLAMA_TUNED_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ollama_tuned.json")
+OLLAMA_TUNE_CONTEXT = 4096   # Context size (num_ctx) the auto-tuner must keep
+# Output token caps by kind of question (see turn_template.classify_query); None keeps the profile's num_predict
+ANSWER_TOKEN_CAPS = {"chat": 128, "short": 384, "explain": 768, "long": None}
+
 # Weather API Configuration (Tomorrow.io)
 TOMORROW_API_KEY = "your_api_key_here"  # Add your Tomorrow.io API key here
 TOMORROW_URL = "https://api.tomorrow.io/v4/weather/realtime"
 DEFAULT_LOCATION = {"lat": 0, "lon": 0}  # Default coordinates, configure in your local setup
 DEFAULT_CITY = "Your City"  # Configure your city name in your local setup
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gazetteer.tsv")  # Offline city index for !weather <city>
+GEOCODE_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "geocode_cache.json")
 
 # Google Search API Configuration
 GOOGLE_SEARCH_API_KEY = "your_api_key_here"  # Add your Google API key here
 # The Search Engine ID must be the cx value from your Google Custom Search Engine
 GOOGLE_SEARCH_ENGINE_ID = "your_search_engine_id_here"  # Add your Google Search Engine ID here
 GOOGLE_SEARCH_URL = "https://www.googleapis.com/customsearch/v1"
+SEARCH_COMPRESSION_ENABLED = True  # Rerank and trim search snippets before prompting
+SEARCH_CONTEXT_TOKENS = 350        # Approximate token budget for search results in the prompt
+SEARCH_DAILY_QUOTA = 100           # Custom Search queries per day (100 on the free tier)
+SEARCH_RATE_PER_MINUTE = 60        # Sustained search rate allowed by the rate limiter
+SEARCH_RATE_BURST = 5              # Searches allowed back to back before the rate limiter queues them
+SEARCH_QUEUE_TIMEOUT = 10          # Max seconds a search waits in the rate limiter queue before falling back
+SEARCH_QUOTA_RESERVE = 10          # With this few queries left, similar cached results are used instead of searching
+SEARCH_QUOTA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_quota.json")
+SEARCH_RESULT_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_results_cache.json")
+SEARCH_RESULT_CACHE_MAX_AGE = 60 * 60  # Seconds cached results are reused for the same question
+SEARCH_RESULT_CACHE_SIZE = 500
+SEARCH_ROUTER_MODEL_CHECK = False  # In Auto mode, ask the model when the wording doesn't settle whether to search;
+                                   # costs a short generation and replaces a prompt prefilled while typing
+SEARCH_ROUTER_UNSURE_SEARCH = True # In Auto mode, search when neither the wording nor the model settles it
+SEARCH_ROUTER_TIMEOUT = 5          # Max seconds for the Auto mode model check
+
+# Semantic answer cache for web search mode (requires numpy and an Ollama embedding model)
+SEMANTIC_CACHE_ENABLED = True
+OLLAMA_EMBED_URL = "http://localhost:11434/api/embeddings"
+OLLAMA_EMBED_MODEL = "nomic-embed-text"  # Pull with: ollama pull nomic-embed-text
+SEMANTIC_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.92         # Minimum cosine similarity to reuse an answer
+SEMANTIC_CACHE_MAX_AGE = 24 * 60 * 60   # Seconds a cached answer stays fresh
+SEMANTIC_CACHE_CAPACITY = 100000        # Maximum cached answers before the oldest are overwritten
+
+# Local documents (Docs mode)
+DOCS_FOLDER = ""  # Folder of notes, markdown or code to answer from in Docs mode; leave empty to disable
+DOCS_INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "docs_index.pkl")
+DOCS_EXTENSIONS = (".txt", ".md", ".rst", ".py", ".js", ".ts", ".java", ".c", ".cpp", ".h", ".go", ".rs",
+                   ".json", ".yaml", ".yml", ".toml", ".csv", ".html")
+DOCS_PASSAGE_CHARS = 800      # Approximate passage size the documents are split into
+DOCS_TOP_K = 4                # Passages included in the prompt
+DOCS_INDEX_WORKERS = 4        # Threads reading and tokenizing changed files
+DOCS_REFRESH_INTERVAL = 60    # Seconds before a Docs query triggers a background re-scan of the folder
+
+# Model comparison (!compare <prompt>)
+COMPARE_MODELS = ["llama3.1", "mistral", "phi3"]  # Local models to run the same prompt on
+COMPARE_CONCURRENT = False  # Run all models at once; only fair if OLLAMA_MAX_LOADED_MODELS lets Ollama keep them all loaded
+COMPARE_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "compare_results.jsonl")
+OLLAMA_PS_URL = "http://localhost:11434/api/ps"
+
+# Logging (see assistant_log.py); messages below LOG_LEVEL are dropped before they are formatted
+LOG_LEVEL = "INFO"       # DEBUG shows per-query timings, prompt sizes and backend details
+LOG_BUFFER_LINES = 2000  # Recent log lines kept in memory for !logs
+LOG_FILE = ""            # Also write the log to this file (on a background thread); leave empty for console only
+LOG_MAX_CHARS = 2000     # Longer log messages are cut; API keys are always masked
 
-# Test the Google Search API on startup
+log = logging.getLogger("assistant")
+
+def configure_logging(process_name=None):
+    """Set up logging from the LOG_* settings; a worker process writes to its own log file"""
+    log_file = LOG_FILE or None
+    if log_file and process_name:
+        base, ext = os.path.splitext(log_file)
+        log_file = f"{base}.{process_name}{ext}"
+    setup_logging(LOG_LEVEL, LOG_BUFFER_LINES, log_file, LOG_MAX_CHARS,
+                  secrets=(GOOGLE_SEARCH_API_KEY.strip(), TOMORROW_API_KEY.strip()))
+
+# Check the Google Search API configuration on startup
 def test_google_search_api():
-    if DEBUG_MODE:
-        print("Testing Google Search API connection...", flush=True)
-    try:
-        params = {
-            'key': GOOGLE_SEARCH_API_KEY.strip(),
-            'cx': GOOGLE_SEARCH_ENGINE_ID.strip(),
-            'q': 'test query',
-            'num': 1
-        }
-        response = requests.get(GOOGLE_SEARCH_URL, params=params)
-        if DEBUG_MODE:
-            print(f"API Test Status Code: {response.status_code}", flush=True)
-        
-        if response.status_code == 200:
-            result = response.json()
-            if 'items' in result:
-                if DEBUG_MODE:
-                    print("Google Search API test successful - results returned", flush=True)
-                return True
-            else:
-                if DEBUG_MODE:
-                    print("Google Search API test - no items in response", flush=True)
-                    print(f"Response keys: {list(result.keys())}", flush=True)
-                    if 'error' in result:
-                        print(f"Error: {result['error']}", flush=True)
-                return False
-        else:
-            if DEBUG_MODE:
-                print(f"Google Search API test failed with status code: {response.status_code}", flush=True)
-            return False
-    except Exception as e:
-        if DEBUG_MODE:
-            print(f"Google Search API test error: {e}", flush=True)
+    """Check that Google Search is configured; no query is sent, since every query spends daily quota"""
+    placeholders = ("", "your_api_key_here", "your_search_engine_id_here")
+    if GOOGLE_SEARCH_API_KEY.strip() in placeholders or GOOGLE_SEARCH_ENGINE_ID.strip() in placeholders:
+        log.debug("Google Search API key or Search Engine ID is not configured")
         return False
+    log.debug("Google Search API is configured")
+    return True
+
+# Query engine
+ENGINE_OUT_OF_PROCESS = False  # Run LLM, search, weather and memory work in a separate worker process
+ENGINE_RESTART_WINDOW = 10     # Seconds; a worker dying sooner than this after start is restarted with backoff
+ENGINE_SHUTDOWN_TIMEOUT = 5    # Seconds to wait for pending work such as memory saves on exit
+QUERY_DEADLINE = 120           # Seconds a whole query (embedding, search and generation) may take
+BACKEND_TIMEOUT = 10           # Max seconds for a single Google, Tomorrow.io or embedding request
+BACKEND_RETRIES = 2            # Retries of failed Google/Tomorrow.io GETs, with jittered exponential backoff
+HEDGE_ENABLED = True           # Send a duplicate GET when the first is slower than the backend's p95 latency
+HEDGE_DEFAULT_DELAY = 1.0      # Seconds before hedging until enough latencies have been observed
+PROFILE_REPORT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles")  # !profile reports
+PROFILE_DEFAULT_QUERIES = 5    # Queries profiled by !profile when no count is given
+TRACE_ENABLED = False          # Record a session trace from startup (or use !trace on / !trace off)
+TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")  # Replay with replay_trace.py
+PIPELINE_WORKERS = 4           # Threads running the independent stages of queries in parallel
+PIPELINE_CACHE_SIZE = 256      # Stage results (compressed search results, docs passages) kept for reuse
+PREFILL_ENABLED = True         # Have Ollama evaluate the system prompt and history while the question is typed
+PREFILL_DEBOUNCE_MS = 400      # Typing pause before the prompt prefix is sent
+PREFILL_MIN_CHARS = 3          # Characters typed before prefilling is worth it
+PREFILL_KEEP_ALIVE = 600       # Seconds Ollama keeps the model (and its prompt cache) loaded after a prefill
+SPECULATIVE_DRAFT = True       # In Web and Auto mode, stream a local model draft while the search runs
+SPECULATIVE_MAX_LOAD = 0.75    # Skip the draft when the 1-minute load average per CPU is above this
+IDLE_JOBS_ENABLED = True       # Re-scan the docs folder and compact memory and caches while the user is away
+IDLE_AFTER = 120               # Seconds without typing after which the user counts as away while the window is shown
+IDLE_MAX_LOAD = 0.5            # Don't start a maintenance job while the 1-minute load average per CPU is above this
+IDLE_POLL_INTERVAL = 5         # Seconds between checks for due maintenance jobs
+IDLE_MEMORY_COMPACT_INTERVAL = 60  # Seconds between checks for memory saves whose near duplicates are not yet compacted
+IDLE_CACHE_COMPACT_INTERVAL = 600  # Seconds between rewrites of the semantic cache log
+IDLE_INPUT_REPORT_INTERVAL = 10    # The window tells the engine about typing at most this often
 
 # Assistant Modes
 MODE_LLM = "llm"  # Default mode using local LLM
 MODE_WEB_SEARCH = "web_search"  # Web search mode using Google API
+MODE_DOCS = "docs"  # Answer from the local documents in DOCS_FOLDER
+MODE_AUTO = "auto"  # Search the web only for questions that need it (see search_router.py)
 
 # Memory Configuration
 MEMORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversation_memory.json")
-MEMORY_MAX_CONVERSATIONS = 5   # Maximum number of conversations to store
+MEMORY_MAX_CONVERSATIONS = 50  # Maximum number of conversations to store
+MEMORY_MAX_CHARS = 50000       # Stored characters (repeated messages counted once) the kept conversations may use
 MEMORY_MAX_MESSAGES = 20       # Maximum messages per conversation
 CONTEXT_WINDOW = 10            # Number of previous messages to include in context
 MIN_MESSAGE_LENGTH = 10        # Minimum length for a message to be stored in memory
 MAX_MEMORY_SAVE_INTERVAL = 5   # Save memory every N messages to reduce writes
+MEMORY_DEDUP_THRESHOLD = 0.7   # Estimated similarity at which a message is stored as a patch of an earlier one (see memory_store.py)
+HISTORY_MAX_MESSAGES = 200     # In-memory history ring buffer size; older messages are dropped
+MAX_CHAT_SESSIONS = 8          # Chat tabs open at once (Ctrl+T opens one, Ctrl+W closes one)
 
 # Window Dimensions
 INITIAL_HEIGHT = 500
@@ -111,6 +211,1481 @@ LIGHT_THEME = {
 CURRENT_THEME = DARK_THEME
 TRANSPARENCY = 0.85
 
+class HistoryMessage:
+    """A single chat message with its prompt line rendered once at append time"""
+    __slots__ = ("role", "content", "line", "timestamp")
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+        self.line = f"{'User' if role == 'user' else 'Assistant'}: {content}"
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {"role": self.role, "content": self.content}
+
+class ConversationHistory:
+    """Bounded ring buffer of HistoryMessage records.
+
+    Keeps memory flat in long-running sessions: once HISTORY_MAX_MESSAGES is
+    reached the oldest message is dropped on every append. Prompt building is
+    a join over the already rendered lines of the last N messages.
+    """
+    def __init__(self, max_messages=HISTORY_MAX_MESSAGES):
+        self._messages = deque(maxlen=max_messages)
+
+    def append(self, role, content):
+        message = HistoryMessage(role, content)
+        self._messages.append(message)
+        return message
+
+    def clear(self):
+        self._messages.clear()
+
+    def recent(self, count):
+        """Return the last `count` messages, oldest first"""
+        if count <= 0:
+            return []
+        # Walk from the newest end so the cost depends on count, not buffer size
+        recent = list(itertools.islice(reversed(self._messages), count))
+        recent.reverse()
+        return recent
+
+    def prompt_lines(self, count=CONTEXT_WINDOW):
+        """Return the pre-rendered prompt lines of the last `count` messages"""
+        return [msg.line for msg in self.recent(count)]
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __bool__(self):
+        return bool(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+class ThinkFilter:
+    """Hide a leading <think>...</think> block from a streamed response"""
+    def __init__(self):
+        self._state = "undecided"  # undecided -> thinking -> visible
+        self._buffer = ""
+
+    def feed(self, piece):
+        """Return the part of piece that should be displayed"""
+        if self._state == "visible":
+            return piece
+        self._buffer += piece
+        if self._state == "undecided":
+            head = self._buffer.lstrip()
+            if "<think>".startswith(head):
+                return ""  # Not enough text yet to decide
+            if not head.startswith("<think>"):
+                self._state = "visible"
+                return self._buffer
+            self._state = "thinking"
+        # Only the tail can contain a newly completed closing tag
+        if "</think>" in self._buffer[-(len(piece) + len("</think>")):]:
+            self._state = "visible"
+            return self._buffer.split("</think>", 1)[1].lstrip()
+        return ""
+
+class QueryEngine:
+    """
+    Runs queries against the backends (Ollama, Google search, Tomorrow.io) and
+    owns the memory file, without touching any Tk widgets.
+    
+    Results are reported through emit(kind, request_id, text), where kind is
+    "chunk" for streamed answer text, "draft" for the text of a speculative
+    answer that a later "chunk" stream replaces, or one of "answer", "system"
+    and "error", which finish a request. The engine runs either on threads inside the UI
+    process (LocalEngineClient) or in a worker process (EngineProcessClient).
+    
+    All backend HTTP traffic goes through self.http, so a session trace can
+    record it (RecordingAdapter) and replay_trace.py can serve it back.
+    
+    Queries run through the staged pipeline of their mode (build_pipelines),
+    which times every stage and caches stage results in self.stage_cache.
+    """
+    EMPTY_ANSWERS = {
+        MODE_WEB_SEARCH: "Sorry, I could not generate a response based on the search results.",
+        MODE_DOCS: "Sorry, I could not generate a response based on your documents.",
+    }
+
+    def __init__(self, emit):
+        self._emit = emit
+        self.tracer = None
+        self.memory_lock = threading.Lock()  # Memory saves can arrive from several threads
+        self.memory_generation = 0  # Bumped by every save and wipe, so a compaction of an older file is dropped
+        self.memory_compacted = False  # Whether near duplicates in the memory file are stored once
+        self.http = requests.Session()  # Keeps connections to the backends alive between queries
+        self.mount_http(requests.adapters.HTTPAdapter())
+        self.geocoder = None
+        try:
+            self.geocoder = Geocoder(GAZETTEER_FILE, GEOCODE_CACHE_FILE)
+        except Exception as e:
+            log.warning("Error loading gazetteer, !weather <city> is disabled: %s", e)
+        self.semantic_cache = None
+        if SEMANTIC_CACHE_ENABLED:
+            self.semantic_cache = SemanticCache(
+                SEMANTIC_CACHE_DIR,
+                OLLAMA_EMBED_URL,
+                OLLAMA_EMBED_MODEL,
+                threshold=SEMANTIC_CACHE_THRESHOLD,
+                max_age=SEMANTIC_CACHE_MAX_AGE,
+                capacity=SEMANTIC_CACHE_CAPACITY,
+                session=self.http
+            )
+        self.doc_index = None
+        if DOCS_FOLDER:
+            if os.path.isdir(DOCS_FOLDER):
+                self.doc_index = DocumentIndex(
+                    DOCS_FOLDER,
+                    DOCS_INDEX_FILE,
+                    DOCS_EXTENSIONS,
+                    passage_chars=DOCS_PASSAGE_CHARS,
+                    workers=DOCS_INDEX_WORKERS
+                )
+                self.refresh_doc_index()
+            else:
+                log.warning("Docs folder not found, Docs mode is disabled: %s", DOCS_FOLDER)
+        self.search_quota = SearchQuota(
+            SEARCH_QUOTA_FILE,
+            daily_limit=SEARCH_DAILY_QUOTA,
+            per_minute=SEARCH_RATE_PER_MINUTE,
+            burst=SEARCH_RATE_BURST,
+            reserve=SEARCH_QUOTA_RESERVE
+        )
+        self.search_results = SearchResultCache(SEARCH_RESULT_CACHE_FILE, SEARCH_RESULT_CACHE_SIZE)
+        self.search_configured = test_google_search_api()
+        self.search_latency = LatencyTracker(default=HEDGE_DEFAULT_DELAY)
+        self.weather_latency = LatencyTracker(default=HEDGE_DEFAULT_DELAY)
+        self.profiles = load_profiles(OLLAMA_PROFILES, OLLAMA_TUNED_FILE, OLLAMA_MODEL)
+        self.profiler = QueryProfiler(
+            PROFILE_REPORT_DIR,
+            on_report=lambda path: self.emit("system", None, f"📊 Profile report written to {path}")
+        )
+        # Stage work of a profiled query is profiled on the pool threads too
+        self.stage_pool = self.profiler.wrap_executor(
+            ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="stage"))
+        self.stage_cache = StageCache(PIPELINE_CACHE_SIZE)
+        self.stats_lock = threading.Lock()  # Guards the prefill state and the prefill and generation counters
+        self.prefill = None  # The last prompt prefix Ollama evaluated ahead of a query
+        self.prefill_stats = {"turns": 0, "prefilled": 0, "tokens": 0, "seconds": 0.0}
+        self.generation_stats = {"turns": 0, "tokens": 0, "capped": 0, "cap_stops": 0, "cap_saved": 0,
+                                 "turn_stops": 0, "turn_saved": 0}
+        self.generating = 0  # Answers and drafts being streamed from Ollama right now
+        self.pipelines = self.build_pipelines()
+        self.report_search_quota()
+        if TRACE_ENABLED:
+            self.start_trace()
+        self.load_memory()
+        self.idle_jobs = None
+        if IDLE_JOBS_ENABLED:
+            self.idle_jobs = IdleScheduler(IDLE_AFTER, IDLE_MAX_LOAD, IDLE_POLL_INTERVAL)
+            self.register_idle_jobs()
+            self.idle_jobs.start()
+
+    def emit(self, kind, request_id, text):
+        """Send an event to the UI, recording it when a session trace is running"""
+        if self.tracer is not None:
+            if kind in ("chunk", "draft"):
+                self.tracer.record("event", event=kind, id=request_id, length=len(text))
+            else:
+                self.tracer.record("event", event=kind, id=request_id, text=text)
+        self._emit(kind, request_id, text)
+
+    def start_trace(self):
+        """Start recording requests, events and backend traffic to a new trace file"""
+        if self.tracer is not None:
+            return self.tracer.path
+        os.makedirs(TRACE_DIR, exist_ok=True)
+        path = os.path.join(TRACE_DIR, f"session_{datetime.now():%Y%m%d_%H%M%S}.jsonl.gz")
+        self.tracer = TraceRecorder(path, model=OLLAMA_MODEL, profile=OLLAMA_PROFILE)
+        self.mount_http(RecordingAdapter(self.tracer))
+        log.info("Recording session trace to %s", path)
+        return path
+
+    def stop_trace(self):
+        """Stop recording and close the trace file; returns its path"""
+        tracer, self.tracer = self.tracer, None
+        if tracer is None:
+            return None
+        self.mount_http(requests.adapters.HTTPAdapter())
+        tracer.close()
+        return tracer.path
+
+    def mount_http(self, adapter):
+        """Send every backend request through adapter; a draft's CancelEvent can abort them (see backend_http.py)"""
+        make_abortable(adapter)
+        self.http.mount("http://", adapter)
+        self.http.mount("https://", adapter)
+
+    # Requests the user is waiting on; maintenance jobs pause while one runs
+    INTERACTIVE_REQUESTS = ("query", "weather", "prefill", "compare", "tune")
+
+    def handle(self, request):
+        """Handle a request dict sent by the UI, pausing idle-time jobs while the user waits on it"""
+        if self.idle_jobs is not None and request['type'] in self.INTERACTIVE_REQUESTS:
+            with self.idle_jobs.interactive():
+                self.dispatch(request)
+        else:
+            self.dispatch(request)
+
+    def dispatch(self, request):
+        """Dispatch a request dict sent by the UI"""
+        kind = request['type']
+        if self.tracer is not None and kind in ("query", "weather", "prefill"):
+            self.tracer.record("request", request=request)
+        if kind == "query":
+            if self.profiler.active:
+                self.profiler.run(f"[{request['mode']}] {request['prompt'][:60]}", self.process_query, request)
+            else:
+                self.process_query(request)
+        elif kind == "prefill":
+            self.prefill_prompt(request)
+        elif kind == "prefill_status":
+            self.report_prefill(request)
+        elif kind == "token_status":
+            self.report_generation(request)
+        elif kind == "logs":
+            self.report_logs(request)
+        elif kind == "trace":
+            if request['enable']:
+                self.emit("system", request['id'], f"Recording session trace to {self.start_trace()}")
+            else:
+                path = self.stop_trace()
+                self.emit("system", request['id'], f"Session trace saved to {path}" if path else "No session trace is being recorded.")
+        elif kind == "profile":
+            if self.profiler.start(request['queries']):
+                self.emit("system", request['id'], f"Profiling the next {request['queries']} queries...")
+            else:
+                self.emit("system", request['id'], "A profiling run is already in progress.")
+        elif kind == "weather":
+            self.handle_weather_command(request)
+        elif kind == "save_memory":
+            self.save_memory(request['conversation_id'], request['messages'], request['important'])
+        elif kind == "wipe_memory":
+            self.wipe_memory()
+        elif kind == "docs_status":
+            self.report_doc_index(request)
+        elif kind == "ui_state":
+            if self.idle_jobs is not None:
+                self.idle_jobs.set_ui_state(request.get('hidden'), request.get('active_at'))
+        elif kind == "compare":
+            self.compare_models(request)
+        elif kind == "tune":
+            self.tune_ollama(request)
+        else:
+            log.warning("Unknown engine request type: %s", kind)
+
+    def request_deadline(self, request):
+        """The Deadline a request must finish by; the UI stamps it when the user presses Enter"""
+        if request.get('deadline'):
+            return Deadline(request['deadline'], QUERY_DEADLINE)
+        return Deadline.after(QUERY_DEADLINE)
+
+    def ollama_options(self, request):
+        """Generation options of the performance profile the request was sent with"""
+        profile = request.get('profile', OLLAMA_PROFILE)
+        options = self.profiles.get(profile)
+        if options is None:
+            log.warning("Unknown performance profile '%s', using Ollama defaults", profile)
+            return {}
+        return dict(options)
+
+    def get_weather_condition(self, cloud_cover):
+        """Convert cloud cover percentage to weather condition description"""
+        if cloud_cover < 10:
+            return "Clear sky"
+        elif cloud_cover < 30:
+            return "Mostly clear"
+        elif cloud_cover < 70:
+            return "Partly cloudy"
+        elif cloud_cover < 90:
+            return "Mostly cloudy"
+        else:
+            return "Overcast"
+
+    def perform_web_search(self, query):
+        """Perform a Google search using the Google Custom Search JSON API"""
+        try:
+            items, error_msg = self.search_web(query)
+        except SearchQuotaExceeded as e:
+            return f"Error performing web search: {e}"
+        if error_msg:
+            return error_msg
+        return format_search_results(items)
+
+    def report_search_quota(self):
+        """Tell the UI how many searches are left today"""
+        self.emit("quota", None, {"remaining": self.search_quota.remaining(), "limit": SEARCH_DAILY_QUOTA})
+
+    def search_web(self, query, deadline=None):
+        """
+        Run a Google Custom Search query and return (items, error_message).
+        
+        Raises SearchQuotaExceeded if the daily quota or the rate limit does not allow the query.
+        """
+        deadline = deadline or Deadline.after(QUERY_DEADLINE)
+        if not GOOGLE_SEARCH_API_KEY or not GOOGLE_SEARCH_ENGINE_ID:
+            return None, "Error: Google Search API key or Search Engine ID is not configured. Please add your API credentials to the configuration."
+        
+        refusal = self.search_quota.acquire(SEARCH_QUEUE_TIMEOUT)
+        if refusal:
+            raise SearchQuotaExceeded(refusal)
+        try:
+            # Prepare the search parameters
+            params = {
+                'key': GOOGLE_SEARCH_API_KEY.strip(),
+                'cx': GOOGLE_SEARCH_ENGINE_ID.strip(),
+                'q': query,
+                'num': 5  # Number of search results to return
+            }
+            
+            search_url = GOOGLE_SEARCH_URL
+            
+            log.debug("Google search request to %s: cx=%s, query=%s", search_url, params['cx'], params['q'])
+            
+            # Make the API request; hedges and retries are only sent if they fit in the quota, and
+            # every request that could not connect gets its quota back, even a hedge failing later
+            response = hedged_get(
+                self.http,
+                search_url,
+                deadline,
+                self.search_latency,
+                timeout_cap=BACKEND_TIMEOUT,
+                retries=BACKEND_RETRIES,
+                hedge=HEDGE_ENABLED,
+                admit=lambda: self.search_quota.acquire(max_wait=0) is None,
+                on_unsent=self.refund_unsent_search,
+                params=params
+            )
+            
+            log.debug("Search response status code: %s", response.status_code)
+            
+            # Google answers 429 (or 403 dailyLimitExceeded) once the quota or rate limit is hit
+            if response.status_code in (403, 429):
+                message = response.text.lower()
+                if response.status_code == 429 or "dailylimitexceeded" in message or "ratelimitexceeded" in message:
+                    daily = "per day" in message or "dailylimit" in message
+                    self.search_quota.report_rate_limited(daily)
+                    raise SearchQuotaExceeded("the daily search quota is used up" if daily else "the search rate limit was reached")
+            
+            response.raise_for_status()
+            search_results = response.json()
+            
+            if 'error' in search_results:
+                log.warning("Google Search API error response: %s", search_results['error'])
+            
+            if 'items' not in search_results:
+                error_msg = "No results found for your query."
+                if 'error' in search_results:
+                    error_msg += f" Error: {search_results['error'].get('message', '')}"
+                elif 'searchInformation' in search_results:
+                    total_results = search_results['searchInformation'].get('totalResults', '0')
+                    error_msg += f" Total results: {total_results}"
+                return None, error_msg
+            
+            return search_results['items'], None
+        
+        except SearchQuotaExceeded:
+            raise
+        except Exception as e:
+            log.warning("Google Search API error: %s", e, exc_info=True)
+            return None, f"Error performing web search: {str(e)}"
+        finally:
+            self.report_search_quota()
+
+    def refund_unsent_search(self, error):
+        """Give back the quota of a search request that never reached Google"""
+        log.debug("Refunding a search request that could not connect: %s", error)
+        self.search_quota.refund()
+        self.report_search_quota()
+
+    def stream_llm_response(self, request_id, payload, deadline=None, kind="chunk", cancel=None):
+        """
+        Stream a generation from Ollama, emitting the visible text as `kind` events.
+        
+        Returns (answer_text, final_result) where final_result is the last streamed
+        object, which carries Ollama's timing and token counts. If the model starts
+        writing another turn, the request is closed, which makes Ollama stop
+        generating, and final_result has done_reason "turn". Setting the cancel
+        CancelEvent closes it from the cancelling thread, even while Ollama is
+        still evaluating the prompt, and final_result has done_reason
+        "cancelled". Raises DeadlineExceeded if the deadline passes before the
+        answer is complete.
+        """
+        if cancel is None:
+            return self._stream_llm_response(request_id, payload, deadline, kind, cancel)
+        with cancel.sending():
+            try:
+                return self._stream_llm_response(request_id, payload, deadline, kind, cancel)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if not cancel.is_set():
+                    raise
+                return "", {"done": True, "done_reason": "cancelled", "eval_count": 0}
+
+    def _stream_llm_response(self, request_id, payload, deadline, kind, cancel):
+        deadline = deadline or Deadline.after(QUERY_DEADLINE)
+        # The read timeout bounds the wait for each streamed line, the deadline check the whole answer
+        response = self.http.post(OLLAMA_URL, json=dict(payload, stream=True), stream=True,
+                                 timeout=(deadline.timeout(BACKEND_TIMEOUT), deadline.timeout()))
+        if cancel is not None:
+            cancel.attach(response)
+        response.raise_for_status()
+        think_filter = ThinkFilter()
+        turn_filter = TurnStopFilter()
+        parts = []
+        tokens = 0  # Ollama streams one token per line
+        result = {}
+        with self.stats_lock:
+            self.generating += 1
+        try:
+            for line in response.iter_lines():
+                if cancel is not None and cancel.is_set():
+                    result = dict(result, done=True, done_reason="cancelled", eval_count=tokens)
+                    break
+                if not line:
+                    continue
+                result = json.loads(line)
+                if 'error' in result:
+                    raise RuntimeError(result['error'])
+                piece = result.get('response', '')
+                if piece:
+                    tokens += 1
+                    visible = turn_filter.feed(think_filter.feed(piece))
+                    if visible:
+                        parts.append(visible)
+                        self.emit(kind, request_id, visible)
+                    if turn_filter.stopped:
+                        result = dict(result, done=True, done_reason="turn", eval_count=tokens)
+                        break
+                if result.get('done'):
+                    break
+                deadline.check()
+        finally:
+            response.close()
+            with self.stats_lock:
+                self.generating -= 1
+        rest = turn_filter.flush()
+        if rest and result.get('done_reason') != "cancelled":
+            parts.append(rest)
+            self.emit(kind, request_id, rest)
+        return "".join(parts), result
+
+    def build_pipelines(self):
+        """The stages each mode's queries run through"""
+        answer_stages = [
+            Stage("generate", self.generate_answer, needs=("prompt",)),
+            Stage("post_process", self.post_process_answer, needs=("generate",)),
+            Stage("render", self.render_answer, needs=("post_process",)),
+        ]
+        web_stages = [
+            # Search waits for the answer cache, so a cached answer never spends search quota
+            Stage("retrieve", self.retrieve_cached_answer),
+            Stage("search", self.search_stage, needs=("retrieve",)),
+            # Streams a local model answer while the search runs
+            Stage("draft", self.draft_stage, needs=("retrieve",)),
+            Stage("compress", self.compress_stage, needs=("search",),
+                  cache_key=self.search_items_key, ttl=SEARCH_RESULT_CACHE_MAX_AGE),
+            Stage("prompt", self.build_search_prompt, needs=("compress",)),
+            # Only waits for the draft when there is nothing to ground (see generate_search_answer)
+            answer_stages[0]._replace(run=self.generate_search_answer),
+        ] + answer_stages[1:] + [
+            # Runs alongside render, so storing the answer does not delay showing it
+            Stage("remember", self.remember_answer, needs=("post_process",)),
+        ]
+        return {
+            MODE_LLM: Pipeline("llm", [
+                Stage("prompt", self.build_llm_prompt),
+            ] + answer_stages),
+            MODE_WEB_SEARCH: Pipeline("web", web_stages, error_message="Error processing web search results"),
+            # The web stages, skipped down to a plain prompt when the route says the model can answer alone
+            MODE_AUTO: Pipeline("auto", [
+                Stage("route", self.route_stage),
+                web_stages[0]._replace(needs=("route",)),
+            ] + web_stages[1:], error_message="Error processing web search results"),
+            MODE_DOCS: Pipeline("docs", [
+                Stage("retrieve", self.retrieve_passages,
+                      cache_key=lambda context: (context.request['prompt'], self.doc_index.last_refresh)
+                      if self.doc_index is not None else None, ttl=DOCS_REFRESH_INTERVAL),
+                Stage("prompt", self.build_docs_prompt, needs=("retrieve",)),
+            ] + answer_stages, error_message="Error answering from documents"),
+        }
+
+    def process_query(self, request):
+        """Run a query through the pipeline of the mode it was sent in"""
+        request_id = request['id']
+        pipeline = self.pipelines.get(request['mode'], self.pipelines[MODE_LLM])
+        context = QueryContext(request, self.request_deadline(request))
+        try:
+            pipeline.run(context, self.stage_pool, self.stage_cache)
+        except QueryFinished as e:
+            self.emit(e.kind, request_id, e.text)
+        except requests.exceptions.ConnectionError as e:
+            log.error("LLM API connection error: %s", e)
+            self.emit("error", request_id, "Error: Could not connect to Ollama server. Is it running at http://localhost:11434?")
+        except requests.exceptions.HTTPError as e:
+            log.error("LLM API HTTP error: %s", e)
+            self.emit("error", request_id, f"Error: HTTP error from Ollama server: {str(e)}")
+        except Exception as e:
+            log.error("%s pipeline error: %s", pipeline.name, e, exc_info=True)
+            self.emit("error", request_id, f"{pipeline.error_message}: {str(e)}")
+        finally:
+            context.signal("draft_cancel", CancelEvent).set()  # A draft still streaming is no longer needed
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("[%s] %s; total %.3fs", pipeline.name, format_timings(context), time.time() - request['started_at'])
+            if self.tracer is not None:
+                self.tracer.record("stages", id=request_id, pipeline=pipeline.name,
+                                   timings={name: round(seconds, 4) for name, seconds in context.timings.items()},
+                                   cached=sorted(context.cached), stats=context.stats)
+
+    def route_stage(self, context):
+        """Decide whether an Auto mode question needs a web search; returns a RouteDecision"""
+        prompt = context.request['prompt']
+        if not self.search_configured:
+            decision = RouteDecision(False, "web search is not configured")
+        else:
+            decision = route_query(prompt)
+            if decision.search is None and SEARCH_ROUTER_MODEL_CHECK:
+                decision = self.ask_router_model(context)
+            if decision.search is None:
+                decision = RouteDecision(SEARCH_ROUTER_UNSURE_SEARCH, decision.reason)
+        context.stats.update(route="search" if decision.search else "local", route_reason=decision.reason)
+        log.info("Auto mode %s for '%.60s' (%s)", "searches the web" if decision.search else "answers locally",
+                 prompt, decision.reason)
+        return decision
+
+    def ask_router_model(self, context):
+        """Ask the model whether the question needs a search; the answer is a word or two"""
+        # Only the load options are kept, so the check never makes Ollama reload the model
+        options = load_options(self.ollama_options(context.request))
+        try:
+            response = self.http.post(OLLAMA_URL, json={
+                "model": OLLAMA_MODEL,
+                "prompt": ROUTER_PROMPT.format(question=context.request['prompt']),
+                "stream": False,
+                "options": dict(options, num_predict=3, temperature=0)
+            }, timeout=context.deadline.timeout(SEARCH_ROUTER_TIMEOUT))
+            response.raise_for_status()
+            answer = parse_router_answer(response.json().get('response', ''))
+        except Exception as e:
+            log.warning("Search router model check failed: %s", e)
+            return RouteDecision(None, "model check failed")
+        if answer is None:
+            return RouteDecision(None, "model was unsure")
+        return RouteDecision(answer, f"model said {'yes' if answer else 'no'}")
+
+    @staticmethod
+    def wants_search(context):
+        """False when Auto mode routed the question to the local model alone"""
+        route = context.get('route')
+        return route is None or route.search
+
+    def retrieve_cached_answer(self, context):
+        """Embed the question and finish with a recent grounded answer to a near-identical one if there is one"""
+        if not self.wants_search(context) or self.semantic_cache is None or not self.semantic_cache.enabled:
+            return None
+        query_vector = self.semantic_cache.embed(context.request['prompt'], timeout=context.deadline.timeout(BACKEND_TIMEOUT))
+        cached = self.semantic_cache.lookup(query_vector)
+        if cached is not None:
+            log.debug("Semantic cache hit (%.3f, %.0fs old): '%s'", cached.score, cached.age, cached.query)
+            raise QueryFinished("answer", cached.answer)
+        return query_vector
+
+    def search_stage(self, context):
+        """
+        Search results for the question, reusing recent results for the same question to save quota.
+        
+        Returns None when search is unavailable and nothing is cached; the answer is then
+        generated by the local model alone.
+        """
+        if not self.wants_search(context):
+            return None
+        request_id = context.request['id']
+        user_prompt = context.request['prompt']
+        cached = self.search_results.get(user_prompt, max_age=SEARCH_RESULT_CACHE_MAX_AGE)
+        notice = None
+        if cached is None and self.search_quota.low:
+            cached = self.search_results.get(user_prompt, similar=True)
+            if cached is not None:
+                notice = "Search quota is running low"
+        if cached is None:
+            try:
+                search_items, search_error = self.search_web(user_prompt, context.deadline)
+                if search_error:
+                    raise QueryFinished("error", search_error)
+                self.search_results.put(user_prompt, search_items)
+                return search_items
+            except SearchQuotaExceeded as e:
+                cached = self.search_results.get(user_prompt, similar=True)
+                if cached is None:
+                    # Nothing to ground the answer in; let the local model answer on its own
+                    self.emit("notice", request_id, f"Web search is unavailable because {e}. Answering with the local model only.")
+                    return None
+                notice = f"Web search is unavailable because {e}"
+        log.debug("Using cached search results for '%s' (%.0fs old)", cached[2], cached[1])
+        if notice:
+            self.emit("notice", request_id, f"{notice}, so I'm using search results from {format_age(cached[1])} ago.")
+        return cached[0]
+
+    def draft_stage(self, context):
+        """
+        Stream an answer from the local model alone while the search runs.
+        
+        The UI shows it as a draft until the grounded answer replaces it. It is
+        cancelled as soon as search results are ready, since Ollama would
+        otherwise make the grounded answer wait for it, and skipped when compute
+        is scarce. Returns (text, result) of a draft that ran to completion, which
+        becomes the answer if the search found nothing to ground it in.
+        """
+        if not SPECULATIVE_DRAFT or not self.wants_search(context):
+            return None
+        cancel = context.signal("draft_cancel", CancelEvent)
+        if cancel.is_set() or self.compute_scarce():
+            context.stats['draft'] = "skipped"
+            return None
+        payload = {
+            "model": OLLAMA_MODEL,
+            "prompt": self.build_llm_prompt(context),
+            "stream": True,
+            "options": self.answer_options(context)
+        }
+        self.forget_evicted_prefill(payload['prompt'])
+        try:
+            text, result = self.stream_llm_response(context.request['id'], payload, context.deadline,
+                                                    kind="draft", cancel=cancel)
+        except Exception as e:
+            log.warning("Draft answer failed: %s", e)
+            context.stats['draft'] = "failed"
+            return None
+        cancelled = result.get('done_reason') == "cancelled"
+        context.stats['draft'] = "cancelled" if cancelled else "complete"
+        log.debug("Draft %s after %d tokens", context.stats['draft'], result.get('eval_count', 0))
+        return None if cancelled else (text, result)
+
+    def compute_scarce(self):
+        """Whether a speculative draft would slow other work down: another answer is streaming or the CPUs are busy"""
+        with self.stats_lock:
+            if self.generating:
+                return True
+        if hasattr(os, "getloadavg"):  # Not available on Windows
+            return os.getloadavg()[0] / (os.cpu_count() or 1) > SPECULATIVE_MAX_LOAD
+        return False
+
+    @staticmethod
+    def search_items_key(context):
+        """Cache key of the compress stage: the question and the results it was given"""
+        items = context['search']
+        if items is None:
+            return None
+        return context.request['prompt'], json.dumps(items, sort_keys=True)
+
+    def compress_stage(self, context):
+        """Rerank and trim the snippets so only useful sentences reach the prompt; returns (context, raw results)"""
+        search_items = context['search']
+        if search_items is None:
+            return None
+        search_results_raw = format_search_results(search_items)
+        if SEARCH_COMPRESSION_ENABLED:
+            return compress_search_results(context.request['prompt'], search_items, SEARCH_CONTEXT_TOKENS), search_results_raw
+        return search_results_raw, search_results_raw
+
+    def retrieve_passages(self, context):
+        """The best matching passages from the local documents"""
+        if self.doc_index is None:
+            raise QueryFinished("error", "Docs mode is disabled. Set DOCS_FOLDER to a folder of documents to enable it.")
+        # Pick up edited files without making this query wait for the scan
+        if time.time() - self.doc_index.last_refresh > DOCS_REFRESH_INTERVAL:
+            self.refresh_doc_index()
+        hits = self.doc_index.search(context.request['prompt'], DOCS_TOP_K)
+        if log.isEnabledFor(logging.DEBUG):
+            stats = self.doc_index.stats()
+            log.debug("Docs retrieval over %d passages (%d files, %.0f KB index)",
+                      stats.passages, stats.files, stats.bytes / 1024)
+        return hits
+
+    def prompt_prefix(self, mode, history):
+        """
+        The lines a mode's prompt starts with: the system instructions and the history.
+        
+        They are known before the question is, so prefill_prompt can have Ollama
+        evaluate them while the user is still typing.
+        """
+        lines = [f"System: {SYSTEM_PROMPT}"]
+        if mode == MODE_WEB_SEARCH:
+            lines.append("System: You have access to web search results. Use the information from these results to provide a comprehensive answer.")
+        elif mode == MODE_DOCS:
+            lines.append("System: Answer using the passages from the user's local documents below. "
+                         "Cite passages by their [n] marker, and say so if they do not contain the answer.")
+        return lines + list(history)
+
+    @staticmethod
+    def prompt_history(request):
+        """History lines of a query's prompt; the question itself goes in the last turn"""
+        return history_without_question(request['history'], request['prompt'])
+
+    def build_llm_prompt(self, context):
+        """Prompt with the conversation history and the question"""
+        lines = self.prompt_prefix(MODE_LLM, self.prompt_history(context.request))
+        return "\n".join(lines) + question_turn(context.request['prompt'])
+
+    def build_search_prompt(self, context):
+        """Prompt with the search results right before the question"""
+        compressed = context['compress']
+        if compressed is None:
+            return self.build_llm_prompt(context)
+        context.signal("draft_cancel", CancelEvent).set()  # The grounded answer takes over from here
+        search_context, search_results_raw = compressed
+        user_prompt = context.request['prompt']
+        # Build context with conversation history first so the search results sit next to the question
+        lines = self.prompt_prefix(MODE_WEB_SEARCH, self.prompt_history(context.request))
+        search_header = f"System: Web search results for query: '{user_prompt}'\n"
+        question = question_turn(user_prompt)
+        full_prompt = "\n".join(lines + [search_header + search_context]) + question
+        if log.isEnabledFor(logging.DEBUG):
+            raw_prompt_tokens = estimate_tokens("\n".join(lines + [search_header + search_results_raw]) + question)
+            context.stats['raw_prompt_tokens'] = raw_prompt_tokens
+            log.debug("Search context: ~%d -> ~%d tokens", estimate_tokens(search_results_raw), estimate_tokens(search_context))
+            log.debug("Prompt size: ~%d -> ~%d tokens", raw_prompt_tokens, estimate_tokens(full_prompt))
+        return full_prompt
+
+    def build_docs_prompt(self, context):
+        """Prompt with the retrieved passages right before the question"""
+        hits = context['retrieve']
+        if not hits:
+            if not self.doc_index.last_refresh:
+                raise QueryFinished("system", "Your documents are still being indexed. Please try again in a moment.")
+            raise QueryFinished("system", "I couldn't find anything related to that in your documents.")
+        passages = "\n\n".join(f"[{i}] {passage.path}:{passage.line}\n{passage.text}"
+                                for i, (_, passage) in enumerate(hits, 1))
+        # Build context with conversation history first so the passages sit next to the question
+        lines = self.prompt_prefix(MODE_DOCS, self.prompt_history(context.request))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Prompt includes %d document passages (~%d tokens)", len(hits), estimate_tokens(passages))
+        return "\n".join(lines + [f"System: Passages from local documents:\n{passages}"]) + \
+            question_turn(context.request['prompt'])
+
+    def generate_search_answer(self, context):
+        """
+        Generate stage of the web pipelines. The prompt stage cancels the draft
+        once there are search results, so only without them does this wait for
+        the draft, which then already is the local model's answer.
+        """
+        if context.get('compress') is None:
+            draft = context.wait('draft', context.deadline.remaining())
+            if draft is not None:
+                self.account_generation(context, draft[1])
+                return draft
+        return self.generate_answer(context)
+
+    def generate_answer(self, context):
+        """Stream the answer from Ollama; returns (text, final result)"""
+        payload = {
+            "model": OLLAMA_MODEL,
+            "prompt": context['prompt'],
+            "stream": True,
+            "options": self.answer_options(context)
+        }
+        log.debug("Sending LLM request: %.50s...", payload['prompt'])
+        response_text, result = self.stream_llm_response(context.request['id'], payload, context.deadline)
+        self.account_prefill(context, payload)
+        self.account_generation(context, result)
+        if log.isEnabledFor(logging.DEBUG):
+            # The final object also carries the prompt's token ids ("context"), thousands of numbers
+            log.debug("Query API response: %s", {key: value for key, value in result.items() if key != 'context'})
+            # Ollama reports prompt evaluation in nanoseconds; extrapolate the uncompressed cost from its rate
+            eval_count = result.get('prompt_eval_count')
+            eval_duration = result.get('prompt_eval_duration')
+            if eval_count and eval_duration:
+                line = f"Prompt eval: {eval_count} tokens in {eval_duration / 1e9:.3f}s"
+                if 'raw_prompt_tokens' in context.stats:
+                    per_token = eval_duration / 1e9 / eval_count
+                    line += f" (uncompressed est. {context.stats['raw_prompt_tokens'] * per_token:.3f}s)"
+                log.debug(line)
+        return response_text, result
+
+    def answer_options(self, context):
+        """The profile's options plus the turn stop sequences and an output cap for this kind of question"""
+        options = self.ollama_options(context.request)
+        kind = classify_query(context.request['prompt'])
+        profile_cap = options.get('num_predict')
+        cap = ANSWER_TOKEN_CAPS.get(kind)
+        if cap is not None and (profile_cap is None or profile_cap < 0 or cap < profile_cap):
+            options['num_predict'] = cap
+        options['stop'] = STOP_SEQUENCES
+        context.stats.update(query_kind=kind, token_cap=options.get('num_predict'), profile_cap=profile_cap)
+        return options
+
+    def account_generation(self, context, result):
+        """
+        Count the tokens generated and the tokens saved by the answer length
+        cap and by ending runaway answers early.
+        
+        An answer that hit its question's cap (token_cap, tighter than the
+        profile's) would otherwise have gone on, at most to the profile's cap.
+        An answer closed at a new turn marker would have gone on at most to
+        token_cap. Both differences are upper bounds, since the model might
+        have ended sooner on its own. Ollama ends generations at stop
+        sequences without saying so, so those savings cannot be counted.
+        """
+        tokens = result.get('eval_count', 0)
+        reason = result.get('done_reason')
+        token_cap = context.stats.get('token_cap')
+        profile_cap = context.stats.get('profile_cap')
+        bounded = lambda cap: cap is not None and cap > 0  # None or a negative num_predict means no cap
+        cap_stop = reason == "length" and token_cap != profile_cap
+        cap_saved = profile_cap - token_cap if cap_stop and bounded(profile_cap) else 0
+        turn_saved = max(0, token_cap - tokens) if reason == "turn" and bounded(token_cap) else 0
+        context.stats.update(tokens=tokens, done_reason=reason, cap_saved=cap_saved, turn_saved=turn_saved)
+        with self.stats_lock:
+            stats = self.generation_stats
+            stats['turns'] += 1
+            stats['tokens'] += tokens
+            stats['capped'] += reason == "length"
+            stats['cap_stops'] += cap_stop
+            stats['cap_saved'] += cap_saved
+            stats['turn_stops'] += reason == "turn"
+            stats['turn_saved'] += turn_saved
+        log.debug("Generated %d tokens (%s question, cap %s of the profile's %s, ended by %s); "
+                  "up to %d tokens saved by the cap and up to %d by the turn stop",
+                  tokens, context.stats['query_kind'], token_cap, profile_cap, reason, cap_saved, turn_saved)
+
+    def report_generation(self, request):
+        """Report generated tokens and the tokens saved by length caps and by stopping at turn markers"""
+        with self.stats_lock:
+            stats = dict(self.generation_stats)
+        if not stats['turns']:
+            text = "No answers generated yet."
+        else:
+            text = (f"✂️ {stats['turns']} answers, {stats['tokens']} tokens generated "
+                    f"(~{stats['tokens'] / stats['turns']:.0f} per answer); {stats['capped']} answers reached their length cap.\n"
+                    f"Length caps by question type: {stats['cap_stops']} answers were cut below the profile's cap, "
+                    f"saving at most {stats['cap_saved']} tokens.\n"
+                    f"Turn stops: {stats['turn_stops']} runaway answers were stopped at an invented turn, "
+                    f"saving at most {stats['turn_saved']} tokens.\n"
+                    f"Both savings are upper bounds: an answer might have ended sooner on its own.")
+        self.emit("system", request['id'], text)
+
+    def report_logs(self, request):
+        """Show the engine's most recent log lines"""
+        lines = recent_logs(request['count'])
+        if not lines:
+            text = f"No log lines recorded (level {LOG_LEVEL}, buffer of {LOG_BUFFER_LINES} lines)."
+        else:
+            text = f"📜 Last {len(lines)} log lines (level {LOG_LEVEL}):\n" + "\n".join(lines)
+        self.emit("system", request['id'], text)
+
+    def prefill_prompt(self, request):
+        """
+        Have Ollama evaluate the prompt prefix of the next query, so its KV cache is warm.
+        
+        Ollama reuses the cached tokens of the longest common prefix of consecutive
+        prompts, so once the question arrives only the question itself is evaluated.
+        Runs a one-token generation (num_predict 0 means no limit in Ollama) with the
+        options the query will use; different options would make Ollama reload the model.
+        """
+        prefix = "\n".join(self.prompt_prefix(request['mode'], request['history']))
+        options = self.ollama_options(request)
+        key = (prefix, json.dumps(load_options(options), sort_keys=True))
+        with self.stats_lock:
+            entry = self.prefill
+            if entry is not None and entry['key'] == key and (
+                    not entry['ready'] or time.time() - entry['at'] < PREFILL_KEEP_ALIVE):
+                return  # Already sent after an earlier pause in typing
+            self.prefill = {"key": key, "prefix": prefix, "ready": False}
+            entry = self.prefill
+        try:
+            response = self.http.post(OLLAMA_URL, json={
+                "model": OLLAMA_MODEL,
+                "prompt": prefix,
+                "stream": False,
+                "keep_alive": PREFILL_KEEP_ALIVE,
+                "options": dict(options, num_predict=1)
+            }, timeout=(BACKEND_TIMEOUT, QUERY_DEADLINE))
+            response.raise_for_status()
+            result = response.json()
+        except Exception as e:
+            log.warning("Prefill error: %s", e)
+            with self.stats_lock:
+                if self.prefill is entry:
+                    self.prefill = None
+            return
+        with self.stats_lock:
+            # Only prompt tokens Ollama did not already have cached are counted as saved
+            entry.update(ready=True, at=time.time(), tokens=result.get('prompt_eval_count', 0),
+                         seconds=result.get('prompt_eval_duration', 0) / 1e9)
+        log.debug("Prefilled %d prompt tokens in %.3fs", entry['tokens'], entry['seconds'])
+
+    def forget_evicted_prefill(self, prompt):
+        """
+        Forget the prefilled prefix when prompt does not start with it: Ollama's
+        prompt cache then holds prompt instead, so the prefill saves the answer
+        nothing (a draft's prompt lacks the web search instructions, for example).
+        """
+        with self.stats_lock:
+            entry = self.prefill
+            if entry is not None and not prompt.startswith(entry['prefix'] + "\n"):
+                self.prefill = None
+
+    def account_prefill(self, context, payload):
+        """Count the prompt evaluation time a prefill saved this query"""
+        key = (context['prompt'], json.dumps(load_options(payload['options']), sort_keys=True))
+        with self.stats_lock:
+            self.prefill_stats['turns'] += 1
+            entry = self.prefill
+            if entry is None or not entry['ready']:
+                return
+            # Either way Ollama's prompt cache now holds this prompt, e.g. another chat tab's, not the prefix
+            self.prefill = None
+            if (time.time() - entry['at'] > PREFILL_KEEP_ALIVE
+                    or key[1] != entry['key'][1] or not key[0].startswith(entry['prefix'] + "\n")):
+                return
+            self.prefill_stats['prefilled'] += 1
+            self.prefill_stats['tokens'] += entry['tokens']
+            self.prefill_stats['seconds'] += entry['seconds']
+        context.stats['prefill_seconds'] = entry['seconds']
+        log.debug("Prefill saved ~%.3fs of prompt evaluation (%d tokens)", entry['seconds'], entry['tokens'])
+
+    def report_prefill(self, request):
+        """Report how much prompt evaluation time prefilling has saved"""
+        with self.stats_lock:
+            stats = dict(self.prefill_stats)
+        if not PREFILL_ENABLED:
+            text = "Prompt prefill is disabled (PREFILL_ENABLED)."
+        elif not stats['turns']:
+            text = "No queries answered yet."
+        else:
+            text = (f"⚡ Prompt prefill warmed {stats['prefilled']} of {stats['turns']} turns, "
+                    f"saving ~{stats['seconds']:.1f}s of prompt evaluation ({stats['tokens']} tokens, "
+                    f"~{stats['seconds'] / stats['turns']:.2f}s per turn)")
+        self.emit("system", request['id'], text)
+
+    def post_process_answer(self, context):
+        """Strip reasoning blocks and prompt artifacts from the generated answer"""
+        response_text, _ = context['generate']
+        assistant_response = response_text or self.EMPTY_ANSWERS.get(
+            context.request['mode'], "Sorry, I could not generate a response.")
+        if "<think>" in assistant_response:
+            assistant_response = assistant_response.split("</think>")[-1].strip()
+        if "[Focus on current question only]" in assistant_response:
+            assistant_response = assistant_response.replace("[Focus on current question only]", "").strip()
+        return assistant_response
+
+    def render_answer(self, context):
+        """Hand the finished answer to the UI"""
+        self.emit("answer", context.request['id'], context['post_process'])
+
+    def remember_answer(self, context):
+        """Store a grounded answer in the semantic cache"""
+        if self.semantic_cache is not None and context['search'] is not None:
+            self.semantic_cache.add(context['retrieve'], context.request['prompt'], context['post_process'])
+
+    def register_idle_jobs(self):
+        """Maintenance that runs while the user is away (see idle_jobs.py)"""
+        if self.doc_index is not None:
+            self.idle_jobs.register("docs index", self.doc_index.refresh_paced, DOCS_REFRESH_INTERVAL)
+        self.idle_jobs.register("memory compaction", self.compact_memory, IDLE_MEMORY_COMPACT_INTERVAL)
+        if self.semantic_cache is not None:
+            self.idle_jobs.register("semantic cache log", self.semantic_cache.compact,
+                                    IDLE_CACHE_COMPACT_INTERVAL)
+
+    def stop_idle_jobs(self):
+        if self.idle_jobs is not None:
+            self.idle_jobs.stop(timeout=1)
+
+    def refresh_doc_index(self):
+        """Re-scan the docs folder on a background thread; queries keep using the current index meanwhile"""
+        threading.Thread(target=self.doc_index.refresh, daemon=True).start()
+
+    def report_doc_index(self, request):
+        """Report the size of the docs index as a system message"""
+        if self.doc_index is None:
+            self.emit("system", request['id'], "Docs mode is disabled. Set DOCS_FOLDER to a folder of documents to enable it.")
+            return
+        stats = self.doc_index.stats()
+        state = "up to date" if self.doc_index.last_refresh else "indexing in progress"
+        self.emit("system", request['id'],
+                  f"📚 Docs index for {DOCS_FOLDER} ({state})\n"
+                  f"Files: {stats.files}, passages: {stats.passages}, terms: {stats.terms}\n"
+                  f"Index size: {stats.bytes / 1024:.0f} KB")
+
+    def compare_models(self, request):
+        """Run the prompt on every model in COMPARE_MODELS, reporting each result as a "compare_result" event"""
+        request_id = request['id']
+        prompt = f"System: {SYSTEM_PROMPT}\nUser: {request['prompt']}\nAssistant: "
+        log.info("Comparing %s (%s)...", ", ".join(COMPARE_MODELS), "concurrent" if COMPARE_CONCURRENT else "sequential")
+        
+        def report(run):
+            if log.isEnabledFor(logging.INFO):
+                log.info("%s: %s", run.model, format_run_stats(run))
+            self.emit("compare_result", request_id, run._asdict())
+        
+        runs = compare_models(OLLAMA_URL, OLLAMA_PS_URL, COMPARE_MODELS, prompt, COMPARE_CONCURRENT, on_result=report)
+        try:
+            save_comparison(COMPARE_RESULTS_FILE, request['prompt'], runs, COMPARE_CONCURRENT)
+            saved = f"Results saved to {os.path.basename(COMPARE_RESULTS_FILE)}."
+        except Exception as e:
+            log.error("Error saving comparison results: %s", e)
+            saved = f"Could not save results: {str(e)}"
+        
+        # Rank the models that answered by total latency
+        finished = sorted((run for run in runs if not run.error), key=lambda run: run.total_time)
+        lines = [f"⚖️ Compared {len(runs)} models. {saved}"]
+        lines += [f"{i}. {run.model}: {format_run_stats(run)}" for i, run in enumerate(finished, 1)]
+        lines += [f"✗ {run.model}: {run.error}" for run in runs if run.error]
+        self.emit("system", request_id, "\n".join(lines))
+
+    def tune_ollama(self, request):
+        """Benchmark thread and batch settings for OLLAMA_MODEL and save the fastest as the "tuned" profile"""
+        request_id = request['id']
+        try:
+            result = autotune(OLLAMA_URL, OLLAMA_MODEL, OLLAMA_TUNE_CONTEXT,
+                              on_progress=lambda text: self.emit("notice", request_id, text))
+            save_tuned_profile(OLLAMA_TUNED_FILE, OLLAMA_MODEL, result)
+            self.profiles = load_profiles(OLLAMA_PROFILES, OLLAMA_TUNED_FILE, OLLAMA_MODEL)
+            options = result['options']
+            self.emit("system", request_id,
+                      f"🔧 Fastest settings for {OLLAMA_MODEL}: {options['num_thread']} threads, "
+                      f"batch {options['num_batch']}, context {options['num_ctx']} "
+                      f"(~{result['turn_seconds']:.1f}s per typical answer). "
+                      f"Saved as the '{TUNED_PROFILE}' profile; type !perf {TUNED_PROFILE} to use it.")
+        except Exception as e:
+            log.error("Auto-tune error: %s", e, exc_info=True)
+            self.emit("error", request_id, f"Auto-tune failed: {str(e)}")
+
+    def save_memory(self, conversation_id, messages, important):
+        """Save a conversation to the memory file, filtering out trivial messages"""
+        try:
+            # Skip saving if conversation is too short and not important
+            if len(messages) < 3 and not important:
+                log.debug("Skipping memory save - conversation too short")
+                return
+                
+            # Filter out short/trivial messages
+            filtered_history = []
+            for msg in messages:
+                # Always keep system messages
+                if msg.get("role") == "system":
+                    filtered_history.append(msg)
+                # Filter user and assistant messages by length and content
+                elif len(msg.get("content", "")) > MIN_MESSAGE_LENGTH:
+                    filtered_history.append(msg)
+            
+            # Skip saving if filtered conversation is empty
+            if not filtered_history:
+                log.debug("Skipping memory save - no significant messages")
+                return
+            
+            with self.memory_lock:
+                # Load existing memory file if it exists
+                document = memory_store.load_document(MEMORY_FILE)
+                
+                # Add or update current conversation; the other conversations keep their near-duplicate patches
+                memory_store.put_conversation(document, conversation_id, {
+                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    'important': important,
+                    'messages': filtered_history[-MEMORY_MAX_MESSAGES:] if filtered_history else []
+                })
+                
+                # Keep important conversations first, then the most recent ones, while their
+                # stored size fits; repeated messages are only counted once
+                conversations = document['conversations']
+                ranked = sorted(conversations, key=lambda k: (conversations[k].get('important', False),
+                                                               conversations[k].get('timestamp', '')), reverse=True)
+                kept = memory_store.fit_budget(document, ranked, MEMORY_MAX_CHARS, MEMORY_MAX_CONVERSATIONS)
+                memory_store.keep_conversations(document, kept)
+                
+                # Near duplicates are found by compact_memory while the user is away, or here without idle jobs
+                if self.idle_jobs is None:
+                    document, _ = memory_store.compact(memory_store.expand(document), MEMORY_DEDUP_THRESHOLD)
+                memory_store.write_document(MEMORY_FILE, document)
+                self.memory_generation += 1
+                self.memory_compacted = self.idle_jobs is None
+                
+            log.debug("Saved conversation to memory file with %d messages", len(filtered_history))
+            log.debug("Memory file holds %d conversations (%d dropped) as %d texts, %d characters",
+                      len(kept), len(ranked) - len(kept), len(document['texts']),
+                      sum(len(text) for text in document['texts']))
+                
+        except Exception as e:
+            log.error("Error saving memory: %s", e)
+    
+    def load_memory(self):
+        """Load conversation history from file"""
+        try:
+            if os.path.exists(MEMORY_FILE):
+                # Count messages in memory for debugging
+                conversations, total_messages, important_convs = memory_store.summarize(MEMORY_FILE)
+                    
+                log.info("Loaded %d conversations from memory (%d messages, %d important)",
+                         conversations, total_messages, important_convs)
+            else:
+                log.info("No memory file found, starting fresh")
+        except Exception as e:
+            log.error("Error loading memory: %s", e)
+
+    def compact_memory(self, checkpoint):
+        """Idle job: store near-duplicate messages in the memory file once"""
+        with self.memory_lock:
+            if self.memory_compacted:
+                return
+            conversations = memory_store.load_conversations(MEMORY_FILE)
+            generation = self.memory_generation
+        # Compacting runs outside the lock, so a save is never held up by a paused job
+        document, stats = memory_store.compact(conversations, MEMORY_DEDUP_THRESHOLD, checkpoint)
+        with self.memory_lock:
+            if generation != self.memory_generation:
+                return  # Saved or wiped meanwhile; the next run compacts the new file
+            if conversations:
+                memory_store.write_document(MEMORY_FILE, document)
+            self.memory_compacted = True
+        log.debug("Compacted memory file: %d messages as %d texts (%d exact and %d near duplicates)",
+                  stats.messages, stats.texts, stats.exact, stats.near)
+
+    def wipe_memory(self):
+        """Delete all stored conversations"""
+        try:
+            with self.memory_lock:
+                self.memory_generation += 1
+                if os.path.exists(MEMORY_FILE):
+                    os.remove(MEMORY_FILE)
+                    log.info("Wiped all stored conversations from memory file")
+        except Exception as e:
+            log.error("Error wiping memory file: %s", e)
+
+    def handle_weather_command(self, request):
+        """Handle the weather command and report current weather conditions"""
+        request_id = request['id']
+        command = request['command']
+        deadline = self.request_deadline(request)
+        try:
+            # Use default location coordinates
+            location = DEFAULT_LOCATION
+            location_name = DEFAULT_CITY
+            
+            # Resolve custom locations offline from the bundled gazetteer
+            if len(command.split()) > 1:
+                place = " ".join(command.split()[1:])
+                resolved = self.geocoder.resolve(place) if self.geocoder else None
+                if resolved is None:
+                    self.emit("error", request_id, f"Unknown location '{place}'. Try a nearby major city, optionally with a country (e.g. '!weather Paris, France').")
+                    return
+                location = {"lat": resolved.lat, "lon": resolved.lon}
+                location_name = f"{resolved.name}, {resolved.country}"
+            
+            # Make API request
+            params = {
+                'apikey': TOMORROW_API_KEY,
+                'location': f"{location['lat']},{location['lon']}",
+                'units': 'metric'
+            }
+            
+            log.debug("Fetching weather for %s...", location_name)
+                
+            response = hedged_get(
+                self.http,
+                TOMORROW_URL,
+                deadline,
+                self.weather_latency,
+                timeout_cap=BACKEND_TIMEOUT,
+                retries=BACKEND_RETRIES,
+                hedge=HEDGE_ENABLED,
+                params=params
+            )
+            response.raise_for_status()
+            weather_data = response.json()
+            
+            # Format weather information
+            data = weather_data['data']['values']
+            temp = data['temperature']
+            feels_like = data['temperatureApparent']
+            humidity = data['humidity']
+            cloud_cover = data['cloudCover']
+            wind_speed = data['windSpeed']
+            conditions = self.get_weather_condition(cloud_cover)
+            
+            weather_message = (
+                f"📍 Weather in {location_name}\n"
+                f"🌡️ Temperature: {temp}°C\n"
+                f"🤔 Feels like: {feels_like}°C\n"
+                f"💧 Humidity: {humidity}%\n"
+                f"🌤️ Conditions: {conditions}\n"
+                f"💨 Wind Speed: {wind_speed} m/s"
+            )
+            
+            self.emit("system", request_id, weather_message)
+            
+        except requests.exceptions.RequestException as e:
+            self.emit("error", request_id, f"Error fetching weather data: {str(e)}")
+        except KeyError as e:
+            self.emit("error", request_id, f"Error parsing weather data: {str(e)}")
+        except Exception as e:
+            self.emit("error", request_id, f"Unexpected error: {str(e)}")
+
+class LocalEngineClient:
+    """Runs the QueryEngine on background threads inside the UI process"""
+    def __init__(self, on_event):
+        self.engine = QueryEngine(on_event)
+        self._threads = set()
+        self._lock = threading.Lock()
+
+    def submit(self, request):
+        thread = threading.Thread(target=self._run, args=(request,), daemon=True)
+        with self._lock:
+            self._threads.add(thread)
+        thread.start()
+
+    def _run(self, request):
+        try:
+            self.engine.handle(request)
+        finally:
+            with self._lock:
+                self._threads.discard(threading.current_thread())
+
+    def close(self, timeout=None):
+        """Wait for outstanding work such as memory saves before exit"""
+        deadline = time.time() + (ENGINE_SHUTDOWN_TIMEOUT if timeout is None else timeout)
+        with self._lock:
+            threads = list(self._threads)
+        self.engine.stop_idle_jobs()
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        self.engine.stop_trace()
+
+def run_engine_process(conn):
+    """Entry point of the engine worker process: serve requests from the UI over conn"""
+    configure_logging("engine")
+    send_lock = threading.Lock()
+
+    def emit(kind, request_id, text):
+        with send_lock:
+            conn.send((kind, request_id, text))
+
+    engine = QueryEngine(emit)
+    workers = []
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:  # Clean shutdown requested by the UI
+            engine.stop_idle_jobs()
+            break
+        worker = threading.Thread(target=engine.handle, args=(request,), daemon=True)
+        worker.start()
+        workers = [w for w in workers if w.is_alive()] + [worker]
+    
+    deadline = time.time() + ENGINE_SHUTDOWN_TIMEOUT
+    for worker in workers:
+        worker.join(max(0, deadline - time.time()))
+    engine.stop_trace()
+
+class EngineProcessClient:
+    """
+    Runs the QueryEngine in a worker process so JSON decoding, prompt building
+    and memory serialization never compete with the Tk main loop for the GIL.
+    
+    Requests and events travel over a multiprocessing Pipe. If the worker dies,
+    its pending requests fail with an error event and a fresh worker is started,
+    with exponential backoff if it keeps dying right after start.
+    """
+    def __init__(self, on_event):
+        self.on_event = on_event
+        self._context = multiprocessing.get_context("spawn")
+        self._lock = threading.Lock()
+        self._pending = set()  # Request ids still waiting for a final event
+        self._closing = False
+        self._quick_failures = 0
+        self._start()
+
+    def _start(self):
+        self._conn, child_conn = self._context.Pipe()
+        self._process = self._context.Process(
+            target=run_engine_process, args=(child_conn,), name="query-engine", daemon=True)
+        self._process.start()
+        # Only the worker keeps its end open, so a crash shows up here as EOF
+        child_conn.close()
+        self._started_at = time.time()
+        threading.Thread(target=self._read_events, args=(self._conn, self._process), daemon=True).start()
+        log.info("Started query engine process (pid %d)", self._process.pid)
+
+    def submit(self, request):
+        request_id = request.get('id')
+        with self._lock:
+            if request_id is not None:
+                self._pending.add(request_id)
+            try:
+                self._conn.send(request)
+                return
+            except (OSError, EOFError) as e:
+                log.warning("Could not reach query engine process: %s", e)
+                self._pending.discard(request_id)
+        if request_id is not None:
+            self.on_event("error", request_id, "The query engine is restarting. Please try again in a moment.")
+
+    def _read_events(self, conn, process):
+        while True:
+            try:
+                kind, request_id, text = conn.recv()
+            except (EOFError, OSError):
+                break
+            if kind not in ("chunk", "draft"):
+                with self._lock:
+                    self._pending.discard(request_id)
+            self.on_event(kind, request_id, text)
+        
+        if self._closing:
+            return
+        process.join(timeout=1)
+        log.error("Query engine process exited unexpectedly (exit code %s), restarting", process.exitcode)
+        with self._lock:
+            lost = list(self._pending)
+            self._pending.clear()
+        for request_id in lost:
+            self.on_event("error", request_id, "The query engine stopped unexpectedly and was restarted. Please try again.")
+        
+        # Back off if the worker keeps dying right after start
+        if time.time() - self._started_at < ENGINE_RESTART_WINDOW:
+            self._quick_failures += 1
+        else:
+            self._quick_failures = 0
+        time.sleep(min(2 ** self._quick_failures - 1, 30))
+        with self._lock:
+            if not self._closing:
+                self._start()
+
+    def close(self, timeout=None):
+        """Ask the worker to finish outstanding work (e.g. memory saves) and exit"""
+        timeout = ENGINE_SHUTDOWN_TIMEOUT if timeout is None else timeout
+        with self._lock:
+            self._closing = True
+            try:
+                self._conn.send(None)
+            except (OSError, EOFError):
+                pass
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+
+def create_engine_client(on_event):
+    """Create the configured query engine client; on_event is called from a background thread"""
+    if ENGINE_OUT_OF_PROCESS:
+        return EngineProcessClient(on_event)
+    return LocalEngineClient(on_event)
+
+class EngineRouter:
+    """
+    One query engine client shared by every chat session.
+    
+    Sessions share the engine's threads, connection pool and caches, and one
+    counter of request ids. Each event goes to the session that sent the request.
+    Quota updates go to every session, and other events without a request go to
+    the focused one.
+    """
+    FINISHING_EVENTS = ("answer", "system", "error")
+
+    def __init__(self):
+        self.request_ids = itertools.count(1)
+        self.focused = None
+        self._lock = threading.Lock()
+        self._owners = {}     # Request id -> EngineSession waiting for its final event
+        self._sessions = []
+        self._last_quota = None  # Replayed to sessions opened after the engine reported it
+        self._input_reported = 0.0
+        self.client = create_engine_client(self._dispatch)
+
+    def session(self, owns_router=False):
+        """A new session's handle on the engine"""
+        session = EngineSession(self, owns_router)
+        with self._lock:
+            self._sessions.append(session)
+            if self.focused is None:
+                self.focused = session
+        return session
+
+    def submit(self, session, request):
+        if request.get('id') is not None:
+            with self._lock:
+                self._owners[request['id']] = session
+        self.client.submit(request)
+
+    @property
+    def busy(self):
+        """Whether any session is waiting for an answer"""
+        with self._lock:
+            return bool(self._owners)
+
+    def remove(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+            self._owners = {request_id: owner for request_id, owner in self._owners.items() if owner is not session}
+            if self.focused is session:
+                self.focused = self._sessions[0] if self._sessions else None
+
+    def _dispatch(self, kind, request_id, text):
+        """Called from engine threads"""
+        with self._lock:
+            if kind == "quota":
+                self._last_quota = text
+            if request_id is None:
+                targets = list(self._sessions) if kind == "quota" else [self.focused]
+            elif kind in self.FINISHING_EVENTS:
+                targets = [self._owners.pop(request_id, None)]
+            else:
+                targets = [self._owners.get(request_id)]
+        for session in targets:
+            # Events for a closed session are dropped
+            if session is not None and session.on_event is not None:
+                session.on_event(kind, request_id, text)
+
+    def attach(self, session, on_event):
+        session.on_event = on_event
+        with self._lock:
+            quota = self._last_quota
+        if quota is not None:
+            on_event("quota", None, quota)
+
+    def report_ui_state(self, hidden=None):
+        """Tell the engine the window was shown or hidden, or that the user typed, so maintenance can wait"""
+        now = time.time()
+        if hidden is None:
+            if now - self._input_reported < IDLE_INPUT_REPORT_INTERVAL:
+                return
+            self._input_reported = now
+        self.client.submit({"type": "ui_state", "hidden": hidden, "active_at": None if hidden else now})
+
+    def close(self, timeout=None):
+        self.client.close(timeout)
+
+class EngineSession:
+    """A chat session's handle on the shared engine, used like an engine client"""
+    def __init__(self, router, owns_router=False):
+        self.router = router
+        self.owns_router = owns_router  # Close the engine with the session when it has no other users
+        self.on_event = None
+        self.request_ids = router.request_ids
+
+    @property
+    def busy(self):
+        return self.router.busy
+
+    def attach(self, on_event):
+        """Start receiving this session's events"""
+        self.router.attach(self, on_event)
+
+    def submit(self, request):
+        self.router.submit(self, request)
+
+    def report_input(self):
+        self.router.report_ui_state()
+
+    def close(self, timeout=None):
+        self.router.remove(self)
+        if self.owns_router:
+            self.router.close(timeout)
+
 class WelcomeScreen(tk.Frame):
     def __init__(self, parent, on_start):
         super().__init__(parent, bg=CURRENT_THEME['welcome_bg'])
@@ -173,18 +1748,87 @@ class WelcomeScreen(tk.Frame):
         )
         self.instructions_label.config(fg=CURRENT_THEME['text'], bg=CURRENT_THEME['welcome_bg'])
 
+class ComparisonWindow(tk.Toplevel):
+    """Shows the answers of a !compare run side by side, one column per model"""
+    def __init__(self, parent, prompt, models):
+        super().__init__(parent, bg=CURRENT_THEME['bg'])
+        self.title(f"Model comparison: {prompt[:60]}")
+        self.geometry(f"{min(360 * len(models), 1400)}x{INITIAL_HEIGHT}")
+        self.columns = {}  # Model -> (stats label, answer text widget)
+        for column, model in enumerate(models):
+            self.columnconfigure(column, weight=1, uniform="model")
+            tk.Label(
+                self,
+                text=model,
+                font=("Segoe UI", 12, "bold"),
+                fg=CURRENT_THEME['accent'],
+                bg=CURRENT_THEME['bg']
+            ).grid(row=0, column=column, sticky="w", padx=10, pady=(10, 0))
+            stats_label = tk.Label(
+                self,
+                text="Waiting...",
+                font=("Segoe UI", 9, "italic"),
+                fg="#888888",
+                bg=CURRENT_THEME['bg'],
+                justify=tk.LEFT,
+                wraplength=330
+            )
+            stats_label.grid(row=1, column=column, sticky="w", padx=10)
+            answer = scrolledtext.ScrolledText(
+                self,
+                bg=CURRENT_THEME['bg'],
+                fg=CURRENT_THEME['text'],
+                font=("Segoe UI", 10),
+                wrap=tk.WORD,
+                relief=tk.FLAT,
+                padx=8,
+                pady=8,
+                width=10,
+                state=tk.DISABLED
+            )
+            answer.grid(row=2, column=column, sticky="nsew", padx=10, pady=10)
+            configure_markdown_tags(answer, CURRENT_THEME, size=10)
+            self.columns[model] = (stats_label, answer)
+        self.rowconfigure(2, weight=1)
+
+    def show_run(self, run):
+        """Fill in a model's column from a ModelRun dict"""
+        if not self.winfo_exists() or run['model'] not in self.columns:
+            return
+        stats_label, answer = self.columns[run['model']]
+        stats = format_run_stats(ModelRun(**run))
+        stats_label.config(text=stats, fg="#FF4444" if run['error'] else "#888888")
+        answer.configure(state=tk.NORMAL)
+        renderer = MarkdownStreamRenderer(answer, base_tag="answer")
+        renderer.feed(run['answer'])
+        renderer.finish()
+        answer.configure(state=tk.DISABLED)
+
 class ChatInterface(tk.Frame):
-    def __init__(self, parent, toggle_theme_callback): # Added toggle_theme_callback
+    MODE_LABELS = {MODE_LLM: "LLM", MODE_WEB_SEARCH: "Web", MODE_AUTO: "Auto", MODE_DOCS: "Docs"}
+
+    def __init__(self, parent, toggle_theme_callback, engine=None, session_number=1): # Added toggle_theme_callback
         self.toggle_theme_callback = toggle_theme_callback # Store the callback
         super().__init__(parent, bg=CURRENT_THEME['bg'])
-        self.conversation_history = []
-        self.conversation_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        self.session_number = session_number
+        # A standalone chat gets an engine of its own; ChatSessions tabs share one
+        self.engine = engine or EngineRouter().session(owns_router=True)
+        self.engine.attach(self.on_engine_event)
+        self.conversation_history = ConversationHistory()
+        self.conversation_id = self.new_conversation_id()
         self.message_count_since_save = 0
         self.important_conversation = False  # Flag to mark important conversations
         self.response_start_time = 0  # Track when response generation starts
         self.current_mode = MODE_LLM  # Default to LLM mode
         self.thinking_position = None  # Track position of thinking message
-        self.load_memory()
+        self.request_ids = self.engine.request_ids  # Shared by all sessions, so ids never collide
+        self.pending_queries = {}  # Request id -> time the query was sent
+        self.streams = {}          # Request id -> (renderer, streamed parts) of answers being streamed
+        self.drafts = {}           # Request id -> (renderer, streamed parts) of speculative drafts shown meanwhile
+        self.comparisons = {}      # Request id -> ComparisonWindow of a running !compare
+        self.search_quota = None   # Latest {"remaining", "limit"} reported by the engine
+        self.performance_profile = OLLAMA_PROFILE
+        self.prefill_timer = None  # Pending after() id of the debounced prompt prefill
         self.chat_display = scrolledtext.ScrolledText(
             self,
             bg=CURRENT_THEME['bg'],
@@ -204,6 +1848,7 @@ class ChatInterface(tk.Frame):
         self.chat_display.tag_configure("system", foreground="#888888", font=("Segoe UI", 10, "italic"))
         self.chat_display.tag_configure("web_search", foreground="#4CAF50", font=("Segoe UI", 10, "italic"))
         self.chat_display.tag_configure("time", foreground="#888888", font=("Segoe UI", 8, "italic"))
+        configure_markdown_tags(self.chat_display, CURRENT_THEME)
         
         self.input_frame = tk.Frame(self, bg=CURRENT_THEME['bg']) # Made instance var and use theme
         self.input_frame.pack(fill=tk.X, padx=10, pady=10)
@@ -218,6 +1863,7 @@ class ChatInterface(tk.Frame):
         )
         self.user_input.pack(side=tk.LEFT, fill=tk.X, expand=True, ipady=8, padx=(0, 5))
         self.user_input.bind("<Return>", self.on_enter_pressed)
+        self.user_input.bind("<KeyRelease>", self.on_input_changed)
         self.user_input.focus_set()
         
         # Theme toggle button
@@ -280,6 +1926,7 @@ class ChatInterface(tk.Frame):
         # Assuming other tags like 'thinking', 'error' should also adapt or have specific theme entries
         self.chat_display.tag_configure("thinking", foreground="#888888" if CURRENT_THEME == LIGHT_THEME else "#AAAAAA") # Example adjustment
         self.chat_display.tag_configure("error", foreground="#FF4444" if CURRENT_THEME == LIGHT_THEME else "#FF6666") # Example adjustment
+        configure_markdown_tags(self.chat_display, CURRENT_THEME)
 
         self.input_frame.config(bg=CURRENT_THEME['bg'])
         self.user_input.config(bg=CURRENT_THEME['input_bg'], fg=CURRENT_THEME['text'], insertbackground=CURRENT_THEME['text'])
@@ -304,19 +1951,6 @@ class ChatInterface(tk.Frame):
             activeforeground=CURRENT_THEME['text']
         )
         
-    def get_weather_condition(self, cloud_cover):
-        """Convert cloud cover percentage to weather condition description"""
-        if cloud_cover < 10:
-            return "Clear sky"
-        elif cloud_cover < 30:
-            return "Mostly clear"
-        elif cloud_cover < 70:
-            return "Partly cloudy"
-        elif cloud_cover < 90:
-            return "Mostly cloudy"
-        else:
-            return "Overcast"
-
     def remove_thinking_message(self):
         """Helper method to remove the thinking message without affecting other messages"""
         self.chat_display.configure(state=tk.NORMAL)
@@ -341,7 +1975,7 @@ class ChatInterface(tk.Frame):
         self.chat_display.configure(state=tk.NORMAL)
         if sender == "user":
             self.chat_display.insert(tk.END, f"You: {text}\n", "user")
-            self.conversation_history.append({"role": "user", "content": text})
+            self.conversation_history.append("user", text)
             # Start timing the response generation
             self.response_start_time = time.time()
             
@@ -360,8 +1994,11 @@ class ChatInterface(tk.Frame):
                     self.message_count_since_save = 0
                     
         elif sender == "assistant":
-            # Add the main message
-            self.chat_display.insert(tk.END, f"Assistant: {text}", "assistant")
+            # Add the main message, rendering its markdown
+            self.chat_display.insert(tk.END, "Assistant: ", "assistant")
+            renderer = MarkdownStreamRenderer(self.chat_display)
+            renderer.feed(text)
+            renderer.finish()
             
             # Add generation time if provided
             if generation_time is not None:
@@ -371,11 +2008,7 @@ class ChatInterface(tk.Frame):
             # Add newline
             self.chat_display.insert(tk.END, "\n")
             
-            self.conversation_history.append({"role": "assistant", "content": text})
-            
-            # Save memory after important responses
-            if self.important_conversation and len(text) > MIN_MESSAGE_LENGTH:
-                self.save_memory()
+            self.record_assistant_message(text)
                 
         elif sender == "thinking":
             # Store the current position before inserting the thinking message
@@ -391,6 +2024,161 @@ class ChatInterface(tk.Frame):
         self.chat_display.configure(state=tk.DISABLED)
         self.chat_display.see(tk.END)
 
+    def record_assistant_message(self, text):
+        """Add an assistant reply to the history and save memory for important conversations"""
+        self.conversation_history.append("assistant", text)
+        
+        # Save memory after important responses
+        if self.important_conversation and len(text) > MIN_MESSAGE_LENGTH:
+            self.save_memory()
+
+    def on_engine_event(self, kind, request_id, text):
+        """Called from engine threads; hands the event to the Tk main loop"""
+        self.after(0, self.handle_engine_event, kind, request_id, text)
+
+    def handle_engine_event(self, kind, request_id, text):
+        """Render an engine event on the Tk main loop"""
+        if kind == "draft":
+            # A draft can still trickle in after its query finished or its grounded answer started
+            if request_id in self.pending_queries and request_id not in self.streams:
+                if request_id not in self.drafts:
+                    self.begin_draft(request_id)
+                self.append_draft_chunk(request_id, text)
+            return
+        if kind == "chunk":
+            if request_id not in self.streams:
+                self.discard_draft(request_id)
+                self.begin_assistant_stream(request_id)
+            self.append_stream_chunk(request_id, text)
+            return
+        if kind == "quota":
+            self.search_quota = text
+            self.update_mode_button()
+            return
+        if kind == "notice":
+            # Informational message about a request that is still running
+            if request_id in self.drafts:
+                self.insert_above_draft(request_id, f"System: {text}\n", "system")
+            else:
+                self.append_message(text, "system")
+            return
+        if kind == "compare_result":
+            window = self.comparisons.get(request_id)
+            if window is not None:
+                window.show_run(text)
+            return
+        self.comparisons.pop(request_id, None)
+        
+        started_at = self.pending_queries.pop(request_id, None)
+        generation_time = time.time() - started_at if started_at is not None else None
+        if kind == "answer":
+            if request_id in self.drafts:
+                self.promote_draft(request_id)
+            if request_id in self.streams:
+                self.end_assistant_stream(request_id, text, generation_time)
+            else:
+                self.remove_thinking_message()
+                self.append_message(text, "assistant", generation_time=generation_time)
+            return
+        
+        # Errors and system messages (e.g. weather) finish the request
+        if request_id in self.drafts:
+            # Leave the draft up, still marked as one, above the error
+            renderer, _ = self.drafts.pop(request_id)
+            self.chat_display.configure(state=tk.NORMAL)
+            renderer.finish([("\n", ())])
+            self.chat_display.configure(state=tk.DISABLED)
+            self.forget_draft_marks(request_id)
+        if request_id in self.streams:
+            # Close the partially streamed answer before the error is shown
+            self.end_assistant_stream(request_id, "".join(self.streams[request_id][1]))
+        if started_at is not None:
+            self.remove_thinking_message()
+        self.append_message(text, kind)
+
+    def begin_assistant_stream(self, request_id):
+        """Replace the thinking message with an assistant message that streamed chunks render into"""
+        self.remove_thinking_message()
+        self.chat_display.configure(state=tk.NORMAL)
+        self.chat_display.insert(tk.END, "Assistant: ", "assistant")
+        self.streams[request_id] = (MarkdownStreamRenderer(self.chat_display), [])
+        self.chat_display.configure(state=tk.DISABLED)
+
+    def begin_draft(self, request_id):
+        """Replace the thinking message with a draft answer from the local model, shown until the grounded one arrives"""
+        self.remove_thinking_message()
+        self.chat_display.configure(state=tk.NORMAL)
+        # Marks of left gravity stay put while the draft is appended after them
+        self.chat_display.mark_set(f"draft_start_{request_id}", "end-1c")
+        self.chat_display.mark_gravity(f"draft_start_{request_id}", tk.LEFT)
+        self.chat_display.insert(tk.END, "Assistant: ", "assistant")
+        self.chat_display.insert(tk.END, "(draft, checking the web) ", "thinking")
+        self.chat_display.mark_set(f"draft_body_{request_id}", "end-1c")
+        self.chat_display.mark_gravity(f"draft_body_{request_id}", tk.LEFT)
+        self.drafts[request_id] = (MarkdownStreamRenderer(self.chat_display), [])
+        self.chat_display.configure(state=tk.DISABLED)
+
+    def append_draft_chunk(self, request_id, text):
+        """Render a streamed chunk of a draft"""
+        renderer, parts = self.drafts[request_id]
+        parts.append(text)
+        self.chat_display.configure(state=tk.NORMAL)
+        renderer.feed(text)
+        self.chat_display.configure(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+
+    def discard_draft(self, request_id):
+        """Remove a draft from the chat; the grounded answer streams in its place"""
+        draft = self.drafts.pop(request_id, None)
+        if draft is None:
+            return
+        renderer, _ = draft
+        self.chat_display.configure(state=tk.NORMAL)
+        renderer.discard(f"draft_start_{request_id}")
+        self.chat_display.configure(state=tk.DISABLED)
+        self.forget_draft_marks(request_id)
+
+    def promote_draft(self, request_id):
+        """Turn a draft into the answer (when the search found nothing to ground a new one in)"""
+        self.streams[request_id] = self.drafts.pop(request_id)
+        self.chat_display.configure(state=tk.NORMAL)
+        self.chat_display.delete(f"draft_start_{request_id} + {len('Assistant: ')}c", f"draft_body_{request_id}")
+        self.chat_display.configure(state=tk.DISABLED)
+        self.forget_draft_marks(request_id)
+
+    def insert_above_draft(self, request_id, line, tag):
+        """Insert a message before a draft, which keeps the draft in one piece so it can be replaced"""
+        mark = f"draft_start_{request_id}"
+        self.chat_display.configure(state=tk.NORMAL)
+        self.chat_display.insert(mark, line, tag)
+        self.chat_display.mark_set(mark, f"{mark} + {len(line)}c")
+        self.chat_display.configure(state=tk.DISABLED)
+
+    def forget_draft_marks(self, request_id):
+        self.chat_display.mark_unset(f"draft_start_{request_id}", f"draft_body_{request_id}")
+
+    def append_stream_chunk(self, request_id, text):
+        """Render a streamed chunk; only the newly arrived text is parsed"""
+        renderer, parts = self.streams[request_id]
+        parts.append(text)
+        self.chat_display.configure(state=tk.NORMAL)
+        renderer.feed(text)
+        self.chat_display.configure(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+
+    def end_assistant_stream(self, request_id, text, generation_time=None):
+        """Finish the streamed message and record the cleaned-up reply"""
+        renderer, _ = self.streams.pop(request_id)
+        trailer = []
+        if generation_time is not None:
+            trailer.append((f" [{generation_time:.2f}s]", "time"))
+        trailer.append(("\n", ()))
+        self.chat_display.configure(state=tk.NORMAL)
+        renderer.finish(trailer)
+        self.chat_display.configure(state=tk.DISABLED)
+        self.chat_display.see(tk.END)
+        self.record_assistant_message(text)
+
     def on_enter_pressed(self, event):
         user_text = self.user_input.get().strip()
         if not user_text:
@@ -417,356 +2205,163 @@ class ChatInterface(tk.Frame):
             self.reset_chat(wipe_all_memory=True)
             self.user_input.delete(0, tk.END)
             return
+        elif user_text.lower().startswith("!compare"):
+            self.compare_models(user_text[len("!compare"):].strip())
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower() in ("!trace on", "!trace off"):
+            self.engine.submit({"type": "trace", "id": next(self.request_ids), "enable": user_text.lower().endswith("on")})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower().startswith("!profile"):
+            count = user_text[len("!profile"):].strip()
+            if count and not count.isdigit():
+                self.append_message("Usage: !profile [number of queries]", "system")
+            else:
+                self.engine.submit({"type": "profile", "id": next(self.request_ids),
+                                    "queries": max(1, int(count)) if count else PROFILE_DEFAULT_QUERIES})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower().startswith("!perf"):
+            self.set_performance_profile(user_text[len("!perf"):].strip().lower())
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower() == "!tune":
+            self.append_message(f"Benchmarking {OLLAMA_MODEL} settings, this takes a few minutes...", "system")
+            self.engine.submit({"type": "tune", "id": next(self.request_ids)})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower() == "!tokens":
+            self.engine.submit({"type": "token_status", "id": next(self.request_ids)})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower().startswith("!logs"):
+            count = user_text[len("!logs"):].strip()
+            if count and not count.isdigit():
+                self.append_message("Usage: !logs [number of lines]", "system")
+            else:
+                self.engine.submit({"type": "logs", "id": next(self.request_ids),
+                                    "count": max(1, int(count)) if count else 20})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower() == "!prefill":
+            self.engine.submit({"type": "prefill_status", "id": next(self.request_ids)})
+            self.user_input.delete(0, tk.END)
+            return
+        elif user_text.lower() == "!docs":
+            self.engine.submit({"type": "docs_status", "id": next(self.request_ids)})
+            self.user_input.delete(0, tk.END)
+            return
             
         self.append_message(user_text, "user")
         self.user_input.delete(0, tk.END)
-        threading.Thread(target=self.process_query, args=(user_text,), daemon=True).start()
+        self.process_query(user_text)
+
+    def on_input_changed(self, event):
+        """Restart the prefill timer on every keystroke, so the prefix is sent once typing pauses"""
+        self.engine.report_input()
+        if not PREFILL_ENABLED or event.keysym == "Return":
+            return
+        if self.prefill_timer is not None:
+            self.after_cancel(self.prefill_timer)
+        self.prefill_timer = self.after(PREFILL_DEBOUNCE_MS, self.prefill_prompt)
+
+    def prefill_prompt(self):
+        """Ask the engine to warm Ollama's prompt cache with the prefix of the query being typed"""
+        self.prefill_timer = None
+        text = self.user_input.get().strip()
+        # Commands never reach the model, and a prefill would queue behind (and slow) an answer being generated
+        if len(text) < PREFILL_MIN_CHARS or text.startswith("!") or self.engine.busy:
+            return
+        self.engine.submit({
+            "type": "prefill",
+            "mode": self.current_mode,
+            # The query's history window will also hold the question, which pushes one older message out
+            "history": self.conversation_history.prompt_lines(CONTEXT_WINDOW - 1),
+            "profile": self.performance_profile
+        })
 
     def toggle_mode(self):
-        """Toggle between LLM and Web Search modes"""
-        self.current_mode = MODE_WEB_SEARCH if self.current_mode == MODE_LLM else MODE_LLM
-        self.mode_button.config(text="Web" if self.current_mode == MODE_WEB_SEARCH else "LLM")
-        self.append_message("system", f"Switched to {self.current_mode.upper()} mode")
-    def perform_web_search(self, query):
-        """Perform a Google search using the Google Custom Search JSON API"""
-        if not GOOGLE_SEARCH_API_KEY or not GOOGLE_SEARCH_ENGINE_ID:
-            return "Error: Google Search API key or Search Engine ID is not configured. Please add your API credentials to the configuration."
-        
-        try:
-            # Prepare the search parameters
-            params = {
-                'key': GOOGLE_SEARCH_API_KEY.strip(),
-                'cx': GOOGLE_SEARCH_ENGINE_ID.strip(),
-                'q': query,
-                'num': 5  # Number of search results to return
-            }
-            
-            search_url = GOOGLE_SEARCH_URL
-            
-            if DEBUG_MODE:
-                print(f"Making Google search request to: {search_url}", flush=True)
-                print(f"Search parameters: key={params['key'][:5]}..., cx={params['cx']}, query={params['q']}", flush=True)
-            
-            # Make the API request
-            response = requests.get(search_url, params=params)
-            
-            if DEBUG_MODE:
-                print(f"Search response status code: {response.status_code}", flush=True)
-            
-            response.raise_for_status()
-            search_results = response.json()
-            
-            if DEBUG_MODE:
-                print(f"Search response keys: {list(search_results.keys())}", flush=True)
-                if 'error' in search_results:
-                    print(f"API Error: {search_results['error']}", flush=True)
-            
-            if 'items' not in search_results:
-                error_msg = "No results found for your query."
-                if 'error' in search_results:
-                    error_msg += f" Error: {search_results['error'].get('message', '')}"
-                elif 'searchInformation' in search_results:
-                    total_results = search_results['searchInformation'].get('totalResults', '0')
-                    error_msg += f" Total results: {total_results}"
-                return error_msg
-            
-            # Format the search results
-            formatted_results = ""
-            for i, item in enumerate(search_results['items'], 1):
-                formatted_results += f"{i}. {item['title']}\n"
-                formatted_results += f"   {item['link']}\n"
-                if 'snippet' in item:
-                    formatted_results += f"   {item['snippet']}\n"
-                formatted_results += "\n"
-            
-            return formatted_results
-        
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Google Search API error: {e}", flush=True)
-                import traceback
-                traceback.print_exc()
-            return f"Error performing web search: {str(e)}"
+        """Cycle between LLM, Web Search, Auto and (when DOCS_FOLDER is set) Docs modes"""
+        modes = [MODE_LLM, MODE_WEB_SEARCH, MODE_AUTO] + ([MODE_DOCS] if DOCS_FOLDER else [])
+        self.current_mode = modes[(modes.index(self.current_mode) + 1) % len(modes)]
+        self.update_mode_button()
+        message = f"Switched to {self.MODE_LABELS[self.current_mode]} mode"
+        if self.current_mode == MODE_AUTO:
+            message += " (searching the web only when a question needs it)"
+        if self.current_mode in (MODE_WEB_SEARCH, MODE_AUTO) and self.search_quota is not None:
+            message += f" ({self.search_quota['remaining']} of {self.search_quota['limit']} searches left today)"
+        self.append_message(message, "system")
+
+    def update_mode_button(self):
+        """Show the current mode, and the remaining search quota in Web mode"""
+        label = self.MODE_LABELS[self.current_mode]
+        if self.current_mode in (MODE_WEB_SEARCH, MODE_AUTO) and self.search_quota is not None:
+            label += f" ({self.search_quota['remaining']})"
+        self.mode_button.config(text=label)
 
     def process_query(self, user_prompt):
+        """Hand a query to the engine; the answer arrives through handle_engine_event"""
         self.append_message("Thinking...", "thinking")
-        
-        try:
-            # Choose processing method based on current mode
-            if self.current_mode == MODE_WEB_SEARCH:
-                return self.process_web_search_query(user_prompt)
-            else:
-                return self.process_llm_query(user_prompt)
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Query processing unexpected error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            self.chat_display.configure(state=tk.NORMAL)
+        request_id = next(self.request_ids)
+        self.pending_queries[request_id] = self.response_start_time
+        self.engine.submit({
+            "type": "query",
+            "id": request_id,
+            "prompt": user_prompt,
+            "mode": self.current_mode,
+            "history": self.conversation_history.prompt_lines(CONTEXT_WINDOW),
+            "started_at": self.response_start_time,
+            "deadline": self.response_start_time + QUERY_DEADLINE,
+            "profile": self.performance_profile
+        })
 
-    def process_web_search_query(self, user_prompt):
-        """Process a query using web search and then use the LLM to formulate an answer"""
-        try:
-            # First, get web search results
-            api_start_time = time.time()
-            search_results_raw = self.perform_web_search(user_prompt)
-            search_time = time.time() - api_start_time
-            
-            if DEBUG_MODE:
-                print(f"Web search time: {search_time:.3f}s", flush=True)
-            
-            # Check if we got an error from the search API
-            if search_results_raw.startswith("Error") or search_results_raw.startswith("No results"):
-                total_generation_time = time.time() - self.response_start_time
-                # Remove only the thinking message
-                self.remove_thinking_message()
-                self.append_message(search_results_raw, "error", generation_time=total_generation_time)
-                return
-            
-            # Now, use the LLM to process these results and generate a comprehensive answer
-            # Build context with search results
-            context = [f"System: {SYSTEM_PROMPT}"]
-            context.append("System: You have access to web search results. Use the information from these results to provide a comprehensive answer.")
-            context.append(f"System: Web search results for query: '{user_prompt}'\n{search_results_raw}")
-            
-            # Add conversation history for context
-            context += [
-                f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
-                for msg in self.conversation_history[-CONTEXT_WINDOW:]
-            ]
-            
-            # Create a prompt for the LLM that includes the web search results
-            full_prompt = "\n".join(context) + f"\nUser: {user_prompt}\nAssistant: "
-            
-            payload = {
-                "model": OLLAMA_MODEL,
-                "prompt": full_prompt,
-                "stream": False
-            }
-            
-            if DEBUG_MODE:
-                print(f"Sending LLM request with web search results...", flush=True)
-            
-            # Get LLM response
-            llm_start_time = time.time()
-            response = requests.post(OLLAMA_URL, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            llm_time = time.time() - llm_start_time
-            
-            # Calculate total generation time
-            total_generation_time = time.time() - self.response_start_time
-            
-            if DEBUG_MODE:
-                print(f"Web search time: {search_time:.3f}s", flush=True)
-                print(f"LLM processing time: {llm_time:.3f}s", flush=True)
-                print(f"Total generation time: {total_generation_time:.3f}s", flush=True)
-            
-            assistant_response = result.get('response', 'Sorry, I could not generate a response based on the search results.')
-            
-            # Clean up the response
-            if "<think>" in assistant_response:
-                assistant_response = assistant_response.split("</think>")[-1].strip()
-            if "[Focus on current question only]" in assistant_response:
-                assistant_response = assistant_response.replace("[Focus on current question only]", "").strip()
-            
-            # Update the display - delete only the thinking message
-            self.remove_thinking_message()
-            self.append_message(assistant_response, "assistant", generation_time=total_generation_time)
-            
-        except requests.exceptions.ConnectionError as e:
-            if DEBUG_MODE:
-                print(f"LLM API connection error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message("Error: Could not connect to Ollama server. Is it running at http://localhost:11434?", "error")
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Web search + LLM error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message(f"Error processing web search results: {str(e)}", "error")
+    def set_performance_profile(self, name):
+        """Switch the Ollama performance profile used for the next queries"""
+        available = load_profiles(OLLAMA_PROFILES, OLLAMA_TUNED_FILE, OLLAMA_MODEL)
+        if name == TUNED_PROFILE and name not in available:
+            self.append_message(f"There is no '{TUNED_PROFILE}' profile for {OLLAMA_MODEL} yet. "
+                                f"Run !tune first to create it.", "system")
+            return
+        if name not in available:
+            hint = "" if TUNED_PROFILE in available else f" (run !tune to create '{TUNED_PROFILE}')"
+            self.append_message(f"Performance profile: {self.performance_profile}. "
+                                f"Available: {', '.join(available)}{hint}", "system")
+            return
+        self.performance_profile = name
+        self.append_message(f"Switched to the '{name}' performance profile", "system")
 
-    def process_llm_query(self, user_prompt):
-        """Process a query using the local LLM"""
-        try:
-            # Build context with more history for better memory
-            context = [f"System: {SYSTEM_PROMPT}"]
-            context += [
-                f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
-                for msg in self.conversation_history[-CONTEXT_WINDOW:]
-            ]
-            
-            # Create a prompt that includes conversation history
-            full_prompt = "\n".join(context) + f"\nUser: {user_prompt}"
-            
-            payload = {
-                "model": OLLAMA_MODEL,
-                "prompt": full_prompt,
-                "stream": False
-            }
-            
-            if DEBUG_MODE:
-                print(f"Sending query request: {payload['prompt'][:50]}...", flush=True)
-            
-            # Get API response time
-            api_start_time = time.time()
-            response = requests.post(OLLAMA_URL, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            api_time = time.time() - api_start_time
-            
-            # Calculate total generation time (from user input to response)
-            total_generation_time = time.time() - self.response_start_time
-            
-            if DEBUG_MODE:
-                print(f"API call time: {api_time:.3f}s", flush=True)
-                print(f"Total generation time: {total_generation_time:.3f}s", flush=True)
-                print(f"Query API response: {result}", flush=True)
-                
-            assistant_response = result.get('response', 'Sorry, I could not generate a response.')
-            
-            if "<think>" in assistant_response:
-                assistant_response = assistant_response.split("</think>")[-1].strip()
-            if "[Focus on current question only]" in assistant_response:
-                assistant_response = assistant_response.replace("[Focus on current question only]", "").strip()
-                
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message(assistant_response, "assistant", generation_time=total_generation_time)
-        except requests.exceptions.ConnectionError as e:
-            if DEBUG_MODE:
-                print(f"Query API connection error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message("Error: Could not connect to Ollama server. Is it running at http://localhost:11434?", "error")
-        except requests.exceptions.HTTPError as e:
-            if DEBUG_MODE:
-                print(f"Query API HTTP error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message(f"Error: HTTP error from Ollama server: {str(e)}", "error")
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Query API unexpected error: {e}", flush=True)
-            total_time = time.time() - self.response_start_time
-            # Use the improved remove_thinking_message method instead of line-based deletion
-            self.remove_thinking_message()
-            self.append_message(f"Error: {str(e)}", "error")
+    def compare_models(self, prompt):
+        """Run the prompt on every model in COMPARE_MODELS and show the answers side by side"""
+        if not prompt:
+            self.append_message("Usage: !compare <prompt>", "system")
+            return
+        request_id = next(self.request_ids)
+        self.comparisons[request_id] = ComparisonWindow(self, prompt, COMPARE_MODELS)
+        mode = "at once" if COMPARE_CONCURRENT else "one after another"
+        self.append_message(f"Comparing {', '.join(COMPARE_MODELS)} {mode}...", "system")
+        self.engine.submit({"type": "compare", "id": request_id, "prompt": prompt})
 
     def save_memory(self):
-        """Save conversation history to a file, filtering out trivial messages"""
-        try:
-            # Skip saving if conversation is too short and not important
-            if len(self.conversation_history) < 3 and not self.important_conversation:
-                if DEBUG_MODE:
-                    print("Skipping memory save - conversation too short", flush=True)
-                return
-                
-            # Filter out short/trivial messages
-            filtered_history = []
-            for msg in self.conversation_history:
-                # Always keep system messages
-                if msg.get("role") == "system":
-                    filtered_history.append(msg)
-                # Filter user and assistant messages by length and content
-                elif len(msg.get("content", "")) > MIN_MESSAGE_LENGTH:
-                    filtered_history.append(msg)
-            
-            # Skip saving if filtered conversation is empty
-            if not filtered_history:
-                if DEBUG_MODE:
-                    print("Skipping memory save - no significant messages", flush=True)
-                return
-                
-            # Load existing memory file if it exists
-            memory_data = {}
-            if os.path.exists(MEMORY_FILE):
-                with open(MEMORY_FILE, 'r') as f:
-                    memory_data = json.load(f)
-            
-            # Add or update current conversation
-            memory_data[self.conversation_id] = {
-                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                'important': self.important_conversation,
-                'messages': filtered_history[-MEMORY_MAX_MESSAGES:] if filtered_history else []
-            }
-            
-            # Keep important conversations and most recent ones
-            if len(memory_data) > MEMORY_MAX_CONVERSATIONS:
-                # First prioritize important conversations
-                important_convs = {k: v for k, v in memory_data.items() if v.get('important', False)}
-                regular_convs = {k: v for k, v in memory_data.items() if not v.get('important', False)}
-                
-                # If we have too many important conversations, keep the most recent ones
-                if len(important_convs) > MEMORY_MAX_CONVERSATIONS:
-                    sorted_important = sorted(important_convs.items(), key=lambda x: x[1]['timestamp'])
-                    important_convs = dict(sorted_important[-MEMORY_MAX_CONVERSATIONS:])
-                    memory_data = important_convs
-                else:
-                    # Fill remaining slots with most recent regular conversations
-                    slots_left = MEMORY_MAX_CONVERSATIONS - len(important_convs)
-                    if slots_left > 0 and regular_convs:
-                        sorted_regular = sorted(regular_convs.items(), key=lambda x: x[1]['timestamp'])
-                        regular_convs = dict(sorted_regular[-slots_left:])
-                        memory_data = {**important_convs, **regular_convs}
-                    else:
-                        memory_data = important_convs
-            
-            # Save to file
-            with open(MEMORY_FILE, 'w') as f:
-                json.dump(memory_data, f, indent=2)
-                
-            if DEBUG_MODE:
-                print(f"Saved conversation to memory file with {len(filtered_history)} messages", flush=True)
-                
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Error saving memory: {e}", flush=True)
-    
-    def load_memory(self):
-        """Load conversation history from file"""
-        try:
-            if os.path.exists(MEMORY_FILE):
-                with open(MEMORY_FILE, 'r') as f:
-                    memory_data = json.load(f)
-                    
-                # Count messages in memory for debugging
-                total_messages = sum(len(conv.get('messages', [])) for conv in memory_data.values())
-                important_convs = sum(1 for conv in memory_data.values() if conv.get('important', False))
-                    
-                if DEBUG_MODE:
-                    print(f"Loaded {len(memory_data)} conversations from memory", flush=True)
-                    print(f"  - {total_messages} total messages", flush=True)
-                    print(f"  - {important_convs} important conversations", flush=True)
-            else:
-                if DEBUG_MODE:
-                    print("No memory file found, starting fresh", flush=True)
-        except Exception as e:
-            if DEBUG_MODE:
-                print(f"Error loading memory: {e}", flush=True)
+        """Hand the current conversation to the engine to be saved to the memory file"""
+        self.engine.submit({
+            "type": "save_memory",
+            "conversation_id": self.conversation_id,
+            "important": self.important_conversation,
+            "messages": [msg.to_dict() for msg in self.conversation_history]
+        })
     
     def reset_chat(self, wipe_all_memory=True):
         # Wipe all stored conversations if requested
         if wipe_all_memory:
-            try:
-                if os.path.exists(MEMORY_FILE):
-                    os.remove(MEMORY_FILE)
-                    if DEBUG_MODE:
-                        print("Wiped all stored conversations from memory file", flush=True)
-            except Exception as e:
-                if DEBUG_MODE:
-                    print(f"Error wiping memory file: {e}", flush=True)
+            self.engine.submit({"type": "wipe_memory"})
         # Otherwise save current conversation if it's important or substantial
         elif self.conversation_history and (self.important_conversation or len(self.conversation_history) > 3):
             self.save_memory()
             
         # Create a new conversation ID
-        self.conversation_id = datetime.now().strftime("%Y%m%d%H%M%S")
-        self.conversation_history = []
+        self.conversation_id = self.new_conversation_id()
+        self.conversation_history.clear()
         self.important_conversation = False
         self.message_count_since_save = 0
         
@@ -776,57 +2371,115 @@ class ChatInterface(tk.Frame):
         self.append_message("Chat has been reset and all memory has been wiped. How can I help you?", "system")
         self.user_input.focus_set()
 
+    def new_conversation_id(self):
+        """Memory id of a new conversation; tabs opened in the same second get distinct ids"""
+        conversation_id = datetime.now().strftime("%Y%m%d%H%M%S")
+        if self.session_number > 1:
+            conversation_id += f"-{self.session_number}"
+        return conversation_id
+
     def handle_weather_command(self, command):
-        """Handle the weather command and return current weather conditions"""
-        try:
-            # Use default location coordinates
-            location = DEFAULT_LOCATION
-            location_name = DEFAULT_CITY
-            
-            # TODO: Add geocoding support for custom locations
-            if len(command.split()) > 1:
-                location_name = " ".join(command.split()[1:])
-            
-            # Make API request
-            params = {
-                'apikey': TOMORROW_API_KEY,
-                'location': f"{location['lat']},{location['lon']}",
-                'units': 'metric'
-            }
-            
-            if DEBUG_MODE:
-                print(f"Fetching weather for {location_name}...", flush=True)
-                
-            response = requests.get(TOMORROW_URL, params=params)
-            response.raise_for_status()
-            weather_data = response.json()
-            
-            # Format weather information
-            data = weather_data['data']['values']
-            temp = data['temperature']
-            feels_like = data['temperatureApparent']
-            humidity = data['humidity']
-            cloud_cover = data['cloudCover']
-            wind_speed = data['windSpeed']
-            conditions = self.get_weather_condition(cloud_cover)
-            
-            weather_message = (
-                f"📍 Weather in {location_name}\n"
-                f"🌡️ Temperature: {temp}°C\n"
-                f"🤔 Feels like: {feels_like}°C\n"
-                f"💧 Humidity: {humidity}%\n"
-                f"🌤️ Conditions: {conditions}\n"
-                f"💨 Wind Speed: {wind_speed} m/s"
-            )
-            
-            self.append_message(weather_message, "system")
-            
-        except requests.exceptions.RequestException as e:
-            self.append_message(f"Error fetching weather data: {str(e)}", "error")
-        except KeyError as e:
-            self.append_message(f"Error parsing weather data: {str(e)}", "error")
-        except Exception as e:
-            self.append_message(f"Unexpected error: {str(e)}", "error")
+        """Ask the engine for current weather conditions; the report arrives as a system message"""
+        self.engine.submit({
+            "type": "weather",
+            "id": next(self.request_ids),
+            "command": command,
+            "deadline": time.time() + QUERY_DEADLINE
+        })
+
+    def shutdown(self):
+        """Save memory and stop the engine before the window closes"""
+        self.save_memory()
+        self.engine.close()
+
+class ChatSessions(tk.Frame):
+    """
+    Tabs of independent chat sessions sharing one query engine.
+    
+    Each tab is a ChatInterface with its own history, mode and memory id. All of
+    them submit to the same EngineRouter, so a slow answer in one tab does not
+    hold up searches or cached answers in another. Ctrl+T opens a tab, Ctrl+W
+    closes one, and Ctrl+Tab switches between them.
+    """
+    def __init__(self, parent, toggle_theme_callback):
+        super().__init__(parent, bg=CURRENT_THEME['bg'])
+        self.toggle_theme_callback = toggle_theme_callback
+        self.router = EngineRouter()
+        self.session_numbers = itertools.count(1)
+        self.style = ttk.Style()
+        self.notebook = ttk.Notebook(self, style="Chat.TNotebook")
+        self.notebook.pack(fill=tk.BOTH, expand=True)
+        self.notebook.enable_traversal()  # Ctrl+Tab / Ctrl+Shift+Tab
+        self.notebook.bind("<<NotebookTabChanged>>", self.on_tab_changed)
+        self.new_button = tk.Button(
+            self,
+            text="+",
+            command=self.new_session,
+            bg=CURRENT_THEME['button_bg'],
+            fg=CURRENT_THEME['text'],
+            font=("Segoe UI", 9),
+            relief=tk.FLAT,
+            bd=0,
+            padx=6,
+            cursor="hand2"
+        )
+        self.new_button.place(relx=1.0, x=-4, y=2, anchor="ne")
+        parent.bind("<Control-t>", self.new_session)
+        parent.bind("<Control-w>", self.close_session)
+        self.apply_theme()
+        self.new_session()
+
+    @property
+    def sessions(self):
+        return [self.notebook.nametowidget(tab) for tab in self.notebook.tabs()]
+
+    @property
+    def current(self):
+        return self.notebook.nametowidget(self.notebook.select())
+
+    def new_session(self, event=None):
+        """Open a new chat tab"""
+        if len(self.notebook.tabs()) >= MAX_CHAT_SESSIONS:
+            self.current.append_message(f"At most {MAX_CHAT_SESSIONS} chats can be open at once.", "system")
+            return "break"
+        number = next(self.session_numbers)
+        chat = ChatInterface(self.notebook, self.toggle_theme_callback,
+                             engine=self.router.session(), session_number=number)
+        self.notebook.add(chat, text=f"Chat {number}")
+        self.notebook.select(chat)
+        return "break"
+
+    def close_session(self, event=None):
+        """Close the current tab, saving its conversation; the last tab stays open"""
+        if len(self.notebook.tabs()) <= 1:
+            return "break"
+        chat = self.current
+        self.notebook.forget(chat)
+        chat.shutdown()
+        chat.destroy()
+        return "break"
+
+    def on_tab_changed(self, event):
+        chat = self.current
+        self.router.focused = chat.engine
+        chat.user_input.focus_set()
+
+    def apply_theme(self):
+        self.config(bg=CURRENT_THEME['bg'])
+        self.style.configure("Chat.TNotebook", background=CURRENT_THEME['bg'], borderwidth=0)
+        self.style.configure("Chat.TNotebook.Tab", background=CURRENT_THEME['button_bg'],
+                             foreground=CURRENT_THEME['text'], padding=(10, 2))
+        self.style.map("Chat.TNotebook.Tab", background=[("selected", CURRENT_THEME['accent'])])
+        self.new_button.config(bg=CURRENT_THEME['button_bg'], fg=CURRENT_THEME['text'],
+                               activebackground=CURRENT_THEME['button_hover'])
+        for chat in self.sessions:
+            chat.apply_theme()
+
+    def shutdown(self):
+        """Save every session and stop the shared engine"""
+        for chat in self.sessions:
+            chat.shutdown()
+        self.router.close()
 
 class AssistantApp:
     def __init__(self, root):
@@ -854,7 +2507,7 @@ class AssistantApp:
         self.win.configure(bg=CURRENT_THEME['bg'])
         self.welcome_screen = WelcomeScreen(self.win, self.show_chat)
         self.welcome_screen.pack(fill=tk.BOTH, expand=True)
-        self.chat_interface = ChatInterface(self.win, self.toggle_theme) # Pass toggle_theme callback
+        self.chat_sessions = ChatSessions(self.win, self.toggle_theme) # Pass toggle_theme callback
         
         # Set up window close handler to save memory
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
@@ -863,6 +2516,11 @@ class AssistantApp:
         threading.Thread(target=self.hotkey_listener, daemon=True).start()
         self.hide_window()
 
+    @property
+    def chat_interface(self):
+        """The chat session in the selected tab"""
+        return self.chat_sessions.current
+
     def move_window(self, dx, dy):
         x = self.win.winfo_x() + dx
         y = self.win.winfo_y() + dy
@@ -870,12 +2528,14 @@ class AssistantApp:
 
     def show_chat(self):
         self.welcome_screen.pack_forget()
-        self.chat_interface.pack(fill=tk.BOTH, expand=True)
+        self.chat_sessions.pack(fill=tk.BOTH, expand=True)
 
     def hide_window(self):
         self.win.withdraw()
+        self.chat_sessions.router.report_ui_state(hidden=True)
 
     def show_window(self):
+        self.chat_sessions.router.report_ui_state(hidden=False)
         self.win.deiconify()
         self.win.lift()
         self.win.focus_force()
@@ -891,12 +2551,10 @@ class AssistantApp:
         self.win.configure(bg=CURRENT_THEME['bg'])
         if self.welcome_screen.winfo_ismapped(): # Apply to welcome screen if visible
             self.welcome_screen.apply_theme()
-        if self.chat_interface.winfo_ismapped(): # Apply to chat interface if visible
-            self.chat_interface.apply_theme()
         # If one is packed, the other might need an update too for when it's shown next
         # Or, ensure apply_theme is called in show_chat / when welcome screen is shown
         self.welcome_screen.apply_theme() # Apply theme regardless of visibility
-        self.chat_interface.apply_theme() # Apply theme regardless of visibility
+        self.chat_sessions.apply_theme() # Every tab, visible or not
 
     def toggle_window(self):
         if self.win.winfo_ismapped():
@@ -931,21 +2589,26 @@ class AssistantApp:
 
     def on_close(self):
         """Handle window closing - save memory before exit"""
-        if hasattr(self, 'chat_interface'):
-            self.chat_interface.save_memory()
+        if hasattr(self, 'chat_sessions'):
+            self.chat_sessions.shutdown()
         self.root.destroy()
 
-if __name__ == "__main__":
-    if DEBUG_MODE:
-        print(f"Starting Lyro AI with memory...", flush=True)
-        print(f"Memory file: {MEMORY_FILE}", flush=True)
+def main():
+    """Start the assistant window (also used by apply_chat_fix.py)"""
+    configure_logging()
+    log.info("Starting Lyro AI with memory...")
+    log.info("Memory file: %s", MEMORY_FILE)
     
     # Test Google Search API connection
     google_api_working = test_google_search_api()
-    if not google_api_working and DEBUG_MODE:
-        print("Warning: Google Search API test failed. Web search mode may not work correctly.", flush=True)
-        print("Please check your API key and Search Engine ID.", flush=True)
+    if not google_api_working:
+        log.warning("Google Search API is not configured. Web search mode will not work. "
+                    "Please check your API key and Search Engine ID.")
     
     root = tk.Tk()
     app = AssistantApp(root)
     root.mainloop()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
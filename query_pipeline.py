@@ -0,0 +1,172 @@
+"""
+This module contains the staged pipeline every query is answered through.
+
+A pipeline is an ordered list of named stages (retrieve, search, compress,
+prompt, generate, post_process, render, ...). A stage is a function of the
+QueryContext whose return value later stages read as context[name], and it
+lists the stages it needs. Stages whose inputs are ready run at the same time
+on a thread pool, everything else waits. Each stage is timed, and a stage with
+a cache_key is skipped when a fresh result for the same key is in the
+StageCache. A stage ends the query early, for example with a cached answer or
+an error, by raising QueryFinished.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import FIRST_COMPLETED, wait
+
+class QueryFinished(Exception):
+    """Raised by a stage to finish the query with an event instead of running the remaining stages"""
+
+    def __init__(self, kind, text):
+        super().__init__(text)
+        self.kind = kind
+        self.text = text
+
+# cache_key(context) returns a hashable key for the stage's inputs, or None to skip the cache
+Stage = namedtuple("Stage", ["name", "run", "needs", "cache_key", "ttl"], defaults=((), None, None))
+
+class StageCache:
+    """Bounded LRU of stage results, each kept for its stage's ttl"""
+
+    def __init__(self, capacity=256):
+        self.capacity = capacity
+        self._entries = OrderedDict()  # (stage name, key) -> (expires at, value)
+        self._lock = threading.Lock()
+
+    def get(self, name, key):
+        """Return (True, value) for a fresh entry, otherwise (False, None)"""
+        with self._lock:
+            entry = self._entries.get((name, key))
+            if entry is None:
+                return False, None
+            if entry[0] is not None and entry[0] < time.time():
+                del self._entries[(name, key)]
+                return False, None
+            self._entries.move_to_end((name, key))
+            return True, entry[1]
+
+    def put(self, name, key, value, ttl=None):
+        with self._lock:
+            self._entries[(name, key)] = (time.time() + ttl if ttl else None, value)
+            self._entries.move_to_end((name, key))
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+class QueryContext:
+    """State of one query passed through a pipeline: the request, stage results and timings"""
+
+    def __init__(self, request, deadline):
+        self.request = request
+        self.deadline = deadline
+        self.values = {}
+        self.timings = {}   # Stage name -> seconds
+        self.cached = set() # Stages answered from the StageCache
+        self.stats = {}     # Free-form numbers stages report for the debug output
+        self._signals = {}  # Name -> threading.Event stages running side by side signal each other with
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def signal(self, name, factory=threading.Event):
+        """The threading.Event named name, created with factory on first use by whichever stage asks first"""
+        with self._lock:
+            if name not in self._signals:
+                self._signals[name] = factory()
+            return self._signals[name]
+
+    def wait(self, name, timeout=None):
+        """
+        Block until stage name has finished and return its value (None if it
+        failed or the timeout passed). For a stage that only needs another
+        stage's result in some cases, so it does not list it in needs.
+        """
+        self.signal(f"finished {name}").wait(timeout)
+        return self.values.get(name)
+
+class Pipeline:
+    """
+    A named set of stages run in dependency order.
+
+    error_message is the prefix of the error shown when a stage fails unexpectedly.
+    """
+
+    def __init__(self, name, stages, error_message="Error"):
+        seen = set()
+        for stage in stages:
+            missing = [need for need in stage.needs if need not in seen]
+            if missing:
+                # Requiring stages to be listed after their inputs also rules out cycles
+                raise ValueError(f"stage '{stage.name}' needs {missing}, which must be listed before it")
+            seen.add(stage.name)
+        self.name = name
+        self.stages = list(stages)
+        self.error_message = error_message
+
+    def run(self, context, executor, cache=None):
+        """
+        Run every stage for context; stage results end up in context.values.
+
+        When a single stage is ready it runs on the calling thread (so the query
+        profiler sees it); when several are, all but one go to executor. Raises
+        whatever a stage raises, including QueryFinished.
+        """
+        pending = list(self.stages)
+        running = {}  # Future -> stage
+        try:
+            while pending or running:
+                ready = [stage for stage in pending if all(need in context.values for need in stage.needs)]
+                for stage in ready:
+                    pending.remove(stage)
+                if ready:
+                    for stage in ready[1:]:
+                        running[executor.submit(self._run_stage, stage, context, cache)] = stage
+                    context.values[ready[0].name] = self._run_stage(ready[0], context, cache)
+                if running and not any(all(need in context.values for need in stage.needs) for stage in pending):
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        context.values[running.pop(future).name] = future.result()
+                elif not ready and not running:
+                    raise RuntimeError(f"pipeline '{self.name}' is stuck; stages {[s.name for s in pending]} can never run")
+        finally:
+            for future in running:
+                future.cancel()
+
+    @staticmethod
+    def _run_stage(stage, context, cache):
+        context.deadline.check()
+        key = stage.cache_key(context) if cache is not None and stage.cache_key else None
+        if key is not None:
+            hit, value = cache.get(stage.name, key)
+            if hit:
+                context.timings[stage.name] = 0.0
+                context.cached.add(stage.name)
+                context.values[stage.name] = value
+                context.signal(f"finished {stage.name}").set()
+                return value
+        start = time.perf_counter()
+        try:
+            value = stage.run(context)
+            # Right away rather than when run() collects it, for a stage blocked in context.wait()
+            context.values[stage.name] = value
+        finally:
+            context.timings[stage.name] = time.perf_counter() - start
+            context.signal(f"finished {stage.name}").set()
+        if key is not None:
+            cache.put(stage.name, key, value, stage.ttl)
+        return value
+
+def format_timings(context):
+    """One-line summary of the stage timings of a finished (or stopped) query"""
+    parts = [f"{name} {seconds * 1000:.0f}ms" + (" (cached)" if name in context.cached else "")
+             for name, seconds in context.timings.items()]
+    return ", ".join(parts)
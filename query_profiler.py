@@ -0,0 +1,202 @@
+"""
+This module contains the on-demand profiler behind the !profile command.
+
+While active, queries handled by the engine run one at a time under a
+cProfile.Profile, and the stats are merged; a query that arrives while
+another is being profiled runs unprofiled and does not count. Before Python
+3.12 cProfile only sees the thread that enabled it, so stage work the query
+hands to the pool passed through wrap_executor() is profiled on its pool
+thread too. From 3.12 on a single profile sees every thread. tracemalloc
+traces allocations for the whole process, and wall and CPU time are recorded
+for every query thread. After the requested number of queries a text report
+is written and everything is switched off again. When the profiler is not
+active, the only cost per request is reading `active`.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+log = logging.getLogger(__name__)
+
+# Before 3.12 a profile only sees the thread that enabled it; from 3.12 on it
+# sees all threads, and enabling a second one at the same time fails
+_PER_THREAD_PROFILES = sys.version_info < (3, 12)
+
+def _thread_cpu_times():
+    """CPU seconds used so far by every live thread (thread name -> seconds), where the OS supports it"""
+    if not hasattr(time, "pthread_getcpuclockid"):
+        return {}
+    times = {}
+    for thread in threading.enumerate():
+        try:
+            clock = time.pthread_getcpuclockid(thread.ident)
+            times[f"{thread.name} ({thread.ident})"] = time.clock_gettime(clock)
+        except (OSError, TypeError, ValueError):
+            continue
+    return times
+
+class QueryProfiler:
+    """Profile the next N queries and write a report of hot functions, allocations and thread times"""
+
+    TOP_FUNCTIONS = 25
+    TOP_ALLOCATIONS = 20
+
+    def __init__(self, report_dir, on_report=None):
+        self.report_dir = report_dir
+        self.on_report = on_report  # Called with the report path when a run finishes
+        self.active = False
+        self._lock = threading.Lock()
+        self._running = 0
+        self._query_thread = None  # Ident of the thread running the profiled query
+
+    def start(self, queries):
+        """Profile the next `queries` queries; returns False if a profiling run is already going"""
+        with self._lock:
+            if self.active:
+                return False
+            self._remaining = queries
+            self._requested = queries
+            self._running = 0
+            self._stats = None
+            self._query_times = []  # (label, thread name, wall seconds, CPU seconds)
+            self._started_at = time.time()
+            self._cpu_at_start = _thread_cpu_times()
+            self._started_tracing = not tracemalloc.is_tracing()
+            if self._started_tracing:
+                tracemalloc.start(10)
+            tracemalloc.reset_peak()
+            self._baseline = tracemalloc.take_snapshot()
+            self.active = True
+        log.info("Profiling the next %d queries", queries)
+        return True
+
+    def run(self, label, func, *args):
+        """Run func(*args) for one query, profiled if this query is still within the requested count"""
+        with self._lock:
+            # One query at a time, so its profile only holds its own work
+            if not self.active or self._remaining <= 0 or self._running:
+                profiled = False
+            else:
+                profiled = True
+                self._remaining -= 1
+                self._running += 1
+                self._query_thread = threading.get_ident()
+        if not profiled:
+            return func(*args)
+
+        profile = cProfile.Profile()
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        profile.enable()
+        try:
+            return func(*args)
+        finally:
+            profile.disable()
+            wall = time.perf_counter() - wall_start
+            cpu = time.thread_time() - cpu_start
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+                self._query_times.append((label, threading.current_thread().name, wall, cpu))
+                self._running -= 1
+                self._query_thread = None
+                finished = self._remaining <= 0 and self._running == 0
+            if finished:
+                try:
+                    self._finish()
+                except Exception as e:
+                    log.error("Error writing profile report: %s", e)
+                    with self._lock:
+                        self.active = False
+
+    def wrap_executor(self, executor):
+        """An executor like executor whose tasks are profiled when the profiled query submits them"""
+        return ProfiledExecutor(self, executor)
+
+    def _profiled_task(self, func, args, kwargs):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                # Tasks still running when the query ends are left out of the report
+                if self._running:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+
+    def _finish(self):
+        """Write the report, switch profiling off and hand the report path to on_report"""
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracing:
+            tracemalloc.stop()
+        cpu_at_end = _thread_cpu_times()
+        elapsed = time.time() - self._started_at
+
+        out = io.StringIO()
+        out.write(f"Profile of {len(self._query_times)} queries, "
+                  f"{datetime.fromtimestamp(self._started_at):%Y-%m-%d %H:%M:%S}, {elapsed:.1f}s window\n\n")
+
+        out.write("== Queries (wall / CPU time on the query thread) ==\n")
+        for label, thread_name, wall, cpu in self._query_times:
+            out.write(f"{wall:8.3f}s {cpu:8.3f}s  {thread_name:<24} {label}\n")
+        if cpu_at_end:
+            out.write("\n== CPU time per thread during the window ==\n")
+            usage = [(cpu_at_end[name] - self._cpu_at_start.get(name, 0.0), name) for name in cpu_at_end]
+            for seconds, name in sorted(usage, reverse=True):
+                if seconds >= 0.001:
+                    out.write(f"{seconds:8.3f}s  {name}\n")
+
+        # Stage pool work is included; before 3.12, other pools (hedged backend requests) show up as waits on futures
+        for sort_key, title in (("cumulative", "cumulative time"), ("tottime", "own time")):
+            out.write(f"\n== Top {self.TOP_FUNCTIONS} functions by {title} ==\n")
+            if self._stats is not None:
+                self._stats.stream = out
+                self._stats.strip_dirs().sort_stats(sort_key).print_stats(self.TOP_FUNCTIONS)
+
+        out.write(f"\n== Top {self.TOP_ALLOCATIONS} allocation sites by memory retained after the window ==\n")
+        out.write(f"Traced memory: {current / 1024:.0f} KB now, {peak / 1024:.0f} KB peak\n")
+        for diff in snapshot.compare_to(self._baseline, "lineno")[:self.TOP_ALLOCATIONS]:
+            out.write(f"{diff}\n")
+
+        os.makedirs(self.report_dir, exist_ok=True)
+        path = os.path.join(self.report_dir, f"profile_{datetime.now():%Y%m%d_%H%M%S}.txt")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(out.getvalue())
+        with self._lock:
+            self.active = False
+            self._stats = None
+            self._baseline = None
+        log.info("Profile report written to %s", path)
+        if self.on_report:
+            self.on_report(path)
+
+class ProfiledExecutor:
+    """Passes tasks to an executor, profiling those the profiled query submits (before Python 3.12)"""
+
+    def __init__(self, profiler, executor):
+        self.profiler = profiler
+        self.executor = executor
+
+    def submit(self, func, *args, **kwargs):
+        profiler = self.profiler
+        if _PER_THREAD_PROFILES and profiler.active and profiler._query_thread == threading.get_ident():
+            return self.executor.submit(profiler._profiled_task, func, args, kwargs)
+        return self.executor.submit(func, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.executor, name)
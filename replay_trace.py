@@ -0,0 +1,165 @@
+"""
+Replay a recorded session trace against the current code and report latencies.
+
+Record a trace in the assistant with `!trace on` ... `!trace off` (or
+TRACE_ENABLED = True), then run for example:
+
+    python replay_trace.py traces/session_20250101_120000.jsonl.gz --speed 10 --concurrency 4 --save new.json
+    python replay_trace.py traces/session_20250101_120000.jsonl.gz --speed 10 --concurrency 4 --compare new.json
+
+Requests are sent at their recorded times (divided by --speed) and answered by
+the recorded backend responses, which are also sped up. Use --backends stub to
+use synthetic backends instead. The engine runs headless with its state files
+(memory, caches, quota) in a temporary folder, so your real ones are untouched.
+Only compare results taken at the same speed and concurrency.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import personalassistant as assistant
+from session_trace import ReplayAdapter, load_trace, request_latencies
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(latencies):
+    """Per mode (and "all") percentiles of time to first token and total latency"""
+    groups = {}
+    for result in latencies.values():
+        for group in ("all", result["mode"]):
+            groups.setdefault(group, []).append(result)
+    summary = {}
+    for group, results in groups.items():
+        summary[group] = {"count": len(results)}
+        for metric in ("ttft", "total"):
+            values = [r[metric] for r in results if r[metric] is not None]
+            summary[group][metric] = {name: percentile(values, fraction)
+                                      for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))}
+    return summary
+
+def print_summary(summary, title):
+    print(f"\n{title}")
+    print(f"{'mode':<12}{'n':>5}  {'metric':<6}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for group in sorted(summary, key=lambda g: (g != "all", g)):
+        for metric in ("ttft", "total"):
+            stats = summary[group][metric]
+            cells = "".join(f"{stats[name]:9.3f}" if stats[name] is not None else f"{'-':>9}"
+                            for name in ("p50", "p90", "p95", "p99", "max"))
+            print(f"{group:<12}{summary[group]['count']:>5}  {metric:<6}{cells}")
+
+def isolate_state(folder, verbose):
+    """Point the engine's state files at a scratch folder"""
+    assistant.LOG_LEVEL = "DEBUG" if verbose else "WARNING"
+    assistant.LOG_FILE = ""
+    assistant.configure_logging()
+    assistant.TRACE_ENABLED = False
+    assistant.IDLE_JOBS_ENABLED = False  # Maintenance would skew the replayed latencies
+    assistant.MEMORY_FILE = os.path.join(folder, "conversation_memory.json")
+    assistant.SEMANTIC_CACHE_DIR = os.path.join(folder, "semantic_cache")
+    assistant.GEOCODE_CACHE_FILE = os.path.join(folder, "geocode_cache.json")
+    assistant.SEARCH_QUOTA_FILE = os.path.join(folder, "search_quota.json")
+    assistant.SEARCH_RESULT_CACHE_FILE = os.path.join(folder, "search_results_cache.json")
+    assistant.DOCS_INDEX_FILE = os.path.join(folder, "docs_index.pkl")
+
+def replay(records, speed=1.0, concurrency=4, backends="recorded", verbose=False):
+    """Re-run the requests of a trace; returns request_latencies() of the replay"""
+    events = []
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def emit(kind, request_id, text):
+        if request_id is None:
+            return
+        with lock:
+            events.append({"kind": "event", "event": kind, "id": request_id, "t": time.monotonic() - start})
+
+    with tempfile.TemporaryDirectory() as folder:
+        isolate_state(folder, verbose)
+        engine = assistant.QueryEngine(emit)
+        adapter = ReplayAdapter(records if backends == "recorded" else (), speed=speed)
+        engine.http.mount("http://", adapter)
+        engine.http.mount("https://", adapter)
+
+        trace_requests = [r for r in records if r.get("kind") == "request"]
+        first = trace_requests[0]["t"] if trace_requests else 0.0
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for record in trace_requests:
+                # Open loop: requests arrive on schedule even if earlier ones are still running
+                delay = start + (record["t"] - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                now = time.time()
+                request = dict(record["request"], started_at=now, deadline=now + assistant.QUERY_DEADLINE)
+                with lock:
+                    events.append({"kind": "request", "request": request, "t": time.monotonic() - start})
+                pool.submit(engine.handle, request)
+        if adapter.misses:
+            print(f"{adapter.misses} backend calls had no recorded response and were stubbed", file=sys.stderr)
+    return request_latencies(events)
+
+def compare(summary, baseline, max_regression):
+    """Print p50/p95/p99 total latency changes against a baseline; returns False on a p95 regression"""
+    ok = True
+    print(f"\nTotal latency vs baseline (regression threshold {max_regression:.0%} at p95)")
+    for group in sorted(summary, key=lambda g: (g != "all", g)):
+        if group not in baseline:
+            continue
+        cells = []
+        for name in ("p50", "p95", "p99"):
+            new, old = summary[group]["total"][name], baseline[group]["total"][name]
+            if new is None or old is None or old == 0:
+                cells.append(f"{name} -")
+                continue
+            change = (new - old) / old
+            cells.append(f"{name} {old:.3f}s -> {new:.3f}s ({change:+.0%})")
+            if name == "p95" and change > max_regression:
+                ok = False
+                cells[-1] += " REGRESSION"
+        print(f"{group:<12}" + "   ".join(cells))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a session trace and report latency percentiles")
+    parser.add_argument("trace", help="Trace file recorded with !trace on / TRACE_ENABLED")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed-up for arrivals and backend latency (default 1)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum requests processed at once (default 4)")
+    parser.add_argument("--backends", choices=("recorded", "stub"), default="recorded",
+                        help="Serve recorded backend responses or synthetic stubs (default recorded)")
+    parser.add_argument("--save", help="Write the latency summary to this JSON file")
+    parser.add_argument("--compare", help="Compare against a summary saved with --save")
+    parser.add_argument("--max-regression", type=float, default=0.10, help="Allowed p95 increase before failing (default 0.10)")
+    parser.add_argument("--verbose", action="store_true", help="Show the engine's debug log")
+    args = parser.parse_args()
+
+    records = load_trace(args.trace)
+    print_summary(summarize(request_latencies(records)), "Recorded session (1x, original backends)")
+
+    latencies = replay(records, args.speed, args.concurrency, args.backends, args.verbose)
+    summary = summarize(latencies)
+    print_summary(summary, f"Replay ({args.speed:g}x, concurrency {args.concurrency}, {args.backends} backends)")
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"speed": args.speed, "concurrency": args.concurrency, "backends": args.backends,
+                       "summary": summary, "latencies": latencies}, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if (baseline["speed"], baseline["concurrency"], baseline["backends"]) != (args.speed, args.concurrency, args.backends):
+            print("Warning: the baseline was replayed with different settings", file=sys.stderr)
+        if not compare(summary, baseline["summary"], args.max_regression):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+This module contains the extractive compression stage for web search results.
+
+Instead of pasting every title, URL and ragged snippet into the prompt, the
+snippets are split into sentences, scored against the query with BM25,
+near-duplicates are dropped, and only the best sentences that fit the token
+budget are kept. Compact source references go at the end of the block.
+"""
+
+import math
+import re
+import urllib.parse
+
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its "
+    "me my of on or that the this to was were what when where which who why will "
+    "with you your about into than then there these those".split()
+)
+
+_WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+# Google snippets often start with a date ("Mar 3, 2024 ...") and contain ellipses
+_SNIPPET_DATE_RE = re.compile(r"^[A-Z][a-z]{2} \d{1,2}, \d{4}\s*(?:\.\.\.|—|-)?\s*")
+_ELLIPSIS_RE = re.compile(r"\s*(?:\.\.\.|…)\s*")
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token for English text)"""
+    return max(1, len(text) // 4)
+
+def tokenize(text):
+    return [w for w in _WORD_RE.findall(text.lower()) if w not in STOPWORDS]
+
+def _clean_snippet(snippet):
+    snippet = _SNIPPET_DATE_RE.sub("", snippet.replace("\n", " ").strip())
+    return _ELLIPSIS_RE.sub(". ", snippet).strip(" .")
+
+def _split_sentences(text):
+    return [s.strip() for s in _SENTENCE_SPLIT_RE.split(text) if len(s.strip()) > 20]
+
+def _jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def _source_label(item):
+    domain = urllib.parse.urlparse(item.get('link', '')).netloc
+    if domain.startswith("www."):
+        domain = domain[4:]
+    return domain or item.get('title', 'source')
+
+def format_search_results(items):
+    """Format search items verbatim (title, URL, snippet) as the uncompressed context"""
+    formatted_results = ""
+    for i, item in enumerate(items, 1):
+        formatted_results += f"{i}. {item['title']}\n"
+        formatted_results += f"   {item['link']}\n"
+        if 'snippet' in item:
+            formatted_results += f"   {item['snippet']}\n"
+        formatted_results += "\n"
+    return formatted_results
+
+def compress_search_results(query, items, token_budget=350, dedup_threshold=0.6):
+    """
+    Build a compact, query-focused context block from Google Custom Search items.
+
+    Args:
+        query: The user's question
+        items: The 'items' list from the Custom Search JSON response
+        token_budget: Approximate maximum tokens for the selected sentences
+        dedup_threshold: Word-set Jaccard similarity above which a sentence is a near-duplicate
+
+    Returns:
+        The compressed context text, with [n] markers referencing the source list at the end
+    """
+    query_terms = set(tokenize(query))
+
+    # Collect candidate sentences from titles and snippets
+    candidates = []  # (result_index, position, text, terms)
+    for index, item in enumerate(items, 1):
+        sentences = _split_sentences(_clean_snippet(item.get('snippet', '')))
+        title = item.get('title', '').strip()
+        if not sentences and title:
+            sentences = [title]
+        for position, sentence in enumerate(sentences):
+            candidates.append((index, position, sentence, tokenize(sentence)))
+    if not candidates:
+        return ""
+
+    # BM25 over the candidate sentences, with a small prior for higher ranked results
+    doc_freq = {}
+    for _, _, _, terms in candidates:
+        for term in set(terms):
+            doc_freq[term] = doc_freq.get(term, 0) + 1
+    n = len(candidates)
+    avg_len = sum(len(terms) for _, _, _, terms in candidates) / n or 1.0
+    k1, b = 1.2, 0.75
+
+    scored = []
+    for index, position, sentence, terms in candidates:
+        score = 0.0
+        relevant = False
+        length_norm = k1 * (1 - b + b * len(terms) / avg_len)
+        for term in query_terms:
+            tf = terms.count(term)
+            if tf:
+                relevant = True
+                idf = math.log(1 + (n - doc_freq[term] + 0.5) / (doc_freq[term] + 0.5))
+                score += idf * tf * (k1 + 1) / (tf + length_norm)
+        score += 0.1 / index
+        scored.append((score, index, position, sentence, set(terms), relevant))
+    scored.sort(key=lambda c: c[0], reverse=True)
+    # Sentences sharing no term with the query are only kept if nothing matches at all
+    any_relevant = any(c[5] for c in scored)
+
+    # Greedily keep the best non-duplicate sentences within the budget
+    selected = []
+    used_tokens = 0
+    for score, index, position, sentence, term_set, relevant in scored:
+        if any_relevant and not relevant:
+            continue
+        cost = estimate_tokens(sentence)
+        if used_tokens + cost > token_budget:
+            continue
+        if any(_jaccard(term_set, other[4]) >= dedup_threshold for other in selected):
+            continue
+        selected.append((score, index, position, sentence, term_set))
+        used_tokens += cost
+
+    # Present in source order so related sentences read together
+    selected.sort(key=lambda c: (c[1], c[2]))
+    lines = [f"[{index}] {sentence}" for _, index, _, sentence, _ in selected]
+    cited = sorted({index for _, index, _, _, _ in selected})
+    sources = " ".join(f"[{i}] {_source_label(items[i - 1])}" for i in cited)
+    return "\n".join(lines) + f"\nSources: {sources}"
@@ -0,0 +1,212 @@
+"""
+This module contains the quota bookkeeping for the Google Custom Search API.
+
+The API has a hard daily quota (100 free queries, reset at midnight Pacific
+time) and a per-minute rate limit. SearchQuota keeps a persistent daily
+counter so restarts do not forget what was spent, and a token bucket that
+makes bursts of searches wait their turn instead of hitting HTTP 429.
+SearchResultCache keeps recent result lists so repeated or similar questions
+can be answered without spending quota, and so there is something to fall
+back on once the quota is used up.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from search_compress import tokenize
+
+try:
+    from zoneinfo import ZoneInfo
+    _QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+except Exception:  # No tz database available; Pacific standard time is close enough
+    _QUOTA_TIMEZONE = timezone(timedelta(hours=-8))
+
+log = logging.getLogger(__name__)
+
+class SearchQuotaExceeded(Exception):
+    """Raised when a search cannot be sent because of the daily quota or the rate limit"""
+
+def quota_day():
+    """The current quota day; Google resets Custom Search quotas at midnight Pacific time"""
+    return datetime.now(_QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+
+def format_age(seconds):
+    """Human friendly age: '45 seconds', '12 minutes', '3 hours', '2 days'"""
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds >= size:
+            count = int(seconds // size)
+            return f"{count} {unit}{'s' if count != 1 else ''}"
+    return f"{int(seconds)} seconds"
+
+class SearchQuota:
+    """Persistent daily query counter combined with a token bucket rate limiter"""
+
+    def __init__(self, state_file, daily_limit=100, per_minute=60, burst=5, reserve=10):
+        self.state_file = state_file
+        self.daily_limit = daily_limit
+        self.reserve = reserve
+        self._lock = threading.Lock()
+        self._rate = per_minute / 60.0  # Tokens per second
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._day = quota_day()
+        self._used = 0
+        self._load()
+
+    def remaining(self):
+        with self._lock:
+            self._roll_day()
+            return max(0, self.daily_limit - self._used)
+
+    @property
+    def low(self):
+        """True once only the reserve is left"""
+        return self.remaining() <= self.reserve
+
+    def acquire(self, max_wait=10.0):
+        """
+        Reserve one query, waiting for the rate limiter if needed.
+
+        Returns None when the query may be sent, or a short reason why not.
+        Callers queue in the order they arrived: each one takes a token now
+        (possibly driving the bucket negative) and sleeps until it is covered.
+        """
+        with self._lock:
+            self._roll_day()
+            if self._used >= self.daily_limit:
+                return "the daily search quota is used up"
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            wait = (1 - self._tokens) / self._rate if self._tokens < 1 else 0.0
+            if wait > max_wait:
+                return "the search rate limit was reached"
+            self._tokens -= 1
+            self._used += 1
+            self._save()
+        if wait > 0:
+            log.debug("Search rate limiter: waiting %.2fs", wait)
+            time.sleep(wait)
+        return None
+
+    def refund(self, count=1):
+        """Give back reserved queries that never reached Google (the connection could not be made)"""
+        with self._lock:
+            self._used = max(0, self._used - count)
+            self._save()
+
+    def report_rate_limited(self, daily):
+        """Record an HTTP 429 from Google: exhaust the day's quota or empty the bucket for a minute"""
+        with self._lock:
+            if daily:
+                self._used = max(self._used, self.daily_limit)
+                self._save()
+            else:
+                self._tokens = min(self._tokens, 1 - 60 * self._rate)
+                self._updated = time.monotonic()
+        log.warning("Google reported %s exceeded", "daily quota" if daily else "rate limit")
+
+    def _roll_day(self):
+        day = quota_day()
+        if day != self._day:
+            self._day = day
+            self._used = 0
+            self._save()
+
+    def _load(self):
+        if not os.path.exists(self.state_file):
+            return
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("day") == self._day:
+                self._used = int(state.get("used", 0))
+            log.debug("Search quota: %d/%d queries left today", max(0, self.daily_limit - self._used), self.daily_limit)
+        except Exception as e:
+            log.warning("Error loading search quota state: %s", e)
+
+    def _save(self):
+        try:
+            tmp_path = self.state_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"day": self._day, "used": self._used}, f)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            log.warning("Error saving search quota state: %s", e)
+
+class SearchResultCache:
+    """LRU cache of search result items keyed by the query's normalized terms"""
+
+    SIMILARITY_THRESHOLD = 0.6  # Term-set Jaccard similarity for reusing another query's results
+
+    def __init__(self, cache_file, capacity=500):
+        self.cache_file = cache_file
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (timestamp, query, items)
+        self._load()
+
+    @staticmethod
+    def _key(query):
+        return " ".join(sorted(set(tokenize(query))))
+
+    def get(self, query, max_age=None, similar=False):
+        """Return (items, age in seconds, cached query) for the query, or None"""
+        key = self._key(query)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and similar and key:
+                # Fall back to the most similar cached question
+                terms = set(key.split())
+                best_score = 0.0
+                for other_key, other in self._entries.items():
+                    other_terms = set(other_key.split())
+                    score = len(terms & other_terms) / len(terms | other_terms) if other_terms else 0.0
+                    if score > best_score:
+                        best_score, entry = score, other
+                if best_score < self.SIMILARITY_THRESHOLD:
+                    entry = None
+            if entry is None:
+                return None
+            timestamp, cached_query, items = entry
+            if max_age is not None and now - timestamp > max_age:
+                return None
+            self._entries.move_to_end(self._key(cached_query))
+            return items, now - timestamp, cached_query
+
+    def put(self, query, items):
+        key = self._key(query)
+        if not key:
+            return
+        with self._lock:
+            self._entries[key] = (time.time(), query, items)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+            self._save()
+
+    def _load(self):
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                for timestamp, query, items in json.load(f):
+                    self._entries[self._key(query)] = (timestamp, query, items)
+        except Exception as e:
+            log.warning("Error loading search result cache: %s", e)
+
+    def _save(self):
+        try:
+            tmp_path = self.cache_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(list(self._entries.values()), f)
+            os.replace(tmp_path, self.cache_file)
+        except Exception as e:
+            log.warning("Error saving search result cache: %s", e)
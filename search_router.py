@@ -0,0 +1,88 @@
+"""
+This module contains the heuristics Auto mode uses to decide whether a question needs a web search.
+
+route_query() looks for phrases that ask for a search outright ("search
+online", "find links"), for tasks on given text (writing, coding, questions
+about the conversation itself), then for words that make a question time
+sensitive ("latest", "today", "price", a recent year), and last for other
+questions the local model can answer alone: small talk, arithmetic and
+general how/why explanations. Questions that match none of these are left
+undecided, and the caller either asks the model (ROUTER_PROMPT) or falls back
+to searching.
+"""
+
+import re
+from collections import namedtuple
+from datetime import datetime
+
+from turn_template import classify_query
+
+RouteDecision = namedtuple("RouteDecision", ["search", "reason"])
+
+# Phrases, not single words: "online", "links" or "sources" alone also turn up in questions the model can answer
+_EXPLICIT_SEARCH = re.compile(r"\b(search (the (web|internet)|online|for)|google|look (it |this |that )?up|browse the (web|internet)|"
+                              r"(find|check) (it |this |that )?online|on the (web|internet)|"
+                              r"(find|give|send|show|share|with|include|add|post) (me )?(some |the |any )?(links|sources)|"
+                              r"cite (your |the |some )?sources?)\b|https?://|www\.", re.IGNORECASE)
+_TIME_SENSITIVE = re.compile(r"\b(today|tonight|tomorrow|yesterday|this (morning|week|weekend|month|year|season)|"
+                             r"last (night|week|weekend|month)|right now|currently|latest|recent|recently|newest|news|"
+                             r"headlines?|upcoming|scores?|standings|forecast|weather|prices?|stocks?|exchange rate|"
+                             r"release date|released|schedule|election|trending|open now|near me|who won)\b", re.IGNORECASE)
+_YEAR = re.compile(r"\b(19|20)\d\d\b")
+_TASK = re.compile(r"^(please |can you |could you )?(write|draft|rewrite|rephrase|reword|translate|summari[sz]e|fix|debug|"
+                   r"refactor|correct|proofread|convert|calculate|compute|solve|simplify|format|sort|generate|"
+                   r"brainstorm|suggest|continue|make)\b", re.IGNORECASE)
+_CODE = re.compile(r"```|^\s*(def|class|import|from|function|const|let|var|public|#include)\b|[{};]\s*$", re.MULTILINE)
+_ARITHMETIC = re.compile(r"^[\d\s.,+\-*/^%()=x]+\??$")
+_CONVERSATION = re.compile(r"\b(you (just )?said|your (last|previous) (answer|message|reply)|above|earlier|that answer|"
+                           r"this conversation|what did i|i just said|my (last|previous) (question|message))\b",
+                           re.IGNORECASE)
+_EXPLANATION = re.compile(r"^(how (do|does|did|can|could|should|would|to)|why|explain|define|what does .* mean|"
+                          r"what('s| is) the difference|what are the (pros|benefits|advantages|differences))\b",
+                          re.IGNORECASE)
+
+ROUTER_PROMPT = ("System: Decide whether answering the user's question needs a web search for current or specific "
+                 "facts you may not know. Reply with only yes or no.\nUser: {question}\nAssistant:")
+
+def _recent_year(prompt):
+    """A year in the prompt that is recent enough for the model's training data to miss it"""
+    this_year = datetime.now().year
+    return any(int(match.group(0)) >= this_year - 1 for match in _YEAR.finditer(prompt))
+
+def route_query(prompt):
+    """
+    Decide from the wording alone whether prompt needs a web search.
+
+    Returns a RouteDecision whose search is True, False, or None when the
+    wording does not settle it, and a short reason for the log.
+    """
+    text = prompt.strip()
+    if _EXPLICIT_SEARCH.search(text):
+        return RouteDecision(True, "asks for a search or a source")
+    # Tasks and questions about the conversation first: "write a poem about the news" needs no search
+    if _CODE.search(text):
+        return RouteDecision(False, "contains code")
+    if _CONVERSATION.search(text):
+        return RouteDecision(False, "about the conversation")
+    if _TASK.match(text):
+        return RouteDecision(False, "writing or transformation task")
+    if _recent_year(text):
+        return RouteDecision(True, "mentions a recent year")
+    if _TIME_SENSITIVE.search(text):
+        return RouteDecision(True, "time sensitive")
+    if classify_query(text) == "chat":
+        return RouteDecision(False, "small talk")
+    if _ARITHMETIC.match(text):
+        return RouteDecision(False, "arithmetic")
+    if _EXPLANATION.match(text):
+        return RouteDecision(False, "general explanation")
+    return RouteDecision(None, "undecided")
+
+def parse_router_answer(text):
+    """True for a yes, False for a no, None for anything else"""
+    word = text.strip().lstrip("*\"' ").lower()
+    if word.startswith("yes"):
+        return True
+    if word.startswith("no"):
+        return False
+    return None
@@ -0,0 +1,295 @@
+"""
+This module contains the semantic answer cache used by web search mode.
+
+Queries are embedded through Ollama's embeddings endpoint and the unit-length
+vectors are kept in a memory-mapped NumPy matrix next to their grounded answers,
+so a reworded question can reuse a recent answer without another Google call
+or LLM generation.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+import requests
+
+try:
+    import numpy as np
+except ImportError:  # The cache is optional; web search works without it
+    np = None
+
+CacheHit = namedtuple("CacheHit", ["answer", "query", "score", "age"])
+
+log = logging.getLogger(__name__)
+
+class SemanticCache:
+    """
+    Ring buffer of (embedding, query, answer) entries with vectorized top-1 search.
+
+    Vectors live in `vectors.npy` and insertion times in `timestamps.npy`, both
+    opened with numpy.lib.format.open_memmap so the matrix is paged in on demand
+    and survives restarts. Query/answer text is appended to `entries.jsonl`.
+    Rows are written in time order, so the entries inside the freshness window
+    are always the newest contiguous slice of the ring and only that slice is
+    scanned on lookup.
+
+    A full scan of 100k 768-dimensional rows is memory-bandwidth bound (~300MB),
+    so lookups first scan a small random-projection sketch of every row
+    (`sketch.npy`) and only re-score the best SKETCH_CANDIDATES rows against
+    the full vectors.
+    """
+
+    INITIAL_ROWS = 1024
+    SKETCH_DIM = 64
+    SKETCH_CANDIDATES = 64
+    CHECKPOINT_LINES = 500  # Log lines written between checkpoints of an idle-time compaction
+
+    def __init__(self, cache_dir, embed_url, embed_model, threshold=0.92,
+                 max_age=24 * 60 * 60, capacity=100000, session=None):
+        self.cache_dir = cache_dir
+        self.embed_url = embed_url
+        self.embed_model = embed_model
+        self.threshold = threshold
+        self.max_age = max_age
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._sketches = None
+        self._projection = None
+        self._timestamps = None
+        self._entries = {}   # slot -> (query, answer)
+        self._count = 0      # number of filled slots
+        self._next = 0       # next slot to write
+        self._entries_path = os.path.join(cache_dir, "entries.jsonl")
+        self._vectors_path = os.path.join(cache_dir, "vectors.npy")
+        self._sketches_path = os.path.join(cache_dir, "sketch.npy")
+        self._timestamps_path = os.path.join(cache_dir, "timestamps.npy")
+        self._session = session or requests.Session()
+        if self.enabled:
+            self._load()
+
+    @property
+    def enabled(self):
+        return np is not None
+
+    def embed(self, text, timeout=10):
+        """Return the normalized float32 embedding for text, or None on failure"""
+        if not self.enabled:
+            return None
+        try:
+            response = self._session.post(
+                self.embed_url,
+                json={"model": self.embed_model, "prompt": text.strip().lower()},
+                timeout=timeout
+            )
+            response.raise_for_status()
+            vector = np.asarray(response.json()["embedding"], dtype=np.float32)
+        except Exception as e:
+            log.warning("Semantic cache embedding error: %s", e)
+            return None
+        norm = float(np.linalg.norm(vector))
+        if norm == 0.0:
+            return None
+        return vector / norm
+
+    def lookup(self, vector):
+        """Return a CacheHit for the most similar fresh entry above the threshold, or None"""
+        if vector is None:
+            return None
+        with self._lock:
+            if self._vectors is None or self._count == 0 or vector.shape[0] != self._vectors.shape[1]:
+                return None
+            now = time.time()
+            cutoff = now - self.max_age
+            sketch = vector @ self._projection
+            best_slot, best_score = -1, -1.0
+            for start, end in self._fresh_ranges(cutoff):
+                approx = self._sketches[start:end] @ sketch
+                if len(approx) > self.SKETCH_CANDIDATES:
+                    candidates = np.argpartition(approx, -self.SKETCH_CANDIDATES)[-self.SKETCH_CANDIDATES:]
+                    candidates.sort()
+                else:
+                    candidates = np.arange(len(approx))
+                scores = self._vectors[start + candidates] @ vector
+                i = int(np.argmax(scores))
+                if scores[i] > best_score:
+                    best_slot, best_score = start + int(candidates[i]), float(scores[i])
+            if best_slot < 0 or best_score < self.threshold:
+                return None
+            query, answer = self._entries[best_slot]
+            return CacheHit(answer, query, best_score, now - float(self._timestamps[best_slot]))
+
+    def add(self, vector, query, answer):
+        """Store an answer under the query embedding, overwriting the oldest entry when full"""
+        if vector is None:
+            return
+        with self._lock:
+            try:
+                if self._vectors is not None and vector.shape[0] != self._vectors.shape[1]:
+                    # The embedding model changed; old vectors are not comparable
+                    self._reset()
+                if self._vectors is None:
+                    self._create(vector.shape[0], min(self.INITIAL_ROWS, self.capacity))
+                elif self._next >= self._vectors.shape[0] and self._vectors.shape[0] < self.capacity:
+                    self._grow()
+
+                slot = self._next
+                now = time.time()
+                self._vectors[slot] = vector
+                self._sketches[slot] = vector @ self._projection
+                self._timestamps[slot] = now
+                self._entries[slot] = (query, answer)
+                self._count = max(self._count, slot + 1)
+                self._next = (slot + 1) % self.capacity
+                with open(self._entries_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"slot": slot, "query": query, "answer": answer, "time": now}) + "\n")
+
+                # The append-only log keeps superseded lines; rewrite it once it doubles
+                self._log_lines += 1
+                if self._log_lines > 2 * max(self._count, self.INITIAL_ROWS):
+                    self._compact_log()
+            except Exception as e:
+                log.warning("Semantic cache write error: %s", e)
+
+    def compact(self, checkpoint=None):
+        """
+        Rewrite the entries log without superseded lines; returns whether it was rewritten.
+
+        Only copying the entries and swapping the file in hold the lock, so
+        lookups are not held up by the rewrite. checkpoint, if given, is called
+        every CHECKPOINT_LINES lines (see idle_jobs.py). If an answer is added
+        meanwhile, the rewrite is dropped and left for the next call.
+        """
+        with self._lock:
+            if self._vectors is None or self._log_lines <= len(self._entries):
+                return False
+            entries = dict(self._entries)
+            times = np.array(self._timestamps[list(entries)])
+            log_lines = self._log_lines
+        tmp_path = self._entries_path + ".tmp"
+        try:
+            self._write_log(tmp_path, entries, times, checkpoint)
+            with self._lock:
+                if self._log_lines != log_lines or self._vectors is None:
+                    os.remove(tmp_path)
+                    return False
+                self._flush()
+                os.replace(tmp_path, self._entries_path)
+                self._log_lines = len(entries)
+                return True
+        except Exception as e:
+            log.warning("Semantic cache write error: %s", e)
+            return False
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)  # Cancelled or failed part way
+
+    def _fresh_ranges(self, cutoff):
+        """Yield contiguous (start, end) row ranges whose entries are newer than cutoff"""
+        if self._count < self.capacity:
+            segments = [(0, self._count)]
+        else:
+            # Full ring: [next, capacity) holds older rows than [0, next)
+            segments = [(self._next, self.capacity), (0, self._next)]
+        for start, end in segments:
+            first_fresh = start + int(np.searchsorted(self._timestamps[start:end], cutoff))
+            if first_fresh < end:
+                yield first_fresh, end
+
+    def _make_projection(self, dim):
+        # Seeded, so the same projection is rebuilt on every start instead of stored
+        rng = np.random.default_rng(dim)
+        return (rng.standard_normal((dim, self.SKETCH_DIM)) / np.sqrt(self.SKETCH_DIM)).astype(np.float32)
+
+    def _create(self, dim, rows):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._projection = self._make_projection(dim)
+        self._vectors = np.lib.format.open_memmap(
+            self._vectors_path, mode="w+", dtype=np.float32, shape=(rows, dim))
+        self._sketches = np.lib.format.open_memmap(
+            self._sketches_path, mode="w+", dtype=np.float32, shape=(rows, self.SKETCH_DIM))
+        self._timestamps = np.lib.format.open_memmap(
+            self._timestamps_path, mode="w+", dtype=np.float64, shape=(rows,))
+        self._log_lines = 0
+
+    def _grow(self):
+        """Double the memory-mapped matrices, up to capacity rows"""
+        rows = min(self.capacity, self._vectors.shape[0] * 2)
+        old_vectors = np.array(self._vectors[:self._count])
+        old_sketches = np.array(self._sketches[:self._count])
+        old_timestamps = np.array(self._timestamps[:self._count])
+        dim = self._vectors.shape[1]
+        self._vectors = None
+        self._sketches = None
+        self._timestamps = None
+        log_lines = self._log_lines
+        self._create(dim, rows)
+        self._log_lines = log_lines
+        self._vectors[:len(old_vectors)] = old_vectors
+        self._sketches[:len(old_sketches)] = old_sketches
+        self._timestamps[:len(old_timestamps)] = old_timestamps
+
+    def _reset(self):
+        self._vectors = None
+        self._sketches = None
+        self._projection = None
+        self._timestamps = None
+        self._entries = {}
+        self._count = 0
+        self._next = 0
+        for path in (self._vectors_path, self._sketches_path, self._timestamps_path, self._entries_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _compact_log(self):
+        tmp_path = self._entries_path + ".tmp"
+        self._write_log(tmp_path, self._entries, self._timestamps[list(self._entries)])
+        self._flush()
+        os.replace(tmp_path, self._entries_path)
+        self._log_lines = len(self._entries)
+
+    def _write_log(self, path, entries, times, checkpoint=None):
+        """Write entries (slot -> (query, answer)) with their times, in the same order, as a log file"""
+        slots = list(entries)
+        with open(path, "w", encoding="utf-8") as f:
+            # Oldest write first, like the append-only log it replaces
+            for n, i in enumerate(np.argsort(times, kind="stable")):
+                if checkpoint is not None and n % self.CHECKPOINT_LINES == 0:
+                    checkpoint()
+                slot = slots[i]
+                query, answer = entries[slot]
+                f.write(json.dumps({"slot": slot, "query": query, "answer": answer, "time": float(times[i])}) + "\n")
+
+    def _flush(self):
+        """Write the memory-mapped rows to disk, so the log never names rows that are not there yet"""
+        for matrix in (self._vectors, self._sketches, self._timestamps):
+            if matrix is not None:
+                matrix.flush()
+
+    def _load(self):
+        self._log_lines = 0
+        if not (os.path.exists(self._vectors_path) and os.path.exists(self._entries_path)):
+            return
+        try:
+            self._vectors = np.lib.format.open_memmap(self._vectors_path, mode="r+")
+            self._sketches = np.lib.format.open_memmap(self._sketches_path, mode="r+")
+            self._projection = self._make_projection(self._vectors.shape[1])
+            self._timestamps = np.lib.format.open_memmap(self._timestamps_path, mode="r+")
+            with open(self._entries_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._entries[entry["slot"]] = (entry["query"], entry["answer"])
+                    self._log_lines += 1
+            self._count = len(self._entries)
+            # The next write goes after the newest row; line order is not write order in older logs
+            if self._entries:
+                slots = list(self._entries)
+                newest = slots[int(np.argmax(self._timestamps[slots]))]
+                self._next = (newest + 1) % self.capacity
+            log.debug("Loaded semantic cache with %d entries", self._count)
+        except Exception as e:
+            log.warning("Error loading semantic cache, starting fresh: %s", e)
+            self._reset()
@@ -0,0 +1,292 @@
+"""
+This module contains session trace recording and the backends used to replay traces.
+
+A trace is a gzip-compressed JSON lines file. Each line is one record with a
+time offset `t` (seconds since recording started) and a `kind`:
+
+- "session": recording metadata (model, profile, start time)
+- "request": a request the UI sent to the engine (query, weather)
+- "event": an event the engine sent back; streamed chunks only keep their length
+- "http": one backend call with its status, time to first byte and body chunks
+  with their time offsets, so streamed answers can be replayed at their
+  original pace
+
+RecordingAdapter is mounted on the engine's requests session to capture
+backend traffic, with API keys removed from URLs. ReplayAdapter serves
+recorded (or stubbed) responses back at 1x or accelerated speed.
+"""
+
+import gzip
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from collections import defaultdict, deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+REDACTED_PARAMS = ("key", "apikey", "api_key", "token")
+
+def redact_url(url):
+    """Drop API keys from a URL's query string"""
+    parts = urllib.parse.urlsplit(url)
+    query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+             if k.lower() not in REDACTED_PARAMS]
+    return urllib.parse.urlunsplit(parts._replace(query=urllib.parse.urlencode(query)))
+
+def _body_text(body):
+    if body is None:
+        return ""
+    if isinstance(body, bytes):
+        return body.decode("utf-8", "surrogateescape")
+    return str(body)
+
+def load_trace(path):
+    """Read all records of a trace file"""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class TraceRecorder:
+    """Thread-safe writer of trace records"""
+
+    def __init__(self, path, **session_info):
+        self.path = path
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+        self.record("session", started=time.time(), **session_info)
+
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def record(self, kind, **fields):
+        line = json.dumps(dict(fields, t=round(self.elapsed(), 4), kind=kind), separators=(",", ":"))
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class _RecordingRaw:
+    """Wraps a urllib3 response body, timestamping chunks as the caller consumes them"""
+
+    def __init__(self, raw, start, on_done):
+        self._raw = raw
+        self._start = start
+        self._on_done = on_done
+        self._chunks = []
+
+    def _add(self, chunk):
+        if chunk:
+            self._chunks.append([round(time.monotonic() - self._start, 4), chunk.decode("utf-8", "surrogateescape")])
+        return chunk
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            yield self._add(chunk)
+        self._done()
+
+    def read(self, *args, **kwargs):
+        return self._add(self._raw.read(*args, **kwargs))
+
+    def close(self):
+        self._done()
+        self._raw.close()
+
+    def _done(self):
+        if self._on_done is not None:
+            on_done, self._on_done = self._on_done, None
+            on_done(self._chunks)
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport adapter that records every request and response to a TraceRecorder"""
+
+    def __init__(self, recorder, **kwargs):
+        super().__init__(**kwargs)
+        self.recorder = recorder
+
+    def send(self, request, stream=False, **kwargs):
+        start = time.monotonic()
+        response = super().send(request, stream=stream, **kwargs)
+        entry = {
+            "method": request.method,
+            "url": redact_url(request.url),
+            "body": _body_text(request.body),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type", ""),
+            "ttfb": round(time.monotonic() - start, 4),
+        }
+        response.raw = _RecordingRaw(response.raw, start,
+                                     lambda chunks: self.recorder.record("http", chunks=chunks, **entry))
+        if not stream:
+            response.content  # Read now, so the recorded timing covers the whole body
+            response.raw._done()
+        return response
+
+class _ReplayRaw:
+    """Serves recorded body chunks, sleeping so they arrive at their (scaled) recorded offsets"""
+
+    def __init__(self, chunks, start, speed):
+        self._chunks = deque(chunks)
+        self._start = start
+        self._speed = speed
+
+    def stream(self, amt=None, decode_content=None):
+        while self._chunks:
+            offset, text = self._chunks.popleft()
+            delay = self._start + offset / self._speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield text.encode("utf-8", "surrogateescape")
+
+    def read(self, *args, **kwargs):
+        return b"".join(self.stream())
+
+    def close(self):
+        self._chunks.clear()
+
+    def release_conn(self):
+        pass
+
+class ReplayAdapter(HTTPAdapter):
+    """
+    Transport adapter that answers from recorded "http" trace records.
+
+    A request is matched on method, URL (without API keys) and body first, then on
+    method and path alone, taking recorded responses in order. Requests nothing
+    was recorded for get a stub response when stub_missing is set, otherwise 404.
+    With no records at all every backend is stubbed.
+    """
+
+    def __init__(self, records=(), speed=1.0, stub_missing=True, **kwargs):
+        super().__init__(**kwargs)
+        self.speed = speed
+        self.stub_missing = stub_missing
+        self._lock = threading.Lock()
+        self._exact = defaultdict(deque)
+        self._by_endpoint = defaultdict(deque)
+        self.misses = 0
+        for record in records:
+            if record.get("kind") == "http":
+                self._exact[self._key(record["method"], record["url"], record["body"])].append(record)
+                self._by_endpoint[self._endpoint(record["method"], record["url"])].append(record)
+
+    @staticmethod
+    def _key(method, url, body):
+        return method, url, hashlib.sha1(body.encode("utf-8", "surrogateescape")).hexdigest()
+
+    @staticmethod
+    def _endpoint(method, url):
+        # Path only, so a trace still replays when the backend host or port changed
+        return method, urllib.parse.urlsplit(url).path
+
+    def _match(self, request):
+        url = redact_url(request.url)
+        body = _body_text(request.body)
+        with self._lock:
+            for queue in (self._exact.get(self._key(request.method, url, body)),
+                          self._by_endpoint.get(self._endpoint(request.method, url))):
+                if queue:
+                    record = queue.popleft()
+                    queue.append(record)  # Repeat recorded responses when replaying more often
+                    return record
+            self.misses += 1
+        return None
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        start = time.monotonic()
+        record = self._match(request)
+        if record is None:
+            record = stub_record(request) if self.stub_missing else {
+                "status": 404, "content_type": "text/plain", "ttfb": 0.0, "chunks": [[0.0, "no recorded response"]]}
+        delay = record["ttfb"] / self.speed
+        if delay > 0:
+            time.sleep(delay)
+
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.reason = "Replayed"
+        response.headers = CaseInsensitiveDict({"Content-Type": record.get("content_type", "")})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.raw = _ReplayRaw(record["chunks"], start, self.speed)
+        return response
+
+# Stub backends for replays without recordings: fixed, plausible payloads and latencies
+STUB_ANSWER = ("This is a stubbed answer used for replaying traces without a model. "
+               "It streams at a steady pace so latency comparisons stay meaningful.").split(" ")
+STUB_TOKEN_INTERVAL = 0.03
+STUB_EMBEDDING_DIM = 768
+
+def stub_record(request):
+    """Build a synthetic "http" record answering the request"""
+    path = urllib.parse.urlsplit(request.url).path
+    body = _body_text(request.body)
+    if path.endswith("/api/generate"):
+        streaming = json.loads(body or "{}").get("stream", True)
+        lines = [json.dumps({"response": word + " ", "done": False}) + "\n" for word in STUB_ANSWER]
+        final = {"response": "", "done": True, "eval_count": len(STUB_ANSWER),
+                 "eval_duration": int(len(STUB_ANSWER) * STUB_TOKEN_INTERVAL * 1e9),
+                 "prompt_eval_count": len(body) // 4, "prompt_eval_duration": int(len(body) // 4 * 2e6)}
+        if not streaming:
+            final["response"] = " ".join(STUB_ANSWER)
+            return {"status": 200, "content_type": "application/json", "ttfb": 0.3 + len(STUB_ANSWER) * STUB_TOKEN_INTERVAL,
+                    "chunks": [[0.3 + len(STUB_ANSWER) * STUB_TOKEN_INTERVAL, json.dumps(final)]]}
+        lines.append(json.dumps(final) + "\n")
+        chunks = [[round(0.3 + i * STUB_TOKEN_INTERVAL, 4), line] for i, line in enumerate(lines)]
+        return {"status": 200, "content_type": "application/x-ndjson", "ttfb": 0.3, "chunks": chunks}
+    if path.endswith("/api/embeddings"):
+        # Deterministic per text, so identical questions still hit the semantic cache
+        rng = random.Random(hashlib.sha1(body.encode("utf-8", "surrogateescape")).digest())
+        payload = {"embedding": [rng.gauss(0, 1) for _ in range(STUB_EMBEDDING_DIM)]}
+        return {"status": 200, "content_type": "application/json", "ttfb": 0.02, "chunks": [[0.02, json.dumps(payload)]]}
+    if path.endswith("/api/ps"):
+        return {"status": 200, "content_type": "application/json", "ttfb": 0.0, "chunks": [[0.0, '{"models": []}']]}
+    if "customsearch" in path:
+        items = [{"title": f"Result {i}", "link": f"https://example.com/{i}",
+                  "snippet": "Stubbed search snippet with a few facts about the topic of the question."}
+                 for i in range(1, 6)]
+        return {"status": 200, "content_type": "application/json", "ttfb": 0.4, "chunks": [[0.4, json.dumps({"items": items})]]}
+    if "weather" in path:
+        values = {"temperature": 18.5, "temperatureApparent": 18.0, "humidity": 60, "cloudCover": 40, "windSpeed": 3.2}
+        return {"status": 200, "content_type": "application/json", "ttfb": 0.3,
+                "chunks": [[0.3, json.dumps({"data": {"values": values}})]]}
+    return {"status": 404, "content_type": "text/plain", "ttfb": 0.0, "chunks": [[0.0, "no stub for this endpoint"]]}
+
+def request_latencies(records):
+    """
+    Latencies of the requests in a trace (recorded or replayed).
+
+    Returns {request id: {"mode", "ttft", "total"}}, with times in seconds from the
+    request to its first streamed chunk (draft or answer) and to the event that
+    finished it.
+    """
+    requests_by_id = {}
+    results = {}
+    for record in records:
+        if record.get("kind") == "request":
+            request = record["request"]
+            requests_by_id[request.get("id")] = (record["t"], request)
+        elif record.get("kind") == "event" and record.get("id") in requests_by_id:
+            sent_at, request = requests_by_id[record["id"]]
+            result = results.setdefault(record["id"], {"mode": request.get("mode", request.get("type")),
+                                                       "ttft": None, "total": None})
+            if record["event"] in ("chunk", "draft"):
+                if result["ttft"] is None:
+                    result["ttft"] = record["t"] - sent_at
+            elif record["event"] in ("answer", "system", "error") and result["total"] is None:
+                result["total"] = record["t"] - sent_at
+    return results
@@ -0,0 +1,118 @@
+"""
+This module contains the chat turn template and the guards that end a generation at the end of its turn.
+
+Prompts are plain text turns ("System: ...", "User: ...", "Assistant: ...")
+ending with an open "Assistant:" turn. Ollama is given STOP_SEQUENCES so the
+model stops instead of inventing the next "User:" turn, and TurnStopFilter
+catches variants the stop sequences miss ("**User:**", "Human:") while the
+answer streams, so the request can be closed early. classify_query() sorts
+questions into rough answer-length classes, so short questions get a smaller
+num_predict budget.
+"""
+
+import re
+
+STOP_SEQUENCES = ["\nUser:", "\nAssistant:", "\nSystem:"]
+
+# Not "you": answers legitimately contain lines such as "You: ..." in dialogue examples
+_ROLE_WORDS = ("User", "Human", "Assistant", "System")
+# Only at the very start of a line and capitalized as in the template, like STOP_SEQUENCES:
+# indented or lowercase keys ("  user: postgres" in a compose file) are part of the answer
+_TURN_MARKER = re.compile(r"\n\**(?:" + "|".join(_ROLE_WORDS) + r")\**:")
+_FENCE = re.compile(r"[ \t]*```")
+
+def _track_fences(in_code, line_head, text):
+    """
+    (in_code, line_head) after text, given the state before it. line_head is
+    the start of the unfinished last line, enough to tell whether it is a fence.
+    """
+    lines = text.split("\n")
+    line_head += lines[0]
+    for line in lines[1:]:
+        if _FENCE.match(line_head):
+            in_code = not in_code
+        line_head = line
+    return in_code, line_head.lstrip(" \t")[:3]
+
+def question_turn(prompt):
+    """The last turn of every prompt: the question and the open answer turn"""
+    return f"\nUser: {prompt}\nAssistant:"
+
+def history_without_question(history, prompt):
+    """The UI's history already ends with the question; drop it so it is not asked twice"""
+    if history and history[-1] == f"User: {prompt}":
+        return history[:-1]
+    return history
+
+class TurnStopFilter:
+    """
+    Pass streamed text through until the model starts writing another turn.
+
+    Text that might be the start of a turn marker is held back until it is
+    clear either way. Markers inside fenced code blocks are part of the
+    answer. Once a marker is seen, `stopped` is set and nothing more is
+    returned.
+    """
+    def __init__(self):
+        self.stopped = False
+        self._pending = ""
+        self._in_code = False   # Inside a ``` fenced block, in the text returned so far
+        self._line_head = ""    # Start of the last line returned so far
+
+    def feed(self, piece):
+        """Return the part of piece that belongs to the answer"""
+        if self.stopped:
+            return ""
+        text = self._pending + piece
+        in_code, line_head = self._in_code, self._line_head
+        scanned = 0
+        for match in _TURN_MARKER.finditer(text):
+            # Up to and including the newline, which completes a fence line right before the marker
+            in_code, line_head = _track_fences(in_code, line_head, text[scanned:match.start() + 1])
+            scanned = match.start() + 1
+            if not in_code:
+                self.stopped = True
+                self._pending = ""
+                return text[:match.start()]
+        cut = text.rfind("\n")
+        if cut >= 0 and self._could_start_marker(text[cut:]):
+            self._pending = text[cut:]
+            text = text[:cut]
+        else:
+            self._pending = ""
+        self._in_code, self._line_head = _track_fences(self._in_code, self._line_head, text)
+        return text
+
+    def flush(self):
+        """Return held back text once the answer is complete"""
+        text, self._pending = self._pending, ""
+        return "" if self.stopped else text
+
+    @staticmethod
+    def _could_start_marker(tail):
+        body = tail[1:].lstrip("*")
+        for word in _ROLE_WORDS:
+            if word.startswith(body):
+                return True  # The role word is still being written
+            if body.startswith(word) and not body[len(word):].strip("*"):
+                return True  # Only the colon is missing
+        return False
+
+_GREETING = re.compile(r"^(hi|hello|hey|yo|thanks|thank you|thx|ok|okay|cool|great|bye|good (morning|afternoon|evening|night))\b",
+                       re.IGNORECASE)
+_LONG_FORM = re.compile(r"\b(write|draft|code|script|program|function|implement|essay|story|poem|letter|email|list|steps|"
+                        r"step by step|in detail|detailed|summari[sz]e|summary|compare|comparison|plan|outline|translate|"
+                        r"table|examples)\b", re.IGNORECASE)
+_SHORT_QUESTION = re.compile(r"^(who|when|where|which|what is|what's|what are|how many|how much|how old|how far|how long|"
+                             r"is|are|was|were|do|does|did|can|could|will|would|should|has|have|define)\b", re.IGNORECASE)
+
+def classify_query(prompt):
+    """Rough answer length a question calls for: "chat", "short", "explain" or "long\""""
+    words = len(prompt.split())
+    if _LONG_FORM.search(prompt):
+        return "long"
+    if _GREETING.match(prompt) and words <= 6:
+        return "chat"
+    if _SHORT_QUESTION.match(prompt) and words <= 15:
+        return "short"
+    return "explain"